@@ -32,6 +32,9 @@ from .caper_check import check_caper_conf
 from .cromwell_rest_api import CromwellRestAPI
 from .caper_uri import URI_S3, URI_GCS, URI_LOCAL, \
     init_caper_uri, CaperURI
+from .caper_cache import CaperCache
+from .caper_stage import CaperStage
+from .caper_telemetry import CaperTelemetry
 from .caper_backend import BACKEND_GCP, BACKEND_AWS, BACKEND_LOCAL, \
     CaperBackendCommon, CaperBackendDatabase, CaperBackendGCP, \
     CaperBackendAWS, CaperBackendLocal, CaperBackendSLURM, \
@@ -167,6 +170,14 @@ class Caper(object):
         # troubleshoot
         self._show_completed_task = args.get('show_completed_task')
 
+        # cache
+        self._prune = args.get('prune')
+
+        # stage
+        self._plan_file = args.get('plan_file')
+        self._plan_only = args.get('plan_only')
+        self._resume = args.get('resume')
+
         # backend and default backend
         self._backend = args.get('backend')
         if self._backend is None:
@@ -231,6 +242,7 @@ class Caper(object):
         print('[Caper] cmd: ', cmd)
 
         if self._dry_run:
+            Caper.__print_transfer_summary()
             return -1
         try:
             p = Popen(cmd, stdout=PIPE, universal_newlines=True)
@@ -277,6 +289,7 @@ class Caper(object):
                 CaperURI(metadata_uri).get_local_file(),
                 self._show_completed_task)
 
+        Caper.__print_transfer_summary()
         print('[Caper] run: ', rc, workflow_id, metadata_uri)
         return workflow_id
 
@@ -382,6 +395,7 @@ class Caper(object):
             input_file, tmp_dir)
         labels_file = self.__create_labels_json_file(tmp_dir)
         on_hold = self._hold if self._hold is not None else False
+        Caper.__print_transfer_summary()
 
         if self._dry_run:
             return -1
@@ -493,9 +507,10 @@ class Caper(object):
         # if it's a file
         wf_id_or_label = []
         metadatas = []
+        CaperURI.stat_many(self._wf_id_or_label)
         for f in self._wf_id_or_label:
             cu = CaperURI(f)
-            if cu.file_exists():
+            if cu.file_exists() and not cu.is_dir():
                 metadatas.append(cu.get_local_file())
             else:
                 wf_id_or_label.append(f)
@@ -507,6 +522,72 @@ class Caper(object):
         for metadata in metadatas:
             Caper.__troubleshoot(metadata, self._show_completed_task)
 
+    def cache(self):
+        """Show statistics of a local cache for remote files and prune it
+        """
+        cache = CaperURI.CACHE
+        if cache is None:
+            # cache without size limit, just for statistics
+            cache = CaperCache(CaperURI.TMP_DIR)
+        if self._prune and not self._dry_run:
+            evicted = cache.prune()
+            print('[Caper] cache: evicted {} files'.format(len(evicted)))
+        stats = cache.get_stats()
+        for k, v in stats.items():
+            print('{}\t{}'.format(k, v))
+        return stats
+
+    def stage(self):
+        """Deepcopy files in an input JSON file for a backend in two
+        phases. Write a plan file first and then copy files in it.
+        Copy can be resumed with an existing plan file (--resume).
+
+        Returns:
+            URI of a deepcopied input JSON file.
+            None if not copied (--plan-only or --dry-run).
+        """
+        uri_type = self.__get_deepcopy_uri_type()
+        inputs = CaperURI(self._inputs).get_local_file()
+        plan_file = self._plan_file
+        if plan_file is None:
+            plan_file = os.path.join(
+                self._tmp_dir, '{}.{}.plan.json'.format(
+                    os.path.splitext(os.path.basename(inputs))[0], uri_type))
+
+        if self._resume:
+            if not os.path.exists(os.path.expanduser(plan_file)):
+                raise FileNotFoundError(
+                    'Plan file does not exist for --resume. '
+                    'plan: {}'.format(plan_file))
+            stage = CaperStage(plan_file)
+        else:
+            stage = CaperStage.create(
+                inputs, plan_file, uri_type=uri_type,
+                uri_exts=self._deepcopy_ext or (), no_copy_root=True)
+
+        summary = stage.get_summary()
+        print('[Caper] stage: plan: {}'.format(stage.plan_file))
+        print('[Caper] stage: files: {num_files} (copy: {num_copy}, '
+              'skip: {num_skip}, done: {num_done}, '
+              'pending: {num_pending})'.format(**summary))
+        print('[Caper] stage: total: {total}, pending: {pending}, '
+              'estimated time: {sec:.1f} sec'.format(
+                total=CaperTelemetry.format_bytes(summary['total_bytes']),
+                pending=CaperTelemetry.format_bytes(
+                    summary['pending_bytes']),
+                sec=summary['estimated_sec']))
+        if summary['num_unknown_size']:
+            print('[Caper] stage: {} pending files with unknown size are '
+                  'not included in estimate.'.format(
+                    summary['num_unknown_size']))
+
+        if self._plan_only or self._dry_run:
+            return None
+        new_uri, _ = stage.execute(parallel=True)
+        print('[Caper] stage: deepcopied inputs: {}'.format(new_uri))
+        Caper.__print_transfer_summary()
+        return new_uri
+
     def __init_cromwell_rest_api(self, action, ip, port,
                                  server_hearbeat_file,
                                  server_hearbeat_timeout):
@@ -637,17 +718,11 @@ class Caper(object):
 
             if not self._no_deepcopy and self._deepcopy_ext:
                 # deepcopy all files in JSON/TSV/CSV
-                #   to the target backend
-                if self._backend == BACKEND_GCP:
-                    uri_type = URI_GCS
-                elif self._backend == BACKEND_AWS:
-                    uri_type = URI_S3
-                else:
-                    uri_type = URI_LOCAL
-
+                #   to the target backend in parallel
                 new_uri, _ = CaperURI(new_uri).deepcopy(
-                    uri_type=uri_type, uri_exts=self._deepcopy_ext,
-                    no_copy_root=True)
+                    uri_type=self.__get_deepcopy_uri_type(),
+                    uri_exts=self._deepcopy_ext,
+                    no_copy_root=True, parallel=True)
 
             return new_uri
         else:
@@ -656,6 +731,16 @@ class Caper(object):
                 fp.write('{}')
             return input_file
 
+    def __get_deepcopy_uri_type(self):
+        """Storage type to deepcopy input files to for a backend
+        """
+        if self._backend == BACKEND_GCP:
+            return URI_GCS
+        elif self._backend == BACKEND_AWS:
+            return URI_S3
+        else:
+            return URI_LOCAL
+
     def __create_labels_json_file(
             self, directory, fname=TMP_FILE_BASENAME_LABELS_JSON):
         """Create labels JSON file
@@ -1064,6 +1149,18 @@ class Caper(object):
                 return True
         return False
 
+    @staticmethod
+    def __print_transfer_summary():
+        """Print a summary table of file operations (e.g. deepcopying
+        an input JSON) by CaperURI
+        """
+        summary = CaperURI.TELEMETRY.format_summary()
+        if summary:
+            print('[Caper] file transfer summary:\n{}'.format(summary))
+            if CaperURI.TELEMETRY.log_file is not None:
+                print('[Caper] file transfer log: {}'.format(
+                    CaperURI.TELEMETRY.log_file))
+
     @staticmethod
     def __get_time_str():
         return datetime.now().strftime('%Y%m%d_%H%M%S_%f')
@@ -1137,8 +1234,22 @@ class Caper(object):
                             print('STDERR_CONTENTS=\n{}'.format(
                                 stderr_contents))
 
+        def find_stderrs(calls, stderrs):
+            for call_ in calls.values():
+                for call in call_:
+                    if 'subWorkflowMetadata' in call:
+                        find_stderrs(call['subWorkflowMetadata']['calls'],
+                                     stderrs)
+                    elif 'stderr' in call and (show_completed_task or
+                            call['executionStatus'] not in ('Done',
+                                                            'Succeeded')):
+                        stderrs.append(call['stderr'])
+            return stderrs
+
         calls = metadata['calls']
         failures = metadata['failures'] if 'failures' in metadata else None
+        # check if stderr files exist all at once
+        CaperURI.stat_many(find_stderrs(calls, []))
         recurse_calls(calls, failures, show_completed_task)
 
     @staticmethod
@@ -1161,7 +1272,7 @@ class Caper(object):
                 for i, v in enumerate(d):
                     result |= recurse_dict(v, lst=d,
                                            lst_idx=i)
-            elif type(d) == str:
+            elif type(d) == str and CaperURI.is_uri_candidate(d):
                 assert(d_parent is not None or lst is not None)
                 c = CaperURI(d)
                 # local absolute path only
@@ -1224,6 +1335,20 @@ def main():
         http_password=args.get('http_password'),
         use_netrc=args.get('use_netrc'),
         use_gsutil_over_aws_s3=args.get('use_gsutil_over_aws_s3'),
+        max_concurrent_transfers=args.get('max_concurrent_transfers'),
+        max_transfer_bandwidth=args.get('max_transfer_bandwidth'),
+        local_cache_max_size=args.get('local_cache_max_size'),
+        verify_checksum=args.get('verify_checksum'),
+        stream_transfer=args.get('stream_transfer'),
+        storage_driver=args.get('storage_driver'),
+        batch_transfer=args.get('batch_transfer'),
+        local_copy_strategy=args.get('local_copy_strategy'),
+        transfer_log_file=args.get('transfer_log'),
+        transfer_max_retries=args.get('transfer_max_retries'),
+        transfer_retry_budget=args.get('transfer_retry_budget'),
+        multipart_upload_part_size=args.get('multipart_upload_part_size'),
+        multipart_upload_num_threads=args.get('multipart_upload_threads'),
+        expand_glob=args.get('expand_glob'),
         verbose=True)
 
     # init caper: taking all args at init step
@@ -1246,6 +1371,10 @@ def main():
         c.unhold()
     elif action in ['troubleshoot', 'debug']:
         c.troubleshoot()
+    elif action == 'cache':
+        c.cache()
+    elif action == 'stage':
+        c.stage()
 
     else:
         raise Exception('Unsupported or unspecified action.')
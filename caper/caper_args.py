@@ -13,6 +13,7 @@ from distutils.util import strtobool
 from collections import OrderedDict
 from .caper_backend import BACKENDS, BACKENDS_WITH_ALIASES
 from .caper_backend import BACKEND_GCP, BACKEND_AWS, BACKEND_LOCAL
+from .caper_storage import STORAGE_DRIVER_CLI, STORAGE_DRIVER_SDK
 from .caper_backend import BACKEND_SLURM, BACKEND_SGE, BACKEND_PBS
 from .caper_backend import BACKEND_ALIAS_LOCAL
 from .caper_backend import BACKEND_ALIAS_GOOGLE, BACKEND_ALIAS_AMAZON
@@ -295,6 +296,18 @@ def parse_caper_arguments():
         '--use-gsutil-over-aws-s3', action='store_true',
         help='Use gsutil instead of aws s3 CLI even for S3 buckets.')
 
+    # run, server, submit, cache
+    parent_cache = argparse.ArgumentParser(add_help=False)
+    group_cache = parent_cache.add_argument_group(
+        title='local cache arguments')
+    group_cache.add_argument(
+        '--local-cache-max-size',
+        help='Maximum total size of local copies of remote files '
+             '(gs://, s3:// and URLs) on --tmp-dir. '
+             'e.g. 500G. If defined, these files are deduplicated by '
+             'their contents and least recently used files are removed '
+             'when the total size exceeds this limit.')
+
     parent_http_auth = argparse.ArgumentParser(add_help=False)
     group_http = parent_http_auth.add_argument_group(
         title='HTTP/HTTPS authentication arguments')
@@ -368,7 +381,9 @@ def parse_caper_arguments():
         '--java-heap-run', default=DEFAULT_JAVA_HEAP_RUN,
         help='Cromwell Java heap size for "run" mode (java -Xmx)')
 
-    parent_submit.add_argument(
+    # run, submit, stage
+    parent_deepcopy = argparse.ArgumentParser(add_help=False)
+    parent_deepcopy.add_argument(
         '--no-deepcopy', action='store_true',
         help='(IMPORTANT) --deepcopy has been deprecated. '
              'Deepcopying is now activated by default. '
@@ -379,9 +394,104 @@ def parse_caper_arguments():
              'and make copies of files on a local/remote storage '
              'for a target backend. Make sure that you have installed '
              'gsutil for GCS and aws for S3.')
-    parent_submit.add_argument(
+    parent_deepcopy.add_argument(
         '--deepcopy-ext', default=DEFAULT_DEEPCOPY_EXT,
         help='Comma-separated list of file extensions to be deepcopied')
+    parent_deepcopy.add_argument(
+        '--max-concurrent-transfers',
+        help='Maximum number of concurrent file transfers for each storage '
+             'type while deepcopying files in parallel. '
+             'Comma-separated list of STORAGE:NUMBER. '
+             'Storage types: gcs, s3, url and local. '
+             'e.g. gcs:8,s3:8,url:4,local:4 (default)')
+    parent_deepcopy.add_argument(
+        '--max-transfer-bandwidth',
+        help='Maximum bandwidth (bytes per second) of file transfers for '
+             'each storage type. Comma-separated list of STORAGE:SIZE. '
+             'Storage types: gcs, s3, url and local. '
+             'Size units (K, M, G, T) are powers of 1024. '
+             'A transfer counts against limits of both source and target '
+             'storages. No limit for missing storage types. '
+             'e.g. gcs:100M,url:50M')
+    parent_deepcopy.add_argument(
+        '--multipart-upload-part-size',
+        help='Size of a part for a parallel upload of a large local file '
+             'to gs:// or s3://. Files larger than it are uploaded in '
+             'parts in parallel and an interrupted upload is resumed '
+             'from uploaded parts. Size units (K, M, G, T) are powers of '
+             '1024. 0 to disable. Objects uploaded with gsutil in parts '
+             'are composite objects without MD5 hash and need crcmod to '
+             'be downloaded with gsutil. (default: 0 for cli storage '
+             'driver, 64M for others)')
+    parent_deepcopy.add_argument(
+        '--multipart-upload-threads', type=int,
+        help='Number of threads to upload parts of a large local file '
+             'in parallel. (default: 4)')
+    parent_deepcopy.add_argument(
+        '--verify-checksum', action='store_true',
+        help='Compare MD5 hashes (if available) in addition to file sizes '
+             'to decide whether an existing copy of a file can be re-used '
+             'while deepcopying. Hashes of local files are cached on '
+             '--tmp-dir.')
+    parent_deepcopy.add_argument(
+        '--stream-transfer', action='store_true',
+        help='Stream files from URLs or between cloud storages '
+             '(gs://, s3://) to a cloud storage while deepcopying '
+             'instead of making a temporary local copy on --tmp-dir.')
+    parent_deepcopy.add_argument(
+        '--storage-driver', default=STORAGE_DRIVER_CLI,
+        choices=[STORAGE_DRIVER_CLI, STORAGE_DRIVER_SDK],
+        help='Driver for file transfers on cloud storages (gs://, s3://) '
+             'while deepcopying. cli: gsutil and aws s3 CLIs. '
+             'sdk: in-process Python client libraries '
+             '(google-cloud-storage and boto3), which do not spawn '
+             'a process for each file. Install them with '
+             '"pip install caper[sdk]".')
+    parent_deepcopy.add_argument(
+        '--batch-transfer', action='store_true',
+        help='Collect file transfers from/to cloud storages (gs://, s3://) '
+             'while deepcopying and run them as a batch. gsutil runs a '
+             'single "gsutil -m cp -I" for each target directory. '
+             'Other drivers (e.g. aws CLI) copy files in a batch on '
+             'a thread pool. Both are bounded by '
+             '--max-concurrent-transfers. '
+             'Failed files are copied again one by one.')
+    parent_deepcopy.add_argument(
+        '--expand-glob', action='store_true',
+        help='Expand glob patterns (*, ?, [...] and ** for any number of '
+             'directories) of local paths, gs:// and s3:// URIs in input '
+             'JSON into arrays of matching files while deepcopying. '
+             'Each directory before the first wildcard is listed only '
+             'once. A pattern without any match is kept as it is. '
+             'e.g. "gs://bucket/run42/*.fastq.gz"')
+    parent_deepcopy.add_argument(
+        '--local-copy-strategy',
+        help='Comma-separated list of strategies for local to local copy. '
+             'They are tried in the order until one succeeds. '
+             'reflink: copy-on-write clone (e.g. btrfs, xfs). '
+             'hardlink: hard link on the same filesystem (a copy shares '
+             'contents with its source). '
+             'zero_copy: in-kernel copy (copy_file_range/sendfile). '
+             'copy: plain copy, always tried last. '
+             'e.g. reflink,hardlink,zero_copy,copy (default)')
+    parent_deepcopy.add_argument(
+        '--transfer-log',
+        help='JSON-lines file to append an event for each file operation '
+             '(copy, stat, list, read, write, sign, rm and lock_wait) '
+             'with storage types, bytes, wall time and retries. '
+             'A summary table is printed at the end regardless of it.')
+    parent_deepcopy.add_argument(
+        '--transfer-max-retries', type=int,
+        help='Maximum number of retries for each file operation on '
+             'transient errors (e.g. HTTP 429/5xx, connection errors, '
+             'failed gsutil/aws CLI). Retried with exponential backoff and '
+             'jitter. Rate-limited storage pauses all transfers from/to it. '
+             '0 to disable retry. (default: 5)')
+    parent_deepcopy.add_argument(
+        '--transfer-retry-budget', type=int,
+        help='Maximum total number of retries for all file operations '
+             'in a run. Errors are not retried once it is exhausted. '
+             '(default: 100)')
 
     group_dep = parent_submit.add_argument_group(
         title='dependency resolver for all backends',
@@ -484,6 +594,38 @@ def parse_caper_arguments():
     parent_troubleshoot.add_argument(
         '--show-completed-task', action='store_true',
         help='Show information about completed tasks.')
+    # cache
+    parent_cache_action = argparse.ArgumentParser(add_help=False)
+    parent_cache_action.add_argument(
+        '--tmp-dir', help='Temporary directory where cache is stored')
+    parent_cache_action.add_argument(
+        '--prune', action='store_true',
+        help='Remove least recently used files from cache until '
+             'its total size <= --local-cache-max-size.')
+
+    # stage
+    parent_stage = argparse.ArgumentParser(add_help=False)
+    parent_stage.add_argument(
+        '-i', '--inputs', required=True, help='Workflow inputs JSON file')
+    parent_stage.add_argument(
+        '--plan-file',
+        help='Plan file (JSON) for deepcopy. '
+             'Default: [INPUTS_BASENAME].[URI_TYPE].plan.json on --tmp-dir. '
+             'Completed files are journaled on [PLAN_FILE].journal.')
+    parent_stage.add_argument(
+        '--plan-only', action='store_true',
+        help='Write a plan file and show total bytes and estimated time '
+             'to copy files without copying them.')
+    parent_stage.add_argument(
+        '--resume', action='store_true',
+        help='Resume deepcopy with an existing plan file. '
+             'Files already journaled are not copied again.')
+    parent_stage.add_argument(
+        '--tmp-dir', help='Temporary directory for local backend')
+    parent_stage.add_argument(
+        '--tmp-gcs-bucket', help='Temporary GCS bucket for GC backend')
+    parent_stage.add_argument(
+        '--tmp-s3-bucket', help='Temporary S3 bucket for AWS backend')
 
     p_init = subparser.add_parser(
         'init',
@@ -492,16 +634,17 @@ def parse_caper_arguments():
         parents=[parent_init])
     p_run = subparser.add_parser(
         'run', help='Run a single workflow without server',
-        parents=[parent_all, parent_submit, parent_run, parent_host, parent_backend,
-                 parent_http_auth])
+        parents=[parent_all, parent_submit, parent_deepcopy, parent_run,
+                 parent_host, parent_backend, parent_http_auth, parent_cache])
     p_server = subparser.add_parser(
         'server', help='Run a Cromwell server',
         parents=[parent_all, parent_server_client, parent_server, parent_host,
-                 parent_backend, parent_http_auth])
+                 parent_backend, parent_http_auth, parent_cache])
     p_submit = subparser.add_parser(
         'submit', help='Submit a workflow to a Cromwell server',
         parents=[parent_all, parent_server_client, parent_submit,
-                 parent_backend, parent_http_auth])
+                 parent_deepcopy, parent_backend, parent_http_auth,
+                 parent_cache])
     p_abort = subparser.add_parser(
         'abort', help='Abort running/pending workflows on a Cromwell server',
         parents=[parent_all, parent_server_client, parent_search_wf])
@@ -527,9 +670,21 @@ def parse_caper_arguments():
         help='Identical to "troubleshoot"',
         parents=[parent_all, parent_troubleshoot, parent_server_client, parent_search_wf,
                  parent_http_auth])
+    p_cache = subparser.add_parser(
+        'cache',
+        help='Show statistics of a local cache for remote files and '
+             'prune it',
+        parents=[parent_all, parent_cache_action, parent_cache])
+    p_stage = subparser.add_parser(
+        'stage',
+        help='Deepcopy files in an input JSON file for a backend '
+             'in two phases (plan and copy). Interrupted copy can be '
+             'resumed with a plan file',
+        parents=[parent_all, parent_stage, parent_deepcopy, parent_backend,
+                 parent_http_auth, parent_cache])
 
     for p in [p_init, p_run, p_server, p_submit, p_abort, p_unhold, p_list,
-              p_metadata, p_troubleshoot, p_debug]:
+              p_metadata, p_troubleshoot, p_debug, p_cache, p_stage]:
         p.set_defaults(**defaults)
 
     if len(sys.argv[1:]) == 0:
@@ -551,7 +706,14 @@ def parse_caper_arguments():
         'no_build_singularity',
         'no_file_db',
         'use_netrc',
-        'show_completed_task']:
+        'show_completed_task',
+        'prune',
+        'plan_only',
+        'resume',
+        'verify_checksum',
+        'stream_transfer',
+        'batch_transfer',
+        'expand_glob']:
         v = args_d.get(k)
         if v is not None and isinstance(v, str):
             args_d[k] = bool(strtobool(v))
@@ -562,6 +724,9 @@ def parse_caper_arguments():
         'max_retries',
         'max_concurrent_tasks',
         'max_concurrent_workflows',
+        'transfer_max_retries',
+        'transfer_retry_budget',
+        'multipart_upload_threads',
         'server_heartbeat_timeout',
         'port']:
         v = args_d.get(k)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""CaperCache: Size-bounded content-addressed cache for local copies
+of remote files
+
+Author:
+    Jin Lee (leepc12@gmail.com) at ENCODE-DCC
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+from contextlib import contextmanager
+
+
+class CaperCache(object):
+    """Content-addressed cache for remote (gs://, s3://, URL) to local
+    copies on CaperURI.TMP_DIR.
+
+    Each cached file is stored once in CACHE_DIR/objects/ under
+    its MD5 hash and every local copy (e.g. TMP_DIR/bucket/a/b.txt)
+    is a hard link to it. Therefore, identical files from different
+    buckets or URLs share a single copy on disk.
+
+    Access times are recorded on an SQLite index. Least recently used
+    objects are evicted (together with all their hard links) when the
+    total size of objects exceeds max_size. Objects accessed by the
+    current process are never evicted so that files for an input JSON
+    being deepcopied are kept even if they don't fit in max_size.
+    """
+
+    DIRNAME = '.caper_cache'
+    OBJECTS_DIRNAME = 'objects'
+    INDEX_DB_BASENAME = 'index.db'
+    HASH_CHUNK_SIZE = 1024 * 1024
+    DB_TIMEOUT_SEC = 60
+
+    def __init__(self, tmp_dir, max_size=None, verbose=False):
+        """
+        Args:
+            tmp_dir:
+                CaperURI.TMP_DIR. Cache is stored on tmp_dir/DIRNAME/.
+            max_size:
+                Maximum total size of cached files in bytes.
+                None for no limit.
+        """
+        self._cache_dir = os.path.join(tmp_dir, CaperCache.DIRNAME)
+        self._objects_dir = os.path.join(self._cache_dir,
+                                         CaperCache.OBJECTS_DIRNAME)
+        self._index_db = os.path.join(self._cache_dir,
+                                      CaperCache.INDEX_DB_BASENAME)
+        self._max_size = max_size
+        self._verbose = verbose
+        self._start_time = time.time()
+
+        os.makedirs(self._objects_dir, exist_ok=True)
+        with self.__connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS objects ('
+                         'hash TEXT PRIMARY KEY, size INTEGER, '
+                         'last_access REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS paths ('
+                         'path TEXT PRIMARY KEY, hash TEXT)')
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    def add(self, path):
+        """Add a local file to cache. If an identical file is already
+        cached then path is replaced with a hard link to it.
+        Evict LRU objects if cache is full.
+
+        Returns:
+            path
+        """
+        h = CaperCache.__get_md5_hash(path)
+        obj = self.__get_object_path(h)
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        try:
+            os.link(path, obj)
+        except FileExistsError:
+            if not os.path.samefile(path, obj):
+                # dedup: replace path with a hard link to cached object
+                tmp_path = path + '.caper_cache_tmp'
+                os.link(obj, tmp_path)
+                os.replace(tmp_path, path)
+                if self._verbose:
+                    print('[CaperCache] dedup, hash: {}, path: {}'.format(
+                        h, path))
+        size = os.path.getsize(obj)
+        with self.__connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO objects VALUES (?, ?, ?)',
+                         (h, size, time.time()))
+            conn.execute('INSERT OR REPLACE INTO paths VALUES (?, ?)',
+                         (path, h))
+        if self._max_size is not None:
+            # stale paths are not swept here since it stats all paths
+            self.__evict_lru(self._max_size)
+        return path
+
+    def touch(self, path):
+        """Update access time of a cached file
+
+        Returns:
+            False if path is not in cache.
+        """
+        with self.__connect() as conn:
+            cur = conn.execute(
+                'UPDATE objects SET last_access = ? WHERE hash = '
+                '(SELECT hash FROM paths WHERE path = ?)',
+                (time.time(), path))
+            return cur.rowcount > 0
+
+    def get_stats(self):
+        """
+        Returns:
+            A dict of cache statistics.
+        """
+        with self.__connect() as conn:
+            num_objects, total_size, oldest_access = conn.execute(
+                'SELECT COUNT(*), SUM(size), MIN(last_access) '
+                'FROM objects').fetchone()
+            num_paths = conn.execute(
+                'SELECT COUNT(*) FROM paths').fetchone()[0]
+        return {
+            'cache_dir': self._cache_dir,
+            'num_objects': num_objects,
+            'num_paths': num_paths,
+            'total_size': total_size or 0,
+            'max_size': self._max_size,
+            'oldest_access': oldest_access,
+        }
+
+    def prune(self, max_size=None):
+        """Remove index entries for deleted paths and then evict LRU objects
+        until total size of cache <= max_size. It stats all indexed paths
+        so it is not called for each add() (see "caper cache --prune").
+
+        Args:
+            max_size:
+                Use self.max_size if not defined.
+        Returns:
+            List of evicted hashes.
+        """
+        if max_size is None:
+            max_size = self._max_size
+
+        with self.__connect() as conn:
+            stale_paths = [
+                (p,) for p, h in conn.execute(
+                    'SELECT path, hash FROM paths')
+                if not os.path.exists(p)]
+            conn.executemany('DELETE FROM paths WHERE path = ?', stale_paths)
+        return self.__evict_lru(max_size)
+
+    def __evict_lru(self, max_size):
+        """Evict LRU objects until total size of cache <= max_size.
+        Only total size is queried if cache is not full.
+
+        Returns:
+            List of evicted hashes.
+        """
+        with self.__connect() as conn:
+            total_size = conn.execute(
+                'SELECT SUM(size) FROM objects').fetchone()[0] or 0
+            if max_size is None or total_size <= max_size:
+                return []
+            lru_objects = conn.execute(
+                'SELECT hash, size FROM objects WHERE last_access < ? '
+                'ORDER BY last_access', (self._start_time,)).fetchall()
+
+        evicted = []
+        for h, size in lru_objects:
+            if total_size <= max_size:
+                break
+            self.__evict(h)
+            total_size -= size
+            evicted.append(h)
+        return evicted
+
+    def __evict(self, h):
+        obj = self.__get_object_path(h)
+        with self.__connect() as conn:
+            paths = [p for p, in conn.execute(
+                'SELECT path FROM paths WHERE hash = ?', (h,))]
+            for p in paths:
+                try:
+                    # remove hard links to obj only
+                    if os.path.samefile(p, obj):
+                        os.remove(p)
+                except FileNotFoundError:
+                    pass
+            try:
+                os.remove(obj)
+            except FileNotFoundError:
+                pass
+            conn.execute('DELETE FROM paths WHERE hash = ?', (h,))
+            conn.execute('DELETE FROM objects WHERE hash = ?', (h,))
+        if self._verbose:
+            print('[CaperCache] evicted, hash: {}, paths: {}'.format(h, paths))
+
+    def __get_object_path(self, h):
+        return os.path.join(self._objects_dir, h[:2], h)
+
+    @contextmanager
+    def __connect(self):
+        """Connect to index DB and commit on exit
+        """
+        conn = sqlite3.connect(self._index_db,
+                               timeout=CaperCache.DB_TIMEOUT_SEC)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def __get_md5_hash(path):
+        md5 = hashlib.md5()
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(CaperCache.HASH_CHUNK_SIZE),
+                              b''):
+                md5.update(chunk)
+        return md5.hexdigest()
@@ -7,8 +7,50 @@ Author:
 
 import os
 from .caper_backend import BACKENDS, BACKEND_SLURM, get_backend
+from .caper_uri import URI_URL, URI_S3, URI_GCS, URI_LOCAL
 
 DEFAULT_FILE_DB_PREFIX = 'caper_file_db'
+STORAGE_TYPE_ALIASES = {
+    'gs': URI_GCS,
+    'http': URI_URL,
+    'https': URI_URL,
+    'ftp': URI_URL,
+}
+
+
+def parse_size(s):
+    """Parse a size string with an optional unit suffix (K, M, G, T)
+    into bytes. Units are powers of 1024.
+
+    Example: "500G" -> 536870912000
+    """
+    if isinstance(s, int):
+        return s
+    s = s.strip().upper().rstrip('B')
+    units = 'KMGT'
+    if s and s[-1] in units:
+        return int(float(s[:-1]) * 1024 ** (units.index(s[-1]) + 1))
+    return int(s)
+
+
+def parse_storage_dict(s, val_type=int):
+    """Parse a comma-separated list of STORAGE:VALUE
+    into a dict of {uri_type: val_type(VALUE)}
+
+    Example: "gcs:8,s3:8,url:4" -> {'gcs': 8, 's3': 8, 'url': 4}
+    """
+    result = {}
+    for item in s.split(','):
+        item = item.strip()
+        if item == '':
+            continue
+        storage, val = item.split(':', 1)
+        storage = storage.strip().lower()
+        storage = STORAGE_TYPE_ALIASES.get(storage, storage)
+        if storage not in (URI_URL, URI_S3, URI_GCS, URI_LOCAL):
+            raise ValueError('Unsupported storage type: {}'.format(storage))
+        result[storage] = val_type(val.strip())
+    return result
 
 
 def check_caper_conf(args_d):
@@ -88,6 +130,35 @@ def check_caper_conf(args_d):
         args_d['singularity_cachedir'] = singularity_cachedir
         os.makedirs(singularity_cachedir, exist_ok=True)
 
+    max_concurrent_transfers = args_d.get('max_concurrent_transfers')
+    if isinstance(max_concurrent_transfers, str):
+        args_d['max_concurrent_transfers'] = parse_storage_dict(
+            max_concurrent_transfers)
+
+    max_transfer_bandwidth = args_d.get('max_transfer_bandwidth')
+    if isinstance(max_transfer_bandwidth, str):
+        args_d['max_transfer_bandwidth'] = parse_storage_dict(
+            max_transfer_bandwidth, val_type=parse_size)
+
+    transfer_log = args_d.get('transfer_log')
+    if transfer_log is not None:
+        args_d['transfer_log'] = os.path.abspath(
+            os.path.expanduser(transfer_log))
+
+    local_copy_strategy = args_d.get('local_copy_strategy')
+    if isinstance(local_copy_strategy, str):
+        args_d['local_copy_strategy'] = [
+            s.strip() for s in local_copy_strategy.split(',') if s.strip()]
+
+    multipart_upload_part_size = args_d.get('multipart_upload_part_size')
+    if multipart_upload_part_size is not None:
+        args_d['multipart_upload_part_size'] = parse_size(
+            multipart_upload_part_size)
+
+    local_cache_max_size = args_d.get('local_cache_max_size')
+    if local_cache_max_size is not None:
+        args_d['local_cache_max_size'] = parse_size(local_cache_max_size)
+
     if args_d.get('str_label') is None:
         if args_d.get('inputs') is not None:
             basename = os.path.basename(args_d['inputs'])
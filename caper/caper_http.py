@@ -0,0 +1,575 @@
+#!/usr/bin/env python3
+"""CaperHTTP: In-process HTTP client for CaperURI
+
+Author:
+    Jin Lee (leepc12@gmail.com) at ENCODE-DCC
+"""
+
+import os
+import re
+import json
+import time
+import base64
+import codecs
+import tempfile
+import threading
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from subprocess import Popen, run, PIPE, CalledProcessError
+import requests
+from requests.adapters import HTTPAdapter
+from requests.utils import get_netrc_auth
+
+
+class CaperHTTPError(Exception):
+    """HTTP error with a status code and a delay requested by
+    a server in Retry-After header (in seconds, None if not defined).
+    """
+
+    def __init__(self, status_code, url, retry_after=None):
+        super().__init__('HTTP_ERR: {}, URL: {}'.format(status_code, url))
+        self.status_code = status_code
+        self.url = url
+        self.retry_after = retry_after
+
+
+class CaperHTTP(object):
+    """HTTP client built on a single pooled keep-alive session.
+
+    Authentication follows curl's behavior in older versions of CaperURI:
+    a request is made without auth first and it's re-tried with auth
+    (HTTP_USER/HTTP_PASSWORD or ~/.netrc) on HTTP 401/403 only.
+    A host that required auth once is remembered so that
+    following requests to it go with auth directly.
+
+    Downloads are resumed with a ranged request if a partial file
+    already exists. Large files on servers supporting ranged requests
+    are downloaded in parallel chunks.
+
+    Validators of a downloaded file (ETag, Last-Modified and size) are
+    stored next to it (path + VALIDATORS_EXT). A complete download is
+    revalidated with a conditional request (If-None-Match and
+    If-Modified-Since) so that an unchanged file (HTTP 304) is never
+    downloaded again. A partial download is resumed with If-Range so
+    that a server sends a whole file again if it has been changed.
+
+    requests does not support ftp://. ftp:// URLs are handled with curl
+    without resuming, parallel download and validators.
+    """
+
+    DELAY_SEC_HTTP_AUTH = 2
+    HTTP_ERR_AUTH = (401, 403)
+    HTTP_ERR_NOT_FOUND = (401, 403, 404, 416)
+    POOL_SIZE = 32
+    TIMEOUT_SEC = 60
+    CHUNK_SIZE = 1024 * 1024
+    PARALLEL_MIN_FILE_SIZE = 256 * 1024 * 1024
+    PARALLEL_PART_SIZE = 64 * 1024 * 1024
+    PARALLEL_NUM_THREADS = 4
+    PARALLEL_TMP_EXT = '.caper_download'
+    VALIDATORS_EXT = '.caper_validators'
+    RE_PATTERN_CONTENT_RANGE_TOTAL = r'/\s*(\d+)\s*$'
+    RE_PATTERN_MD5_HEX = r'^[0-9a-f]{32}$'
+    CURL_URL_PREFIXES = ('ftp://',)
+    # access denied, file not found and failed to retrieve
+    CURL_RC_NOT_FOUND = (9, 19, 78)
+    RE_PATTERN_CURL_CONTENT_LENGTH = r'(?im)^Content-Length:\s*(\d+)'
+
+    def __init__(self, http_user=None, http_password=None, use_netrc=False,
+                 num_threads=PARALLEL_NUM_THREADS, verbose=False):
+        self._http_user = http_user
+        self._http_password = http_password
+        self._use_netrc = use_netrc
+        self._num_threads = num_threads
+        self._verbose = verbose
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=CaperHTTP.POOL_SIZE,
+                              pool_maxsize=CaperHTTP.POOL_SIZE)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+        self._auth_hosts = set()
+        self._lock = threading.Lock()
+
+    def head(self, url):
+        """HEAD request (redirects followed)
+
+        Returns:
+            Response object. Status code is not checked.
+        """
+        return self.__request('HEAD', url, allow_redirects=True)
+
+    def exists(self, url):
+        """Check if URL exists. HTTP 401, 403, 404 and 416 mean
+        a file does not exist (or is not accessible).
+        """
+        return self.stat(url)[0]
+
+    def stat(self, url):
+        """Check if URL exists and get its size and MD5 hash from headers.
+        Size is taken from Content-Length. MD5 hash is taken from
+        x-goog-hash, Content-MD5 or ETag if it looks like an MD5 hash.
+
+        Returns:
+            Tuple of (exists, size, md5). size is None if not available
+            or contents are encoded (e.g. gzipped). md5 is a hexadecimal
+            MD5 hash or None if not available.
+        """
+        if url.startswith(CaperHTTP.CURL_URL_PREFIXES):
+            return self.__curl_stat(url)
+        r = self.head(url)
+        if r.status_code in CaperHTTP.HTTP_ERR_NOT_FOUND:
+            return False, None, None
+        CaperHTTP.__raise_for_status(r, url)
+        size = None
+        if 'Content-Length' in r.headers and \
+                'Content-Encoding' not in r.headers:
+            size = int(r.headers['Content-Length'])
+        return True, size, CaperHTTP.__get_md5(r)
+
+    def is_downloaded(self, url, path):
+        """Check if path is a complete download of URL with validators
+        stored on download. A conditional HEAD request is made and
+        HTTP 304 (Not Modified) means that URL has not been changed.
+        Validators are compared in case a server ignores conditions.
+
+        Returns:
+            True if URL has not been changed since path was downloaded,
+            False if changed, None if there are no validators to check
+            (e.g. path was not downloaded by CaperHTTP or partial).
+        """
+        validators = CaperHTTP.__read_complete_validators(url, path)
+        if validators is None:
+            return None
+        r = self.__request('HEAD', url, allow_redirects=True,
+                           headers=CaperHTTP.__get_conditional_headers(
+                                validators))
+        if r.status_code == 304:
+            return True
+        CaperHTTP.__raise_for_status(r, url)
+        return CaperHTTP.__match_validators(validators, r)
+
+    def get_contents(self, url):
+        """Get contents of URL
+
+        Returns:
+            Decoded string
+        """
+        if url.startswith(CaperHTTP.CURL_URL_PREFIXES):
+            return self.__curl(url).stdout.decode()
+        r = self.__request('GET', url)
+        CaperHTTP.__raise_for_status(r, url)
+        return r.content.decode()
+
+    def iter_lines(self, url):
+        """Stream lines of URL without reading the whole contents
+        into memory.
+
+        Yields:
+            Decoded line with a trailing newline
+        """
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        buf = ''
+        for chunk in self.iter_content(url):
+            lines = (buf + decoder.decode(chunk)).split('\n')
+            buf = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        buf += decoder.decode(b'', final=True)
+        if buf:
+            yield buf
+
+    def iter_content(self, url):
+        """Stream contents of URL chunk by chunk
+
+        Yields:
+            Bytes of CHUNK_SIZE at most
+        """
+        if url.startswith(CaperHTTP.CURL_URL_PREFIXES):
+            yield from self.__curl_iter_content(url)
+            return
+        r = self.__request('GET', url, stream=True)
+        CaperHTTP.__raise_for_status(r, url)
+        with r:
+            yield from r.iter_content(CaperHTTP.CHUNK_SIZE)
+
+    def download(self, url, path):
+        """Download URL to a local file. Resume downloading if
+        path already exists.
+
+        Returns:
+            False if path was already a complete copy of URL
+            (nothing downloaded), otherwise True.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if url.startswith(CaperHTTP.CURL_URL_PREFIXES):
+            self.__curl(url, '-R', '-o', path)
+            return True
+        if os.path.exists(path):
+            validators = CaperHTTP.__read_complete_validators(url, path)
+            if validators is not None:
+                return self.__download_revalidate(url, path, validators)
+            return self.__download_resume(url, path)
+
+        if self._num_threads > 1:
+            r = self.head(url)
+            if r.ok and r.headers.get('Accept-Ranges') == 'bytes' \
+                    and 'Content-Encoding' not in r.headers:
+                size = int(r.headers.get('Content-Length', 0))
+                if size >= CaperHTTP.PARALLEL_MIN_FILE_SIZE:
+                    self.__download_parallel(url, path, size, r)
+                    return True
+
+        r = self.__request('GET', url, stream=True)
+        CaperHTTP.__raise_for_status(r, url)
+        self.__write_response(r, url, path, 'wb')
+        return True
+
+    def __download_revalidate(self, url, path, validators):
+        """Download URL again only if it has been changed
+        since path was downloaded.
+        """
+        r = self.__request('GET', url, stream=True,
+                           headers=CaperHTTP.__get_conditional_headers(
+                                validators))
+        if r.status_code == 304:
+            r.close()
+            if self._verbose:
+                print('[CaperHTTP] not modified. '
+                      'skip downloading, path: {}'.format(path))
+            return False
+        CaperHTTP.__raise_for_status(r, url)
+        if CaperHTTP.__match_validators(validators, r):
+            # server ignored conditions
+            r.close()
+            return False
+        if self._verbose:
+            print('[CaperHTTP] modified. downloading again, '
+                  'path: {}'.format(path))
+        self.__write_response(r, url, path, 'wb')
+        return True
+
+    def __download_resume(self, url, path):
+        offset = os.path.getsize(path)
+        headers = {'Range': 'bytes={}-'.format(offset)}
+        validators = CaperHTTP.__read_validators(url, path)
+        if validators is not None:
+            # whole file (200) instead of a part (206) if changed.
+            # weak ETag is not allowed for If-Range
+            etag = validators.get('etag')
+            if etag and not etag.startswith('W/'):
+                headers['If-Range'] = etag
+            elif validators.get('last_modified'):
+                headers['If-Range'] = validators['last_modified']
+        r = self.__request('GET', url, stream=True, headers=headers)
+        if r.status_code == 416:
+            # range is not satisfiable, file can be already complete
+            r.close()
+            total = CaperHTTP.__get_total_size(r)
+            if total is None or total == offset:
+                if self._verbose:
+                    print('[CaperHTTP] file already exists. '
+                          'skip downloading, path: {}'.format(path))
+                return False
+            # partial file is larger than remote, start over
+            os.remove(path)
+            return self.download(url, path)
+
+        CaperHTTP.__raise_for_status(r, url)
+        if r.status_code == 206:
+            if self._verbose:
+                print('[CaperHTTP] resume downloading from byte {}, '
+                      'path: {}'.format(offset, path))
+            self.__write_response(r, url, path, 'ab')
+        else:
+            # server ignored a ranged request or file has been changed
+            self.__write_response(r, url, path, 'wb')
+        return True
+
+    def __download_parallel(self, url, path, size, r_head):
+        """Download parts of URL concurrently into a temporary file
+        and move it to path when all parts are done.
+        Partially downloaded temporary file is never resumed.
+        """
+        tmp_path = path + CaperHTTP.PARALLEL_TMP_EXT
+        if self._verbose:
+            print('[CaperHTTP] parallel downloading {} bytes with {} threads, '
+                  'path: {}'.format(size, self._num_threads, path))
+        with open(tmp_path, 'wb') as fp:
+            fp.truncate(size)
+
+        part_size = CaperHTTP.PARALLEL_PART_SIZE
+        ranges = [(start, min(start + part_size, size) - 1)
+                  for start in range(0, size, part_size)]
+
+        fd = os.open(tmp_path, os.O_WRONLY)
+        try:
+            def download_part(byte_range):
+                start, end = byte_range
+                r = self.__request(
+                    'GET', url, stream=True,
+                    headers={'Range': 'bytes={}-{}'.format(start, end)})
+                CaperHTTP.__raise_for_status(r, url)
+                if r.status_code != 206:
+                    raise Exception('HTTP ranged request failed, '
+                                    'HTTP_ERR: {}, URL: {}'.format(
+                                        r.status_code, url))
+                offset = start
+                for chunk in r.iter_content(CaperHTTP.CHUNK_SIZE):
+                    os.pwrite(fd, chunk, offset)
+                    offset += len(chunk)
+                if offset != end + 1:
+                    raise Exception('Incomplete part ({}-{}) for '
+                                    'URL: {}'.format(start, end, url))
+
+            with ThreadPoolExecutor(self._num_threads) as executor:
+                # list() to re-raise exceptions from workers
+                list(executor.map(download_part, ranges))
+        except:
+            os.close(fd)
+            os.remove(tmp_path)
+            raise
+        os.close(fd)
+        os.replace(tmp_path, path)
+        CaperHTTP.__set_mtime(r_head, path)
+        CaperHTTP.__write_validators(url, path, r_head, complete=True)
+
+    def __write_response(self, r, url, path, mode):
+        # validators for a partial file are used for If-Range on resume
+        CaperHTTP.__write_validators(url, path, r, complete=False)
+        with open(path, mode) as fp:
+            for chunk in r.iter_content(CaperHTTP.CHUNK_SIZE):
+                fp.write(chunk)
+        CaperHTTP.__set_mtime(r, path)
+        CaperHTTP.__write_validators(url, path, r, complete=True)
+
+    def __request(self, method, url, headers=None, **kwargs):
+        """Try without HTTP auth first if it fails with 401/403 then
+        try with auth.
+        """
+        kwargs.setdefault('timeout', CaperHTTP.TIMEOUT_SEC)
+        host = urlparse(url).netloc
+        auth = self.__get_auth(url)
+
+        if auth is not None and host in self._auth_hosts:
+            return self._session.request(method, url, headers=headers,
+                                         auth=auth, **kwargs)
+
+        # null auth to prevent requests from reading ~/.netrc
+        r = self._session.request(method, url, headers=headers,
+                                  auth=CaperHTTP.__no_auth, **kwargs)
+        if auth is None or r.status_code not in CaperHTTP.HTTP_ERR_AUTH:
+            return r
+        r.close()
+        if self._verbose:
+            print('[CaperHTTP] got HTTP_ERR {}. wait for {} seconds. '
+                  're-trying with auth...'.format(
+                    r.status_code, CaperHTTP.DELAY_SEC_HTTP_AUTH))
+        time.sleep(CaperHTTP.DELAY_SEC_HTTP_AUTH)
+
+        r = self._session.request(method, url, headers=headers,
+                                  auth=auth, **kwargs)
+        if r.status_code not in CaperHTTP.HTTP_ERR_AUTH:
+            with self._lock:
+                self._auth_hosts.add(host)
+        return r
+
+    def __get_curl_cmd(self, url, *args):
+        cmd = ['curl', '-sS', '-f', '-L'] + list(args)
+        if self._use_netrc:
+            cmd.append('-n')
+        elif self._http_user is not None:
+            cmd += ['-u', '{}:{}'.format(self._http_user,
+                                         self._http_password)]
+        return cmd + [url]
+
+    def __curl(self, url, *args):
+        """Raises:
+            CalledProcessError with STDERR if curl fails.
+        """
+        return run(self.__get_curl_cmd(url, *args),
+                   stdout=PIPE, stderr=PIPE, check=True)
+
+    def __curl_stat(self, url):
+        try:
+            stdout = self.__curl(url, '-I').stdout.decode()
+        except CalledProcessError as e:
+            if e.returncode in CaperHTTP.CURL_RC_NOT_FOUND:
+                return False, None, None
+            raise
+        m = re.search(CaperHTTP.RE_PATTERN_CURL_CONTENT_LENGTH, stdout)
+        return True, int(m.group(1)) if m else None, None
+
+    def __curl_iter_content(self, url):
+        cmd = self.__get_curl_cmd(url)
+        # STDERR on a file. a full pipe would block curl
+        with tempfile.TemporaryFile() as stderr:
+            p = Popen(cmd, stdout=PIPE, stderr=stderr)
+            completed = False
+            try:
+                yield from iter(
+                    lambda: p.stdout.read(CaperHTTP.CHUNK_SIZE), b'')
+                completed = True
+            finally:
+                if not completed:
+                    p.kill()
+                p.stdout.close()
+                rc = p.wait()
+            if rc:
+                stderr.seek(0)
+                raise CalledProcessError(rc, cmd, stderr=stderr.read())
+
+    def __get_auth(self, url):
+        if self._use_netrc:
+            return get_netrc_auth(url)
+        elif self._http_user is not None:
+            return (self._http_user, self._http_password)
+        return None
+
+    @staticmethod
+    def __no_auth(r):
+        return r
+
+    @staticmethod
+    def __get_total_size(r):
+        """Parse total size from "Content-Range: bytes */1234"
+        """
+        m = re.findall(CaperHTTP.RE_PATTERN_CONTENT_RANGE_TOTAL,
+                       r.headers.get('Content-Range', ''))
+        if len(m) > 0:
+            return int(m[0])
+        return None
+
+    @staticmethod
+    def __get_md5(r):
+        # e.g. x-goog-hash: crc32c=n03x6A==,md5=Ojk9c3dhfxgoKVVHYwFbHQ==
+        for h in r.headers.get('x-goog-hash', '').split(','):
+            k, _, v = h.strip().partition('=')
+            if k == 'md5':
+                return base64.b64decode(v).hex()
+        if 'Content-MD5' in r.headers:
+            return base64.b64decode(r.headers['Content-MD5']).hex()
+        etag = r.headers.get('ETag', '').strip('"').lower()
+        if re.match(CaperHTTP.RE_PATTERN_MD5_HEX, etag):
+            return etag
+        return None
+
+    @staticmethod
+    def __write_validators(url, path, r, complete):
+        """Write validators (ETag and Last-Modified) of a response
+        for a downloaded file on path + VALIDATORS_EXT.
+        size is None for a partial file.
+        """
+        validators_file = path + CaperHTTP.VALIDATORS_EXT
+        etag = r.headers.get('ETag')
+        last_modified = r.headers.get('Last-Modified')
+        if etag is None and last_modified is None:
+            if os.path.exists(validators_file):
+                os.remove(validators_file)
+            return
+        validators = {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'size': os.path.getsize(path) if complete else None}
+        tmp_file = '{}.{}.{}'.format(
+            validators_file, os.getpid(), threading.get_ident())
+        with open(tmp_file, 'w') as fp:
+            json.dump(validators, fp)
+        os.replace(tmp_file, validators_file)
+
+    @staticmethod
+    def __read_validators(url, path):
+        """
+        Returns:
+            Validators of path downloaded from URL or None if not found.
+        """
+        try:
+            with open(path + CaperHTTP.VALIDATORS_EXT) as fp:
+                validators = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if validators.get('url') != url:
+            return None
+        return validators
+
+    @staticmethod
+    def __read_complete_validators(url, path):
+        """
+        Returns:
+            Validators of path downloaded completely from URL.
+            None if not found or path is partial or modified.
+        """
+        validators = CaperHTTP.__read_validators(url, path)
+        if validators is None or validators.get('size') is None or \
+                not os.path.isfile(path) or \
+                os.path.getsize(path) != validators['size']:
+            return None
+        return validators
+
+    @staticmethod
+    def __get_conditional_headers(validators):
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        return headers
+
+    @staticmethod
+    def __match_validators(validators, r):
+        """Check if a response has the same validators.
+        ETag is compared first if available. Otherwise, Last-Modified
+        and Content-Length are compared.
+        """
+        etag = r.headers.get('ETag')
+        if validators.get('etag') and etag:
+            return etag == validators['etag']
+        last_modified = r.headers.get('Last-Modified')
+        if not validators.get('last_modified') or \
+                last_modified != validators['last_modified']:
+            return False
+        if 'Content-Length' in r.headers and \
+                'Content-Encoding' not in r.headers:
+            return int(r.headers['Content-Length']) == validators['size']
+        return True
+
+    @staticmethod
+    def __set_mtime(r, path):
+        """Use remote time for a local file (equivalent to "curl -R")
+        """
+        last_modified = r.headers.get('Last-Modified')
+        if last_modified is None:
+            return
+        try:
+            t = parsedate_to_datetime(last_modified).timestamp()
+        except (TypeError, ValueError):
+            return
+        os.utime(path, (t, t))
+
+    @staticmethod
+    def __get_retry_after(r):
+        """Parse "Retry-After: 120" or "Retry-After: <HTTP date>"
+
+        Returns:
+            Delay in seconds or None if not available
+        """
+        retry_after = r.headers.get('Retry-After')
+        if retry_after is None:
+            return None
+        if retry_after.strip().isdigit():
+            return int(retry_after)
+        try:
+            t = parsedate_to_datetime(retry_after).timestamp()
+        except (TypeError, ValueError):
+            return None
+        return max(t - time.time(), 0)
+
+    @staticmethod
+    def __raise_for_status(r, url):
+        if not r.ok:
+            r.close()
+            raise CaperHTTPError(r.status_code, url,
+                                 retry_after=CaperHTTP.__get_retry_after(r))
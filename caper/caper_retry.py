@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""CaperRetry: Retry policy for storage operations
+
+Author:
+    Jin Lee (leepc12@gmail.com) at ENCODE-DCC
+"""
+
+import re
+import time
+import errno
+import random
+import threading
+from concurrent.futures import CancelledError
+from subprocess import CalledProcessError
+import requests
+
+
+class CaperRetry(object):
+    """Retry a storage operation on transient errors with exponential
+    backoff and full jitter. Delay before n-th retry is a random number
+    in [0, min(max_delay_sec, base_delay_sec * 2^n)).
+
+    Errors are classified into retryable and fatal:
+        retryable:
+            HTTP 408/429/5xx (CaperHTTPError, requests, SDK clients),
+            throttling/internal error codes of SDK clients,
+            connection errors and timeouts,
+            failed CLI (gsutil, aws) subprocesses unless their output
+            (if captured) says that a file is not found or
+            access is denied.
+        fatal:
+            everything else (e.g. FileNotFoundError, PermissionError,
+            HTTP 4xx, cancellation).
+
+    A rate-limit response (HTTP 429, SlowDown, Throttling) pauses all
+    operations with the same key (e.g. storage type) until the delay
+    (or Retry-After) expires so that many concurrent transfers back off
+    together instead of hammering a storage.
+
+    Total number of retries is bounded by retry_budget for all
+    operations. Once it's exhausted, errors are not retried any more.
+    """
+
+    MAX_RETRIES = 5
+    BASE_DELAY_SEC = 1.0
+    MAX_DELAY_SEC = 60.0
+    RETRY_BUDGET = 100
+
+    HTTP_STATUS_RATE_LIMIT = (429,)
+    HTTP_STATUS_RETRYABLE = (408, 429, 500, 502, 503, 504)
+    ERROR_CODES_RATE_LIMIT = (
+        'SlowDown', 'Throttling', 'ThrottlingException', 'RequestThrottled',
+        'RequestLimitExceeded', 'TooManyRequests', 'TooManyRequestsException',
+        'rateLimitExceeded')
+    ERROR_CODES_RETRYABLE = ERROR_CODES_RATE_LIMIT + (
+        'InternalError', 'ServiceUnavailable', 'RequestTimeout',
+        'RequestTimeoutException')
+    ERRNO_RETRYABLE = (
+        errno.ECONNRESET, errno.ECONNREFUSED, errno.ECONNABORTED,
+        errno.ETIMEDOUT, errno.EPIPE, errno.EHOSTUNREACH, errno.ENETUNREACH,
+        errno.ENETDOWN, errno.EAGAIN)
+    REQUESTS_ERRORS_RETRYABLE = (
+        requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+        requests.exceptions.ChunkedEncodingError)
+    EXCEPTIONS_FATAL = (
+        CancelledError, FileNotFoundError, PermissionError,
+        NotImplementedError, ValueError, TypeError, KeyError, AssertionError)
+    RE_PATTERN_RATE_LIMIT = \
+        r'\b429\b|SlowDown|Throttl|TooManyRequests|rate ?limit'
+    RE_PATTERN_FATAL = \
+        r'\b40[134]\b|NotFound|No URLs matched|does not exist|' \
+        r'AccessDenied|Forbidden|NoSuchBucket|NoSuchKey|InvalidAccessKeyId'
+
+    def __init__(self, max_retries=MAX_RETRIES, base_delay_sec=BASE_DELAY_SEC,
+                 max_delay_sec=MAX_DELAY_SEC, retry_budget=RETRY_BUDGET,
+                 verbose=False):
+        """
+        Args:
+            max_retries:
+                Maximum number of retries for each operation.
+                0 to disable retry.
+            base_delay_sec, max_delay_sec:
+                Base and cap of exponential backoff.
+            retry_budget:
+                Maximum number of retries for all operations.
+                None for no limit.
+        """
+        self._max_retries = max_retries
+        self._base_delay_sec = base_delay_sec
+        self._max_delay_sec = max_delay_sec
+        self._retry_budget = retry_budget
+        self._verbose = verbose
+
+        self._num_retries = 0
+        self._budget_exhausted = False
+        # {key: time until which operations are paused by rate-limit}
+        self._paused_until = {}
+        self._lock = threading.Lock()
+
+    @property
+    def num_retries(self):
+        """Total number of retries so far
+        """
+        return self._num_retries
+
+    def run(self, func, key=None, event=None, sleep=time.sleep):
+        """Call func() and retry it on a retryable error.
+
+        Args:
+            key:
+                Operations with the same key (e.g. storage type) are
+                paused together by a rate-limit response.
+            event:
+                Telemetry event dict (see CaperTelemetry).
+                Its "retries" is incremented for each retry.
+            sleep:
+                Function to sleep for given seconds (e.g. cancellable).
+        Returns:
+            Return value of func()
+        """
+        attempt = 0
+        while True:
+            self.__wait_if_paused(key, sleep)
+            try:
+                return func()
+            except Exception as e:
+                retryable, rate_limited, retry_after = self.classify(e)
+                if not retryable or attempt >= self._max_retries \
+                        or not self.__consume_budget():
+                    raise
+                delay = random.uniform(0, min(
+                    self._max_delay_sec,
+                    self._base_delay_sec * 2 ** attempt))
+                if retry_after is not None:
+                    delay = max(delay, retry_after)
+                if rate_limited:
+                    self.__pause(key, delay)
+                attempt += 1
+                if event is not None:
+                    event['retries'] += 1
+                if self._verbose:
+                    print('[CaperRetry] {err}: {msg}. retry {n}/{max} '
+                          'in {delay:.1f} sec, key: {key}'.format(
+                            err=type(e).__name__, msg=e, n=attempt,
+                            max=self._max_retries, delay=delay, key=key))
+                sleep(delay)
+
+    def classify(self, e):
+        """Classify an exception.
+
+        Returns:
+            Tuple of (retryable, rate_limited, retry_after).
+            retry_after is delay in seconds requested by a server or None.
+        """
+        if isinstance(e, CaperRetry.EXCEPTIONS_FATAL):
+            return False, False, None
+        retry_after = getattr(e, 'retry_after', None)
+        status_code, error_code = CaperRetry.__get_codes(e)
+
+        if status_code in CaperRetry.HTTP_STATUS_RATE_LIMIT or \
+                error_code in CaperRetry.ERROR_CODES_RATE_LIMIT:
+            return True, True, retry_after
+        if status_code in CaperRetry.HTTP_STATUS_RETRYABLE or \
+                error_code in CaperRetry.ERROR_CODES_RETRYABLE:
+            return True, False, retry_after
+        if status_code is not None or error_code is not None:
+            return False, False, None
+
+        if isinstance(e, CalledProcessError):
+            output = CaperRetry.__get_output(e)
+            if re.search(CaperRetry.RE_PATTERN_RATE_LIMIT, output):
+                return True, True, None
+            if re.search(CaperRetry.RE_PATTERN_FATAL, output):
+                return False, False, None
+            return True, False, None
+
+        if isinstance(e, CaperRetry.REQUESTS_ERRORS_RETRYABLE):
+            return True, False, None
+        if isinstance(e, (ConnectionError, TimeoutError)) or \
+                isinstance(e, OSError) and \
+                e.errno in CaperRetry.ERRNO_RETRYABLE:
+            return True, False, None
+        return False, False, None
+
+    def __consume_budget(self):
+        with self._lock:
+            if self._retry_budget is not None and \
+                    self._num_retries >= self._retry_budget:
+                if not self._budget_exhausted:
+                    print('[CaperRetry] retry budget ({}) is exhausted. '
+                          'errors will not be retried.'.format(
+                            self._retry_budget))
+                    self._budget_exhausted = True
+                return False
+            self._num_retries += 1
+            return True
+
+    def __pause(self, key, delay):
+        with self._lock:
+            self._paused_until[key] = max(
+                self._paused_until.get(key, 0), time.time() + delay)
+
+    def __wait_if_paused(self, key, sleep):
+        while True:
+            with self._lock:
+                remaining = self._paused_until.get(key, 0) - time.time()
+            if remaining <= 0:
+                return
+            sleep(remaining)
+
+    @staticmethod
+    def __get_codes(e):
+        """Get HTTP status code and error code (e.g. SlowDown)
+        from an exception of CaperHTTP, requests or SDK clients.
+
+        Returns:
+            Tuple of (status_code, error_code). None if not found.
+        """
+        status_code = getattr(e, 'status_code', None)
+        error_code = None
+        response = getattr(e, 'response', None)
+        if isinstance(response, dict):
+            # botocore.exceptions.ClientError
+            status_code = response.get('ResponseMetadata', {}).get(
+                'HTTPStatusCode')
+            error_code = response.get('Error', {}).get('Code')
+        elif status_code is None and response is not None:
+            # requests.exceptions.HTTPError
+            status_code = getattr(response, 'status_code', None)
+        if status_code is None:
+            # google.api_core.exceptions.GoogleAPICallError
+            status_code = getattr(e, 'code', None)
+        if not isinstance(status_code, int):
+            status_code = None
+        return status_code, error_code
+
+    @staticmethod
+    def __get_output(e):
+        output = ''
+        for s in (e.output, e.stderr):
+            if isinstance(s, bytes):
+                s = s.decode(errors='replace')
+            if s:
+                output += s
+        return output
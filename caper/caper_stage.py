@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""CaperStage: Two-phase deepcopy with a transfer plan and a journal
+
+Author:
+    Jin Lee (leepc12@gmail.com) at ENCODE-DCC
+"""
+
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future, CancelledError
+from .caper_uri import CaperURI
+
+
+class CaperStage(object):
+    """Deepcopy in two phases so that an interrupted deepcopy can be
+    resumed without re-checking files that have already been copied.
+
+    Planning (create()):
+        Resolve all files to be deepcopied (see CaperURI.plan_deepcopy())
+        with their targets, sizes and actions (copy or skip) and write
+        them to a plan file (JSON).
+
+    Execution (execute()):
+        Copy files in a plan on a thread pool and append each completed
+        file to a journal file (plan file + JOURNAL_EXT, JSON lines).
+        Files in a journal are not copied again when execution is
+        resumed. Then deepcopy the root file with journaled files
+        memoized so that only nested files (e.g. .json, .tsv) are
+        rewritten. Files to be skipped are checked again at this step
+        since they can be changed after planning.
+    """
+
+    JOURNAL_EXT = '.journal'
+    ACTION_COPY = 'copy'
+    ACTION_SKIP = 'skip'
+    # bytes per second to estimate time if no other information
+    # (observed throughput in a journal or bandwidth limits)
+    DEFAULT_THROUGHPUT = 100 * 1024 * 1024
+
+    def __init__(self, plan_file):
+        """Load a plan from plan_file and its journal if exists.
+        """
+        self._plan_file = os.path.abspath(os.path.expanduser(plan_file))
+        with open(self._plan_file) as fp:
+            self._plan = json.load(fp, object_pairs_hook=OrderedDict)
+        self._journal_file = self._plan_file + CaperStage.JOURNAL_EXT
+        self._journal = OrderedDict()
+        if os.path.exists(self._journal_file):
+            with open(self._journal_file) as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # last line can be partially written
+                        continue
+                    self._journal[record['src']] = record
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def create(uri, plan_file, uri_type, uri_exts, no_copy_root=False):
+        """Plan a deepcopy of uri and write it to plan_file.
+        An existing plan and its journal are overwritten.
+
+        Returns:
+            CaperStage object
+        """
+        entries = CaperURI(uri).plan_deepcopy(
+            uri_type=uri_type, uri_exts=uri_exts)
+        plan = OrderedDict([
+            ('uri', CaperURI(uri).get_uri()),
+            ('uri_type', uri_type),
+            ('uri_exts', list(uri_exts)),
+            ('no_copy_root', no_copy_root),
+            ('created', time.time()),
+            ('entries', entries)])
+
+        plan_file = os.path.abspath(os.path.expanduser(plan_file))
+        os.makedirs(os.path.dirname(plan_file), exist_ok=True)
+        tmp_plan_file = '{}.{}'.format(plan_file, os.getpid())
+        with open(tmp_plan_file, 'w') as fp:
+            json.dump(plan, fp, indent=4)
+        os.replace(tmp_plan_file, plan_file)
+        journal_file = plan_file + CaperStage.JOURNAL_EXT
+        if os.path.exists(journal_file):
+            os.remove(journal_file)
+        return CaperStage(plan_file)
+
+    @property
+    def plan_file(self):
+        return self._plan_file
+
+    @property
+    def journal_file(self):
+        return self._journal_file
+
+    def get_entries(self):
+        return self._plan['entries']
+
+    def get_pending_entries(self):
+        """
+        Returns:
+            List of entries to be copied and not in a journal
+        """
+        return [e for e in self._plan['entries']
+                if e['action'] == CaperStage.ACTION_COPY
+                and e['src'] not in self._journal]
+
+    def get_summary(self):
+        """
+        Returns:
+            A dict with numbers of files (num_files, num_copy, num_skip,
+            num_done, num_pending), bytes (total_bytes to be copied,
+            done_bytes, pending_bytes), num_unknown_size (number of
+            pending files without size, e.g. URLs without Content-Length),
+            throughput (bytes per second used for an estimate) and
+            estimated_sec for pending files.
+        """
+        entries = self._plan['entries']
+        copy = [e for e in entries if e['action'] == CaperStage.ACTION_COPY]
+        pending = self.get_pending_entries()
+        total_bytes = sum(e['size'] or 0 for e in copy)
+        pending_bytes = sum(e['size'] or 0 for e in pending)
+        throughput = self.__estimate_throughput()
+        return OrderedDict([
+            ('num_files', len(entries)),
+            ('num_copy', len(copy)),
+            ('num_skip', len(entries) - len(copy)),
+            ('num_done', len(copy) - len(pending)),
+            ('num_pending', len(pending)),
+            ('total_bytes', total_bytes),
+            ('done_bytes', total_bytes - pending_bytes),
+            ('pending_bytes', pending_bytes),
+            ('num_unknown_size', sum(e['size'] is None for e in pending)),
+            ('throughput', throughput),
+            ('estimated_sec', pending_bytes / throughput)])
+
+    def execute(self, parallel=True):
+        """Copy pending files in a plan and journal them.
+        Then deepcopy the root file to rewrite nested files.
+        Files failed to copy are not journaled and an exception is
+        raised after all other files are done.
+
+        Returns:
+            Tuple of (new_uri, updated) same as CaperURI.deepcopy()
+        """
+        uri_type = self._plan['uri_type']
+        memo = {}
+        for e in self._plan['entries']:
+            if e['src'] in self._journal:
+                CaperStage.__memoize(memo, e, uri_type)
+
+        cancel_event = getattr(CaperURI.THREAD_LOCAL, 'cancel_event', None)
+
+        def copy(e):
+            with CaperURI.cancel_scope(cancel_event):
+                start = time.time()
+                CaperURI(e['src']).copy(target_uri=e['target'])
+                self.__write_journal(OrderedDict([
+                    ('src', e['src']),
+                    ('target', e['target']),
+                    ('bytes', e['size']),
+                    ('start', start),
+                    ('end', time.time())]))
+                CaperStage.__memoize(memo, e, uri_type)
+
+        pending = self.get_pending_entries()
+        num_threads = CaperURI.DEEPCOPY_NUM_THREADS if parallel else 1
+        errors = []
+        with ThreadPoolExecutor(num_threads) as executor:
+            futures = [executor.submit(copy, e) for e in pending]
+            for e, future in zip(pending, futures):
+                try:
+                    future.result()
+                except CancelledError:
+                    # other workers stop at their next checkpoints
+                    raise
+                except Exception as ex:
+                    print('[CaperStage] failed to copy {}. {}'.format(
+                        e['src'], ex))
+                    errors.append(ex)
+        if errors:
+            raise Exception('Failed to copy {} files. Resume to retry '
+                            'them. plan: {}'.format(
+                                len(errors), self._plan_file)) from errors[0]
+
+        return CaperURI(self._plan['uri']).deepcopy(
+            uri_type=uri_type, uri_exts=tuple(self._plan['uri_exts']),
+            no_copy_root=self._plan['no_copy_root'], parallel=parallel,
+            memo=memo)
+
+    def __write_journal(self, record):
+        with self._lock:
+            with open(self._journal_file, 'a') as fp:
+                fp.write(json.dumps(record) + '\n')
+                fp.flush()
+                os.fsync(fp.fileno())
+            self._journal[record['src']] = record
+
+    def __estimate_throughput(self):
+        """Observed throughput of journaled files if available.
+        Otherwise, bandwidth limit of a target storage type
+        or DEFAULT_THROUGHPUT.
+
+        Elapsed time is the union of transfer intervals so that
+        concurrent transfers are counted once and idle time between
+        sessions (e.g. a resumed plan) is not counted.
+        """
+        records = [r for r in self._journal.values() if r.get('bytes')]
+        if records:
+            elapsed, end = 0.0, None
+            for r in sorted(records, key=lambda r: r['start']):
+                if end is None or r['start'] > end:
+                    elapsed += r['end'] - r['start']
+                    end = r['end']
+                elif r['end'] > end:
+                    elapsed += r['end'] - end
+                    end = r['end']
+            if elapsed > 0:
+                return sum(r['bytes'] for r in records) / elapsed
+        limit = CaperURI.MAX_TRANSFER_BANDWIDTH.get(self._plan['uri_type'])
+        if limit:
+            return limit
+        return CaperStage.DEFAULT_THROUGHPUT
+
+    @staticmethod
+    def __memoize(memo, entry, uri_type):
+        """Memoize a copied file for CaperURI.deepcopy()
+        """
+        future = Future()
+        future.set_result((entry['target'], True))
+        memo[(entry['src'], uri_type)] = future
@@ -0,0 +1,1166 @@
+#!/usr/bin/env python3
+"""CaperStorage: Storage drivers for cloud URIs (gs://, s3://)
+
+Author:
+    Jin Lee (leepc12@gmail.com) at ENCODE-DCC
+"""
+
+import io
+import os
+import re
+import sys
+import signal
+import json
+import base64
+import codecs
+import shutil
+import hashlib
+import threading
+import time
+import uuid
+import tempfile
+import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen, run, check_output, \
+    PIPE, CalledProcessError
+
+
+STORAGE_DRIVER_CLI = 'cli'
+STORAGE_DRIVER_SDK = 'sdk'
+STORAGE_DRIVER_EMULATED = 'emulated'
+STORAGE_DRIVERS = (STORAGE_DRIVER_CLI, STORAGE_DRIVER_SDK,
+                   STORAGE_DRIVER_EMULATED)
+
+RE_PATTERN_MD5_HEX = r'^[0-9a-f]{32}$'
+AWS_PRESIGN_NUM_THREADS = 8
+# parts of a multipart upload are stored on a hidden sub-directory
+# of a target (e.g. gs://bucket/a/.caper_parts/b.bam.UPLOAD_ID.00001)
+MULTIPART_PARTS_DIRNAME = '.caper_parts'
+
+
+def create_storage_drivers(storage_driver=STORAGE_DRIVER_CLI,
+                           use_gsutil_over_aws_s3=False,
+                           emulated_storage_dir=None):
+    """Create drivers for gs:// and s3://
+
+    Args:
+        storage_driver:
+            cli: gsutil and aws CLIs (default if None).
+            sdk: in-process clients (google-cloud-storage and boto3).
+            emulated: local directory emulated_storage_dir.
+    Returns:
+        A dict of {scheme: driver}
+    """
+    if storage_driver is None or storage_driver == STORAGE_DRIVER_CLI:
+        gsutil = GsutilDriver()
+        if use_gsutil_over_aws_s3:
+            return {'gs': gsutil, 's3': gsutil}
+        return {'gs': gsutil, 's3': AwsS3Driver()}
+
+    elif storage_driver == STORAGE_DRIVER_SDK:
+        return {'gs': GCSClientDriver(), 's3': S3ClientDriver()}
+
+    elif storage_driver == STORAGE_DRIVER_EMULATED:
+        if emulated_storage_dir is None:
+            raise ValueError('emulated_storage_dir must be defined for '
+                             'storage driver "emulated".')
+        emulated = EmulatedStorageDriver(emulated_storage_dir)
+        return {'gs': emulated, 's3': emulated}
+
+    raise ValueError('Unsupported storage driver: {}. '
+                     'Supported: {}'.format(storage_driver, STORAGE_DRIVERS))
+
+
+def split_uri(uri):
+    """
+    Returns:
+        Tuple of (scheme, bucket, key). e.g. ('gs', 'bucket', 'a/b.txt')
+    """
+    scheme, path = uri.split('://', 1)
+    bucket, _, key = path.partition('/')
+    return scheme, bucket, key
+
+
+def etag_to_md5(etag):
+    """ETag of a non-multipart object on S3 is its MD5 hash
+    """
+    if etag is not None:
+        etag = etag.strip('"').lower()
+        if re.match(RE_PATTERN_MD5_HEX, etag):
+            return etag
+    return None
+
+
+class StorageDriver(object):
+    """Interface for a storage driver. All URIs are full URIs with
+    a scheme (e.g. gs://bucket/a.txt).
+
+    A driver must implement stat, read_range, write, list and delete.
+    Other methods have default implementations built on them.
+    """
+    SCHEMES = ()
+    CHUNK_SIZE = 1024 * 1024
+    # driver implements create_multipart, upload_part, complete_multipart
+    # and abort_multipart for upload_parallel()
+    MULTIPART = False
+    MULTIPART_MIN_PART_SIZE = 0
+    MULTIPART_MAX_NUM_PARTS = 10000
+
+    def stat(self, uri):
+        """
+        Returns:
+            Tuple of (exists, size, md5). md5 is a hexadecimal MD5 hash
+            or None if not available.
+        """
+        raise NotImplementedError
+
+    def read(self, uri):
+        return self.read_range(uri, 0, None)
+
+    def read_range(self, uri, start, end):
+        """Read bytes [start, end] of a file. end is inclusive.
+        Read until the end of file if end is None.
+        """
+        raise NotImplementedError
+
+    def iter_content(self, uri, chunk_size=CHUNK_SIZE):
+        """Stream contents chunk by chunk with ranged reads
+        """
+        start = 0
+        while True:
+            chunk = self.read_range(uri, start, start + chunk_size - 1)
+            if chunk:
+                yield chunk
+            if len(chunk) < chunk_size:
+                break
+            start += len(chunk)
+
+    def iter_lines(self, uri):
+        """
+        Yields:
+            Decoded line with a trailing newline
+        """
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        buf = ''
+        for chunk in self.iter_content(uri):
+            lines = (buf + decoder.decode(chunk)).split('\n')
+            buf = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        buf += decoder.decode(b'', final=True)
+        if buf:
+            yield buf
+
+    def write(self, uri, data):
+        """Write bytes to a file
+        """
+        raise NotImplementedError
+
+    def write_stream(self, uri, chunks):
+        """Write chunks (iterable of bytes) to a file. A file must not be
+        created if iteration fails.
+        """
+        self.write(uri, b''.join(chunks))
+
+    def upload(self, path, uri):
+        with open(path, 'rb') as fp:
+            self.write_stream(
+                uri, iter(lambda: fp.read(self.CHUNK_SIZE), b''))
+
+    def upload_parallel(self, path, uri, part_size, num_threads=1,
+                        state_file=None):
+        """Upload a large local file in parts of part_size concurrently
+        on num_threads workers and combine them into a single object.
+        A file not larger than part_size is uploaded with upload().
+        So is any file if a driver does not support multipart upload
+        (MULTIPART is False).
+
+        Completed parts are recorded on state_file (JSON) so that
+        an interrupted upload of the same file (same size and mtime)
+        is resumed without uploading them again. state_file is removed
+        when an upload is complete.
+
+        Each part is verified with its MD5 hash by a driver. A combined
+        object is verified by complete_multipart() and its size.
+
+        Returns:
+            Number of parts (1 if not split)
+        """
+        size = os.path.getsize(path)
+        if not self.MULTIPART or not part_size or size <= part_size:
+            self.upload(path, uri)
+            return 1
+        part_size = max(part_size, self.MULTIPART_MIN_PART_SIZE,
+                        -(-size // self.MULTIPART_MAX_NUM_PARTS))
+        num_parts = -(-size // part_size)
+
+        state = OrderedDict([
+            ('path', os.path.abspath(path)),
+            ('uri', uri),
+            ('size', size),
+            ('mtime', os.path.getmtime(path)),
+            ('part_size', part_size),
+            ('upload_id', None),
+            ('parts', {})])
+        if state_file is not None and os.path.exists(state_file):
+            with open(state_file) as fp:
+                old_state = json.load(fp, object_pairs_hook=OrderedDict)
+            if all(old_state.get(k) == state[k] for k in
+                    ('path', 'uri', 'size', 'mtime', 'part_size')):
+                state = old_state
+            elif old_state.get('upload_id'):
+                # source has been changed
+                self.abort_multipart(old_state['uri'], old_state['upload_id'])
+        if state['upload_id'] is None:
+            state['upload_id'] = self.create_multipart(uri)
+            StorageDriver.__write_multipart_state(state_file, state)
+        lock = threading.Lock()
+
+        def upload_part(part_number):
+            with open(path, 'rb') as fp:
+                fp.seek((part_number - 1) * part_size)
+                data = fp.read(part_size)
+            md5 = hashlib.md5(data).hexdigest()
+            part = self.upload_part(
+                uri, state['upload_id'], part_number, data, md5)
+            part['md5'] = md5
+            part['size'] = len(data)
+            with lock:
+                state['parts'][str(part_number)] = part
+                StorageDriver.__write_multipart_state(state_file, state)
+
+        pending = [n for n in range(1, num_parts + 1)
+                   if str(n) not in state['parts']]
+        with ThreadPoolExecutor(max(num_threads, 1)) as executor:
+            # list() to re-raise exceptions from workers
+            list(executor.map(upload_part, pending))
+
+        parts = [state['parts'][str(n)] for n in range(1, num_parts + 1)]
+        try:
+            self.complete_multipart(uri, state['upload_id'], parts)
+            exists, target_size, _ = self.stat(uri)
+            if not exists or target_size != size:
+                raise IOError(
+                    'Size of a multipart upload does not match. '
+                    'expected: {}, uploaded: {}, uri: {}'.format(
+                        size, target_size, uri))
+        except IOError:
+            # start over next time
+            self.abort_multipart(uri, state['upload_id'])
+            if state_file is not None and os.path.exists(state_file):
+                os.remove(state_file)
+            raise
+        if state_file is not None and os.path.exists(state_file):
+            os.remove(state_file)
+        return num_parts
+
+    def create_multipart(self, uri):
+        """
+        Returns:
+            Upload ID of a new multipart upload
+        """
+        raise NotImplementedError
+
+    def upload_part(self, uri, upload_id, part_number, data, md5):
+        """Upload a part (part_number starts from 1) and verify it with
+        its hexadecimal MD5 hash.
+
+        Returns:
+            A JSON-serializable dict of information about a part
+            needed for complete_multipart()
+        """
+        raise NotImplementedError
+
+    def complete_multipart(self, uri, upload_id, parts):
+        """Combine parts (ordered by part number) into uri.
+        Each part has md5 and size in addition to what upload_part()
+        returned. Raise IOError if a combined object is not valid.
+        """
+        raise NotImplementedError
+
+    def abort_multipart(self, uri, upload_id):
+        """Remove all uploaded parts
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def __write_multipart_state(state_file, state):
+        if state_file is None:
+            return
+        os.makedirs(os.path.dirname(state_file), exist_ok=True)
+        tmp_file = '{}.{}.{}'.format(
+            state_file, os.getpid(), threading.get_ident())
+        with open(tmp_file, 'w') as fp:
+            json.dump(state, fp)
+        os.replace(tmp_file, state_file)
+
+    def download(self, uri, path):
+        tmp_path = '{}.{}.{}'.format(path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_path, 'wb') as fp:
+                for chunk in self.iter_content(uri):
+                    fp.write(chunk)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def can_copy_from(self, driver):
+        """Check if this driver can copy a file from another
+        driver's storage directly.
+        """
+        return driver is self
+
+    def copy(self, src_uri, target_uri):
+        self.write_stream(target_uri, self.iter_content(src_uri))
+
+    def transfer(self, src, target):
+        """Copy a file. src and target can be a local path or a URI
+        but one of them must be on this driver's storage.
+        """
+        if '://' not in src:
+            self.upload(src, target)
+        elif '://' not in target:
+            self.download(src, target)
+        else:
+            self.copy(src, target)
+
+    def transfer_many(self, transfers, num_threads=1):
+        """Run many transfers as a batch. By default, transfers are
+        distributed over a pool of num_threads workers.
+
+        Args:
+            transfers:
+                List of (src, target) tuples. See transfer().
+        Returns:
+            A dict of {(src, target): exception or None}.
+            Results can be inaccurate if a CLI does not report them
+            per file. Caller must verify targets.
+        """
+        def transfer(t):
+            try:
+                self.transfer(*t)
+            except Exception as e:
+                return e
+            return None
+
+        with ThreadPoolExecutor(max(num_threads, 1)) as executor:
+            return dict(zip(transfers, executor.map(transfer, transfers)))
+
+    def list(self, prefix, recursive=False):
+        """List objects whose URIs start with prefix.
+        If not recursive, objects under a sub-directory are excluded.
+
+        Returns:
+            A dict of {uri: (size, md5)}
+        """
+        raise NotImplementedError
+
+    def delete(self, uri):
+        raise NotImplementedError
+
+    def presign_many(self, uris, duration_sec, private_key_file=None):
+        """Make presigned URLs valid for duration_sec at once
+
+        Args:
+            private_key_file:
+                Private key file of a service account (gs:// only).
+        Returns:
+            A dict of {uri: url}
+        """
+        raise NotImplementedError
+
+
+class GsutilDriver(StorageDriver):
+    """gsutil CLI. It can also take s3:// URIs.
+    """
+    SCHEMES = ('gs', 's3')
+
+    def stat(self, uri):
+        try:
+            s = check_output(['gsutil', '-q', 'ls', '-l', uri],
+                             stderr=PIPE).decode()
+            # example ['1000982', '2019-05-21T21:06:47Z', ...]
+            return True, int(s.strip('\n').split()[0]), None
+        except (CalledProcessError, ValueError):
+            # ValueError: not a file (e.g. directory on a bucket)
+            return False, None, None
+
+    def read(self, uri):
+        return check_output(['gsutil', '-q', 'cat', uri], stderr=PIPE)
+
+    def read_range(self, uri, start, end):
+        r = '{}-{}'.format(start, '' if end is None else end)
+        return check_output(['gsutil', '-q', 'cat', '-r', r, uri],
+                            stderr=PIPE)
+
+    def iter_content(self, uri, chunk_size=StorageDriver.CHUNK_SIZE):
+        yield from _iter_stdout(['gsutil', '-q', 'cat', uri], chunk_size)
+
+    def write(self, uri, data):
+        _write_stdin(['gsutil', '-q', 'cp', '-', uri], [data])
+
+    def write_stream(self, uri, chunks):
+        _write_stdin(['gsutil', '-q', 'cp', '-', uri], chunks)
+
+    def upload(self, path, uri):
+        _check_call(['gsutil', '-q', 'cp', path, uri])
+
+    def upload_parallel(self, path, uri, part_size, num_threads=1,
+                        state_file=None):
+        """gsutil's parallel composite upload for gs://. gsutil uploads
+        components concurrently, verifies them with MD5 hashes, tracks
+        them for resuming and composes them. state_file is not used.
+        Note that a composite object does not have an MD5 hash.
+        """
+        size = os.path.getsize(path)
+        if not uri.startswith('gs://') or not part_size or size <= part_size:
+            self.upload(path, uri)
+            return 1
+        _check_call([
+            'gsutil', '-q',
+            '-o', 'GSUtil:parallel_composite_upload_threshold={}'.format(
+                part_size),
+            '-o', 'GSUtil:parallel_composite_upload_component_size={}'.format(
+                part_size),
+            '-o', 'GSUtil:parallel_thread_count={}'.format(num_threads),
+            '-o', 'GSUtil:parallel_process_count=1',
+            'cp', path, uri])
+        return -(-size // part_size)
+
+    def download(self, uri, path):
+        _check_call(['gsutil', '-q', 'cp', uri, path])
+
+    def can_copy_from(self, driver):
+        return isinstance(driver, (GsutilDriver, AwsS3Driver))
+
+    def copy(self, src_uri, target_uri):
+        _check_call(['gsutil', '-q', 'cp', src_uri, target_uri])
+
+    def transfer_many(self, transfers, num_threads=1):
+        """Transfers to the same target directory with the same basename
+        are done with a single "gsutil -m cp -I" fed with a list of
+        sources on STDIN. gsutil does not report which files failed.
+        gsutil runs num_threads threads in a single process.
+        """
+        results = {}
+        batches = OrderedDict()
+        for src, target in transfers:
+            target_dir, basename = os.path.split(target)
+            if os.path.basename(src) == basename:
+                batches.setdefault(target_dir, []).append((src, target))
+            else:
+                results[(src, target)] = None
+        results = StorageDriver.transfer_many(
+            self, list(results), num_threads=num_threads)
+
+        for target_dir, batch in batches.items():
+            if '://' not in target_dir:
+                os.makedirs(target_dir, exist_ok=True)
+            p = Popen(['gsutil', '-q',
+                       '-o', 'GSUtil:parallel_thread_count={}'.format(
+                           max(num_threads, 1)),
+                       '-o', 'GSUtil:parallel_process_count=1',
+                       '-m', 'cp', '-I', target_dir + '/'],
+                      stdin=PIPE, stderr=PIPE)
+            _, stderr = p.communicate(
+                input='\n'.join(src for src, _ in batch).encode())
+            e = None if p.returncode == 0 else CalledProcessError(
+                p.returncode, p.args, stderr=stderr)
+            for t in batch:
+                results[t] = e
+        return results
+
+    def list(self, prefix, recursive=False):
+        objects = {}
+        pattern = prefix + ('**' if recursive else '*')
+        try:
+            s = check_output(['gsutil', '-q', 'ls', '-L', pattern],
+                             stderr=PIPE).decode()
+        except CalledProcessError:
+            # no object matched
+            return objects
+        # example:
+        # gs://bucket/a/b.txt:
+        #     Content-Length:         1000982
+        #     Hash (md5):             ylnRKcjHd2Gq/nM8i8rw9A==
+        #     ETag:                   CJCdyazLn+ICEAE=
+        uri, meta = None, {}
+        for line in s.split('\n') + ['']:
+            if line and line[0].isspace():
+                key, _, val = line.strip().partition(':')
+                meta[key] = val.strip()
+                continue
+            if uri is not None and 'Content-Length' in meta:
+                if 'Hash (md5)' in meta:
+                    checksum = base64.b64decode(meta['Hash (md5)']).hex()
+                elif uri.startswith('s3://'):
+                    checksum = etag_to_md5(meta.get('ETag'))
+                else:
+                    checksum = None
+                objects[uri] = (int(meta['Content-Length']), checksum)
+            uri, meta = None, {}
+            if line.startswith(('gs://', 's3://')) and \
+                    line.rstrip().endswith(':'):
+                uri = line.rstrip()[:-1]
+        return objects
+
+    def delete(self, uri):
+        _check_call(['gsutil', '-q', 'rm', uri])
+
+    def presign_many(self, uris, duration_sec, private_key_file=None):
+        """All gs:// URIs are signed with a single "gsutil signurl".
+        gsutil cannot sign s3:// URIs so that "aws s3 presign" is used
+        for them.
+        """
+        gcs_uris = [uri for uri in uris if uri.startswith('gs://')]
+        result = _aws_presign_many(
+            [uri for uri in uris if not uri.startswith('gs://')],
+            duration_sec)
+        if gcs_uris:
+            s = check_output(
+                ['gsutil', '-q', 'signurl', '-d', '{}s'.format(duration_sec),
+                 private_key_file] + gcs_uris, stderr=PIPE).decode()
+            # example: URL     HTTP Method     Expiration      Signed URL
+            # a line for each URI after a header line
+            for line in s.strip('\n').split('\n')[1:]:
+                arr = line.split('\t')
+                result[arr[0]] = arr[3]
+        return result
+
+
+class AwsS3Driver(StorageDriver):
+    """aws CLI. Copy from/to gs:// is done with gsutil.
+    """
+    SCHEMES = ('s3',)
+
+    def stat(self, uri):
+        try:
+            s = check_output(['aws', 's3', 'ls', uri], stderr=PIPE).decode()
+        except CalledProcessError:
+            return False, None, None
+        for line in s.strip('\n').split('\n'):
+            # example ['2019-05-21', '14:06:47', '1000982', 'x.txt']
+            arr = line.split()
+            if arr and arr[-1] == os.path.basename(uri):
+                return True, int(arr[2]), None
+        return False, None, None
+
+    def read(self, uri):
+        return check_output(['aws', 's3', 'cp', '--only-show-errors',
+                             uri, '-'], stderr=PIPE)
+
+    def read_range(self, uri, start, end):
+        _, bucket, key = split_uri(uri)
+        r = 'bytes={}-{}'.format(start, '' if end is None else end)
+        return check_output(['aws', 's3api', 'get-object',
+                             '--bucket', bucket, '--key', key,
+                             '--range', r, '/dev/stdout'], stderr=PIPE)
+
+    def iter_content(self, uri, chunk_size=StorageDriver.CHUNK_SIZE):
+        yield from _iter_stdout(
+            ['aws', 's3', 'cp', '--only-show-errors', uri, '-'], chunk_size)
+
+    def write(self, uri, data):
+        _write_stdin(['aws', 's3', 'cp', '--only-show-errors', '-', uri],
+                     [data])
+
+    def write_stream(self, uri, chunks):
+        _write_stdin(['aws', 's3', 'cp', '--only-show-errors', '-', uri],
+                     chunks)
+
+    def upload(self, path, uri):
+        _check_call(['aws', 's3', 'cp', '--only-show-errors', path, uri])
+
+    def download(self, uri, path):
+        _check_call(['aws', 's3', 'cp', '--only-show-errors', uri, path])
+
+    def can_copy_from(self, driver):
+        return isinstance(driver, (GsutilDriver, AwsS3Driver))
+
+    def copy(self, src_uri, target_uri):
+        if src_uri.startswith('gs://'):
+            _check_call(['gsutil', '-q', 'cp', src_uri, target_uri])
+        else:
+            _check_call(['aws', 's3', 'cp', '--only-show-errors',
+                        src_uri, target_uri])
+
+    def list(self, prefix, recursive=False):
+        objects = {}
+        _, bucket, key_prefix = split_uri(prefix)
+        cmd = ['aws', 's3api', 'list-objects-v2',
+               '--bucket', bucket, '--prefix', key_prefix,
+               '--output', 'json']
+        if not recursive:
+            cmd += ['--delimiter', '/']
+        try:
+            s = check_output(cmd, stderr=PIPE).decode()
+        except CalledProcessError:
+            return objects
+        # empty output if there is no object
+        for obj in json.loads(s).get('Contents', []) if s.strip() else []:
+            uri = 's3://{}/{}'.format(bucket, obj['Key'])
+            objects[uri] = (int(obj['Size']), etag_to_md5(obj.get('ETag')))
+        return objects
+
+    def delete(self, uri):
+        _check_call(['aws', 's3', 'rm', '--only-show-errors', uri])
+
+    def presign_many(self, uris, duration_sec, private_key_file=None):
+        return _aws_presign_many(uris, duration_sec)
+
+
+class GCSClientDriver(StorageDriver):
+    """In-process client for gs:// (google-cloud-storage).
+    An authenticated client is created once and shared by all threads.
+    """
+    SCHEMES = ('gs',)
+    MULTIPART = True
+    MAX_COMPOSE_SOURCES = 32
+
+    def __init__(self):
+        try:
+            from google.cloud import storage
+            from google.api_core.exceptions import NotFound
+        except ImportError:
+            raise ImportError(
+                'Storage driver "sdk" requires google-cloud-storage. '
+                'pip install google-cloud-storage')
+        self._client = storage.Client()
+        self._not_found = NotFound
+
+    def stat(self, uri):
+        blob = self.__get_blob(uri, reload=True)
+        if blob is None:
+            return False, None, None
+        return True, blob.size, GCSClientDriver.__get_md5(blob)
+
+    def read_range(self, uri, start, end):
+        try:
+            return self.__get_blob(uri).download_as_bytes(
+                start=start, end=end)
+        except self._not_found:
+            raise FileNotFoundError('File does not exist: {}'.format(uri))
+
+    def write(self, uri, data):
+        self.__get_blob(uri).upload_from_string(data)
+
+    def write_stream(self, uri, chunks):
+        fp = self.__get_blob(uri).open('wb')
+        try:
+            for chunk in chunks:
+                fp.write(chunk)
+        except BaseException:
+            # BlobWriter.close() finalizes an upload with buffered data.
+            # it's also called when a writer is garbage-collected.
+            # discard the buffer instead so that the writer is closed
+            # without finalizing and the resumable upload is abandoned
+            fp._buffer.close()
+            raise
+        fp.close()
+
+    def upload(self, path, uri):
+        self.__get_blob(uri).upload_from_filename(path)
+
+    def create_multipart(self, uri):
+        return uuid.uuid4().hex
+
+    def upload_part(self, uri, upload_id, part_number, data, md5):
+        part_uri = _get_part_uri(uri, upload_id, part_number)
+        blob = self.__get_blob(part_uri)
+        md5_hash = base64.b64encode(bytes.fromhex(md5)).decode()
+        # server rejects a part if it does not match md5_hash
+        blob.md5_hash = md5_hash
+        blob.upload_from_string(data)
+        # blob is updated with a response
+        if blob.md5_hash != md5_hash:
+            raise IOError('MD5 hash of a part does not match. '
+                          'uri: {}'.format(part_uri))
+        return {'uri': part_uri}
+
+    def complete_multipart(self, uri, upload_id, parts):
+        """Compose parts into uri. A compose request takes up to
+        MAX_COMPOSE_SOURCES objects so that many parts are composed
+        into intermediate objects first.
+        """
+        sources = [self.__get_blob(p['uri']) for p in parts]
+        level = 0
+        while len(sources) > GCSClientDriver.MAX_COMPOSE_SOURCES:
+            composed = []
+            for i in range(0, len(sources),
+                           GCSClientDriver.MAX_COMPOSE_SOURCES):
+                group = sources[i:i + GCSClientDriver.MAX_COMPOSE_SOURCES]
+                blob = self.__get_blob('{}.c{}.{:05d}'.format(
+                    parts[0]['uri'], level, i))
+                blob.compose(group)
+                composed.append(blob)
+            sources = composed
+            level += 1
+        target = self.__get_blob(uri)
+        target.compose(sources)
+        target.reload()
+        if target.size != sum(p['size'] for p in parts):
+            raise IOError('Size of a composed object does not match. '
+                          'uri: {}'.format(uri))
+        self.abort_multipart(uri, upload_id)
+
+    def abort_multipart(self, uri, upload_id):
+        for part_uri in self.list(_get_part_uri(uri, upload_id)):
+            try:
+                self.delete(part_uri)
+            except FileNotFoundError:
+                pass
+
+    def download(self, uri, path):
+        self.__get_blob(uri).download_to_filename(path)
+
+    def copy(self, src_uri, target_uri):
+        src = self.__get_blob(src_uri)
+        target = self.__get_blob(target_uri)
+        # rewrite in multiple calls for large objects
+        token, _, _ = target.rewrite(src)
+        while token is not None:
+            token, _, _ = target.rewrite(src, token=token)
+
+    def list(self, prefix, recursive=False):
+        _, bucket, key_prefix = split_uri(prefix)
+        blobs = self._client.list_blobs(
+            bucket, prefix=key_prefix,
+            delimiter=None if recursive else '/')
+        return {
+            'gs://{}/{}'.format(bucket, blob.name): (
+                blob.size, GCSClientDriver.__get_md5(blob))
+            for blob in blobs}
+
+    def delete(self, uri):
+        try:
+            self.__get_blob(uri).delete()
+        except self._not_found:
+            raise FileNotFoundError('File does not exist: {}'.format(uri))
+
+    def presign_many(self, uris, duration_sec, private_key_file=None):
+        """URLs are signed in-process with a service account's key
+        (JSON only) loaded once for all URIs.
+        """
+        from google.oauth2 import service_account
+        credentials = service_account.Credentials.from_service_account_file(
+            private_key_file)
+        return {
+            uri: self.__get_blob(uri).generate_signed_url(
+                expiration=datetime.timedelta(seconds=duration_sec),
+                credentials=credentials, version='v4')
+            for uri in uris}
+
+    def __get_blob(self, uri, reload=False):
+        _, bucket, key = split_uri(uri)
+        if reload:
+            return self._client.bucket(bucket).get_blob(key)
+        return self._client.bucket(bucket).blob(key)
+
+    @staticmethod
+    def __get_md5(blob):
+        if blob.md5_hash is None:
+            # composite object
+            return None
+        return base64.b64decode(blob.md5_hash).hex()
+
+
+class S3ClientDriver(StorageDriver):
+    """In-process client for s3:// (boto3).
+    An authenticated client is created once and shared by all threads.
+    """
+    SCHEMES = ('s3',)
+    MULTIPART = True
+    MULTIPART_MIN_PART_SIZE = 5 * 1024 * 1024
+
+    def __init__(self):
+        try:
+            import boto3
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise ImportError(
+                'Storage driver "sdk" requires boto3. pip install boto3')
+        self._client = boto3.client('s3')
+        self._client_error = ClientError
+
+    def stat(self, uri):
+        _, bucket, key = split_uri(uri)
+        try:
+            r = self._client.head_object(Bucket=bucket, Key=key)
+        except self._client_error as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return False, None, None
+            raise
+        return True, r['ContentLength'], etag_to_md5(r.get('ETag'))
+
+    def read_range(self, uri, start, end):
+        _, bucket, key = split_uri(uri)
+        r = 'bytes={}-{}'.format(start, '' if end is None else end)
+        try:
+            return self._client.get_object(
+                Bucket=bucket, Key=key, Range=r)['Body'].read()
+        except self._client.exceptions.NoSuchKey:
+            raise FileNotFoundError('File does not exist: {}'.format(uri))
+        except self._client_error as e:
+            # range is not satisfiable for an empty object
+            if e.response['Error']['Code'] == 'InvalidRange':
+                return b''
+            raise
+
+    def write(self, uri, data):
+        _, bucket, key = split_uri(uri)
+        self._client.put_object(Bucket=bucket, Key=key, Body=data)
+
+    def write_stream(self, uri, chunks):
+        _, bucket, key = split_uri(uri)
+        # multipart upload is aborted if iteration fails
+        self._client.upload_fileobj(_ChunkReader(chunks), bucket, key)
+
+    def upload(self, path, uri):
+        _, bucket, key = split_uri(uri)
+        self._client.upload_file(path, bucket, key)
+
+    def create_multipart(self, uri):
+        _, bucket, key = split_uri(uri)
+        return self._client.create_multipart_upload(
+            Bucket=bucket, Key=key)['UploadId']
+
+    def upload_part(self, uri, upload_id, part_number, data, md5):
+        _, bucket, key = split_uri(uri)
+        # server rejects a part if it does not match ContentMD5
+        r = self._client.upload_part(
+            Bucket=bucket, Key=key, UploadId=upload_id,
+            PartNumber=part_number, Body=data,
+            ContentMD5=base64.b64encode(bytes.fromhex(md5)).decode())
+        return {'etag': r['ETag']}
+
+    def complete_multipart(self, uri, upload_id, parts):
+        """ETag of a multipart object is an MD5 hash of concatenated
+        MD5 hashes (binary) of parts followed by a number of parts.
+        """
+        _, bucket, key = split_uri(uri)
+        r = self._client.complete_multipart_upload(
+            Bucket=bucket, Key=key, UploadId=upload_id,
+            MultipartUpload={'Parts': [
+                {'ETag': p['etag'], 'PartNumber': i + 1}
+                for i, p in enumerate(parts)]})
+        expected = '{}-{}'.format(
+            hashlib.md5(b''.join(
+                bytes.fromhex(p['md5']) for p in parts)).hexdigest(),
+            len(parts))
+        if r['ETag'].strip('"') != expected:
+            raise IOError('ETag of a multipart object does not match. '
+                          'expected: {}, uploaded: {}, uri: {}'.format(
+                            expected, r['ETag'], uri))
+
+    def abort_multipart(self, uri, upload_id):
+        _, bucket, key = split_uri(uri)
+        try:
+            self._client.abort_multipart_upload(
+                Bucket=bucket, Key=key, UploadId=upload_id)
+        except self._client_error as e:
+            # already completed or aborted
+            if e.response['Error']['Code'] != 'NoSuchUpload':
+                raise
+
+    def download(self, uri, path):
+        _, bucket, key = split_uri(uri)
+        self._client.download_file(bucket, key, path)
+
+    def copy(self, src_uri, target_uri):
+        _, src_bucket, src_key = split_uri(src_uri)
+        _, bucket, key = split_uri(target_uri)
+        # managed copy (multipart for large objects)
+        self._client.copy({'Bucket': src_bucket, 'Key': src_key},
+                          bucket, key)
+
+    def list(self, prefix, recursive=False):
+        _, bucket, key_prefix = split_uri(prefix)
+        kwargs = {'Bucket': bucket, 'Prefix': key_prefix}
+        if not recursive:
+            kwargs['Delimiter'] = '/'
+        objects = {}
+        paginator = self._client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(**kwargs):
+            for obj in page.get('Contents', []):
+                uri = 's3://{}/{}'.format(bucket, obj['Key'])
+                objects[uri] = (obj['Size'], etag_to_md5(obj.get('ETag')))
+        return objects
+
+    def delete(self, uri):
+        _, bucket, key = split_uri(uri)
+        self._client.delete_object(Bucket=bucket, Key=key)
+
+    def presign_many(self, uris, duration_sec, private_key_file=None):
+        result = {}
+        for uri in uris:
+            _, bucket, key = split_uri(uri)
+            result[uri] = self._client.generate_presigned_url(
+                'get_object', Params={'Bucket': bucket, 'Key': key},
+                ExpiresIn=duration_sec)
+        return result
+
+
+class EmulatedStorageDriver(StorageDriver):
+    """Emulates gs:// and s3:// buckets on a local directory so that
+    transfers can be tested and benchmarked offline.
+    gs://bucket/a/b.txt is stored on ROOT_DIR/gs/bucket/a/b.txt.
+    MD5 hashes are calculated once for each version of a file
+    (inode, mtime, size) as cloud storages keep them on metadata.
+    """
+    SCHEMES = ('gs', 's3')
+    MULTIPART = True
+
+    def __init__(self, root_dir):
+        self._root_dir = os.path.abspath(os.path.expanduser(root_dir))
+        # {path: ((inode, mtime, size), md5)}
+        self._md5_cache = {}
+        self._md5_lock = threading.Lock()
+
+    @property
+    def root_dir(self):
+        return self._root_dir
+
+    def get_path(self, uri):
+        scheme, bucket, key = split_uri(uri)
+        return os.path.join(self._root_dir, scheme, bucket, key)
+
+    def stat(self, uri):
+        path = self.get_path(uri)
+        if not os.path.isfile(path):
+            return False, None, None
+        return True, os.path.getsize(path), self.__get_md5(path)
+
+    def read_range(self, uri, start, end):
+        with open(self.__get_existing_path(uri), 'rb') as fp:
+            fp.seek(start)
+            if end is None:
+                return fp.read()
+            return fp.read(end - start + 1)
+
+    def write(self, uri, data):
+        self.write_stream(uri, [data])
+
+    def write_stream(self, uri, chunks):
+        path = self.get_path(uri)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # object appears only when it's completely written
+        tmp_path = '{}.{}.{}'.format(path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_path, 'wb') as fp:
+                for chunk in chunks:
+                    fp.write(chunk)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def download(self, uri, path):
+        src = self.__get_existing_path(uri)
+        tmp_path = '{}.{}.{}'.format(path, os.getpid(), threading.get_ident())
+        try:
+            shutil.copyfile(src, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def copy(self, src_uri, target_uri):
+        with open(self.__get_existing_path(src_uri), 'rb') as fp:
+            self.write_stream(
+                target_uri, iter(lambda: fp.read(self.CHUNK_SIZE), b''))
+
+    def create_multipart(self, uri):
+        return uuid.uuid4().hex
+
+    def upload_part(self, uri, upload_id, part_number, data, md5):
+        part_uri = _get_part_uri(uri, upload_id, part_number)
+        self.write(part_uri, data)
+        if self.stat(part_uri)[2] != md5:
+            self.delete(part_uri)
+            raise IOError('MD5 hash of a part does not match. '
+                          'uri: {}'.format(part_uri))
+        return {'uri': part_uri}
+
+    def complete_multipart(self, uri, upload_id, parts):
+        def iter_parts():
+            for p in parts:
+                yield from self.iter_content(p['uri'])
+        self.write_stream(uri, iter_parts())
+        self.abort_multipart(uri, upload_id)
+
+    def abort_multipart(self, uri, upload_id):
+        for part_uri in self.list(_get_part_uri(uri, upload_id)):
+            self.delete(part_uri)
+
+    def list(self, prefix, recursive=False):
+        scheme, bucket, _ = split_uri(prefix)
+        bucket_dir = os.path.join(self._root_dir, scheme, bucket)
+        objects = {}
+        for d, _, files in os.walk(bucket_dir):
+            for f in files:
+                path = os.path.join(d, f)
+                uri = '{}://{}/{}'.format(
+                    scheme, bucket, os.path.relpath(path, bucket_dir))
+                if not uri.startswith(prefix) or \
+                        not recursive and '/' in uri[len(prefix):]:
+                    continue
+                objects[uri] = (os.path.getsize(path), self.__get_md5(path))
+        return objects
+
+    def delete(self, uri):
+        os.remove(self.__get_existing_path(uri))
+
+    def presign_many(self, uris, duration_sec, private_key_file=None):
+        return {
+            uri: 'file://{}?Expires={}'.format(
+                self.get_path(uri), int(time.time()) + duration_sec)
+            for uri in uris}
+
+    def __get_existing_path(self, uri):
+        path = self.get_path(uri)
+        if not os.path.isfile(path):
+            raise FileNotFoundError('File does not exist: {}'.format(uri))
+        return path
+
+    def __get_md5(self, path):
+        st = os.stat(path)
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with self._md5_lock:
+            cached = self._md5_cache.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        md5 = hashlib.md5()
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(StorageDriver.CHUNK_SIZE),
+                              b''):
+                md5.update(chunk)
+        md5 = md5.hexdigest()
+        with self._md5_lock:
+            self._md5_cache[path] = (key, md5)
+        return md5
+
+
+class _ChunkReader(io.RawIOBase):
+    """File-like object reading from an iterable of bytes
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buf:
+            try:
+                self._buf = next(self._chunks)
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
+
+def _get_part_uri(uri, upload_id, part_number=None):
+    """URI of a part of a multipart upload. Prefix of all parts
+    if part_number is None.
+    """
+    dirname, basename = uri.rsplit('/', 1)
+    prefix = '{}/{}/{}.{}.'.format(
+        dirname, MULTIPART_PARTS_DIRNAME, basename, upload_id)
+    if part_number is None:
+        return prefix
+    return '{}{:05d}'.format(prefix, part_number)
+
+
+def _aws_presign_many(uris, duration_sec):
+    """"aws s3 presign" takes only one URI. Run it for each URI on
+    a thread pool.
+    """
+    def presign(uri):
+        return check_output(
+            ['aws', 's3', 'presign', '--expires-in', str(duration_sec),
+             uri], stderr=PIPE).decode().strip('\n')
+
+    with ThreadPoolExecutor(AWS_PRESIGN_NUM_THREADS) as executor:
+        return dict(zip(uris, executor.map(presign, uris)))
+
+
+def _check_call(cmd):
+    """check_call() with STDERR attached to CalledProcessError
+    so that CaperRetry can classify an error with it
+    """
+    try:
+        run(cmd, stderr=PIPE, check=True)
+    except CalledProcessError as e:
+        _print_stderr(e.stderr)
+        raise
+
+
+def _iter_stdout(cmd, chunk_size):
+    """Stream stdout of a command chunk by chunk
+    """
+    # STDERR on a file. a full pipe would block the command
+    stderr = tempfile.TemporaryFile()
+    p = Popen(cmd, stdout=PIPE, stderr=stderr)
+    completed = False
+    try:
+        yield from iter(lambda: p.stdout.read(chunk_size), b'')
+        completed = True
+    finally:
+        # iteration can be stopped before the end of stream
+        if not completed:
+            p.kill()
+        p.stdout.close()
+        rc = p.wait()
+        if not completed:
+            stderr.close()
+    _raise_on_error(rc, cmd, stderr)
+
+
+def _write_stdin(cmd, chunks):
+    """Write chunks to stdin of a command
+    """
+    stderr = tempfile.TemporaryFile()
+    # in a new process group to kill all child processes of CLI
+    p = Popen(cmd, stdin=PIPE, stderr=stderr, start_new_session=True)
+    try:
+        for chunk in chunks:
+            p.stdin.write(chunk)
+        p.stdin.close()
+    except:
+        # do not let CLI finalize a truncated upload. all processes
+        # reading STDIN are killed before it's closed (EOF)
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        p.wait()
+        try:
+            p.stdin.close()
+        except BrokenPipeError:
+            pass
+        stderr.close()
+        raise
+    _raise_on_error(p.wait(), cmd, stderr)
+
+
+def _raise_on_error(rc, cmd, stderr):
+    """Raise CalledProcessError with STDERR read from a temporary file
+    """
+    with stderr:
+        if rc:
+            stderr.seek(0)
+            s = stderr.read()
+            _print_stderr(s)
+            raise CalledProcessError(rc, cmd, stderr=s)
+
+
+def _print_stderr(s):
+    """Captured STDERR of a failed command is still shown to users
+    """
+    if s:
+        sys.stderr.write(s.decode(errors='replace'))
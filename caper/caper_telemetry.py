@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""CaperTelemetry: Structured events and summary for file operations
+
+Author:
+    Jin Lee (leepc12@gmail.com) at ENCODE-DCC
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class CaperTelemetry(object):
+    """Record an event for each file operation (e.g. copy, stat, lock_wait)
+    with source/target storage types, bytes, wall time and number of
+    retries. Events are appended to a JSON-lines log file (if defined) and
+    aggregated for each (op, src_type, target_type) in memory for
+    a summary table.
+
+    An event is a dict with the following keys:
+        time: Start time (UNIX timestamp)
+        op: Operation (e.g. copy)
+        src_type, target_type: Storage types (e.g. gcs, local)
+        src, target: URIs
+        bytes: Number of bytes transferred. None if not known.
+        wall_time: Wall time in seconds
+        retries: Number of retries
+        status: done, skipped or failed
+        error: Error message if failed
+        Any other operation-specific keys (e.g. method, num_objects).
+        Transfers have throttle states (see CaperThrottle):
+            slot_wait: Time waited for a transfer slot
+            throttle_wait: Time waited for bandwidth limits
+            throttle: State of limits of source/target storage types
+    """
+
+    STATUS_DONE = 'done'
+    STATUS_SKIPPED = 'skipped'
+    STATUS_FAILED = 'failed'
+
+    def __init__(self, log_file=None):
+        """
+        Args:
+            log_file:
+                JSON-lines file to append events to.
+        """
+        self._log_file = log_file
+        self._lock = threading.Lock()
+        # {(op, src_type, target_type): dict of totals}
+        self._totals = OrderedDict()
+
+    @property
+    def log_file(self):
+        return self._log_file
+
+    def new_event(self, op, src_type=None, target_type=None,
+                  src=None, target=None, **kwargs):
+        """
+        Returns:
+            An event dict. Other keys can be defined in kwargs.
+        """
+        event = OrderedDict([
+            ('time', time.time()),
+            ('op', op),
+            ('src_type', src_type),
+            ('target_type', target_type),
+            ('src', src),
+            ('target', target),
+            ('bytes', None),
+            ('wall_time', 0.0),
+            ('retries', 0),
+            ('status', CaperTelemetry.STATUS_DONE)])
+        event.update(kwargs)
+        return event
+
+    @contextmanager
+    def measure(self, op, src_type=None, target_type=None,
+                src=None, target=None, **kwargs):
+        """Measure wall time of an operation in this context.
+        Yields an event dict, which can be updated in the context
+        (e.g. bytes, status). An event fails if an exception is raised.
+        """
+        event = self.new_event(op, src_type=src_type,
+                               target_type=target_type, src=src,
+                               target=target, **kwargs)
+        start = time.perf_counter()
+        try:
+            yield event
+        except BaseException as e:
+            event['status'] = CaperTelemetry.STATUS_FAILED
+            event['error'] = '{}: {}'.format(type(e).__name__, e)
+            raise
+        finally:
+            event['wall_time'] = time.perf_counter() - start
+            self.record(event)
+
+    def record(self, event):
+        key = (event['op'], event['src_type'], event['target_type'])
+        with self._lock:
+            t = self._totals.get(key)
+            if t is None:
+                t = self._totals[key] = OrderedDict([
+                    ('count', 0), ('failed', 0), ('skipped', 0),
+                    ('bytes', 0), ('wall_time', 0.0), ('retries', 0),
+                    ('throttled', 0.0)])
+            t['count'] += 1
+            if event['status'] == CaperTelemetry.STATUS_FAILED:
+                t['failed'] += 1
+            elif event['status'] == CaperTelemetry.STATUS_SKIPPED:
+                t['skipped'] += 1
+            elif event['bytes']:
+                t['bytes'] += event['bytes']
+            t['wall_time'] += event['wall_time']
+            t['retries'] += event['retries']
+            t['throttled'] += event.get('slot_wait', 0.0) + \
+                event.get('throttle_wait', 0.0)
+
+            if self._log_file is not None:
+                with open(self._log_file, 'a') as fp:
+                    fp.write(json.dumps(event) + '\n')
+
+    def get_summary(self):
+        """
+        Returns:
+            List of dicts with op, src_type, target_type and totals
+            (count, failed, skipped, bytes, wall_time, retries, throttled).
+            throttled is time waited for transfer slots and bandwidth.
+            throughput is bytes per second of wall time for operations
+            that have been done (not skipped/failed).
+        """
+        summary = []
+        with self._lock:
+            for (op, src_type, target_type), t in self._totals.items():
+                row = OrderedDict([
+                    ('op', op), ('src_type', src_type),
+                    ('target_type', target_type)])
+                row.update(t)
+                row['throughput'] = t['bytes'] / t['wall_time'] \
+                    if t['bytes'] and t['wall_time'] else None
+                summary.append(row)
+        return summary
+
+    def format_summary(self):
+        """
+        Returns:
+            Summary table string. Empty string if there is no event.
+        """
+        summary = self.get_summary()
+        if not summary:
+            return ''
+        header = ['op', 'src', 'target', 'count', 'failed', 'skipped',
+                  'retries', 'throttled', 'bytes', 'wall_time', 'throughput']
+        rows = [header]
+        for row in summary:
+            rows.append([
+                row['op'], row['src_type'] or '-', row['target_type'] or '-',
+                str(row['count']), str(row['failed']), str(row['skipped']),
+                str(row['retries']), '{:.1f}s'.format(row['throttled']),
+                CaperTelemetry.format_bytes(row['bytes']),
+                '{:.1f}s'.format(row['wall_time']),
+                '-' if row['throughput'] is None else
+                CaperTelemetry.format_bytes(row['throughput']) + '/s'])
+        widths = [max(len(r[i]) for r in rows) for i in range(len(header))]
+        return '\n'.join(
+            '  '.join(col.ljust(w) for col, w in zip(r, widths)).rstrip()
+            for r in rows)
+
+    @staticmethod
+    def format_bytes(n):
+        """Human-readable bytes (e.g. 1.5MB)
+        """
+        for unit in ('B', 'KB', 'MB', 'GB'):
+            if n < 1024:
+                return '{:.1f}{}'.format(n, unit) if unit != 'B' \
+                    else '{}B'.format(int(n))
+            n /= 1024.0
+        return '{:.1f}TB'.format(n)
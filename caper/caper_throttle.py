@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""CaperThrottle: Concurrency and bandwidth limits for file transfers
+
+Author:
+    Jin Lee (leepc12@gmail.com) at ENCODE-DCC
+"""
+
+import time
+import threading
+from collections import OrderedDict
+from contextlib import ExitStack
+
+
+class CaperThrottle(object):
+    """Limit number of concurrent transfers and bandwidth for each
+    storage type (e.g. gcs, s3, url, local). A transfer counts against
+    limits of both source and target storage types.
+
+    Bandwidth is limited with a token bucket for each storage type.
+    Tokens (bytes) are refilled at a limit (bytes per second) up to
+    a burst of BURST_SEC seconds of a limit. A transfer takes tokens
+    for its bytes and the bucket can go into debt for a transfer larger
+    than a burst. Following transfers wait until the debt is paid off.
+    So average bandwidth is bounded by a limit while a single
+    transfer (e.g. gsutil cp) runs at full speed.
+    """
+
+    BURST_SEC = 1.0
+
+    def __init__(self, max_concurrent=None, max_bandwidth=None):
+        """
+        Args:
+            max_concurrent:
+                A dict of {storage_type: maximum number of concurrent
+                transfers}. No limit for missing storage types.
+            max_bandwidth:
+                A dict of {storage_type: maximum bandwidth in bytes
+                per second}. No limit for missing storage types.
+        """
+        self._max_concurrent = dict(max_concurrent or {})
+        self._max_bandwidth = {k: v for k, v in (max_bandwidth or {}).items()
+                               if v}
+        self._semaphores = {
+            k: threading.BoundedSemaphore(v)
+            for k, v in self._max_concurrent.items()}
+        self._active = {}
+        self._tokens = {k: v * CaperThrottle.BURST_SEC
+                        for k, v in self._max_bandwidth.items()}
+        self._updated = {k: time.time() for k in self._max_bandwidth}
+        self._lock = threading.Lock()
+
+    def acquire(self, *storage_types):
+        """Acquire a transfer slot for each storage type.
+        Slots are acquired in a sorted order to prevent deadlocks.
+
+        Returns:
+            ExitStack object. Call close() on it to release slots.
+        """
+        stack = ExitStack()
+        for storage_type in sorted(set(storage_types)):
+            sem = self._semaphores.get(storage_type)
+            if sem is not None:
+                stack.enter_context(sem)
+            self.__add_active(storage_type, 1)
+            stack.callback(self.__add_active, storage_type, -1)
+        return stack
+
+    def consume(self, num_bytes, *storage_types, sleep=time.sleep):
+        """Take tokens for num_bytes from a bucket of each storage type
+        and wait until debts of all buckets are paid off.
+
+        Args:
+            sleep:
+                Function to sleep for given seconds (e.g. cancellable).
+        Returns:
+            Waited time in seconds.
+        """
+        if not num_bytes:
+            return 0.0
+        wait = 0.0
+        with self._lock:
+            for storage_type in set(storage_types):
+                if storage_type not in self._max_bandwidth:
+                    continue
+                tokens = self.__refill(storage_type)
+                if tokens < 0:
+                    wait = max(
+                        wait, -tokens / self._max_bandwidth[storage_type])
+                self._tokens[storage_type] = tokens - num_bytes
+        if wait > 0:
+            sleep(wait)
+        return wait
+
+    def get_state(self, *storage_types):
+        """
+        Args:
+            storage_types:
+                Storage types to get states of. All if not defined.
+        Returns:
+            A dict of {storage_type: state}. state is a dict with
+            active (number of active transfers), max_concurrent,
+            max_bandwidth (bytes per second) and tokens (available
+            bytes in a bucket, negative for debt). Missing limits are None.
+        """
+        with self._lock:
+            if not storage_types:
+                storage_types = sorted(
+                    set(self._max_concurrent) | set(self._max_bandwidth)
+                    | set(self._active))
+            state = OrderedDict()
+            for storage_type in storage_types:
+                state[storage_type] = OrderedDict([
+                    ('active', self._active.get(storage_type, 0)),
+                    ('max_concurrent',
+                     self._max_concurrent.get(storage_type)),
+                    ('max_bandwidth', self._max_bandwidth.get(storage_type)),
+                    ('tokens', self.__refill(storage_type)
+                     if storage_type in self._max_bandwidth else None)])
+            return state
+
+    def __refill(self, storage_type):
+        """Refill a bucket. Must be called with self._lock.
+
+        Returns:
+            Refilled tokens
+        """
+        now = time.time()
+        rate = self._max_bandwidth[storage_type]
+        tokens = min(
+            rate * CaperThrottle.BURST_SEC,
+            self._tokens[storage_type]
+            + (now - self._updated[storage_type]) * rate)
+        self._tokens[storage_type] = tokens
+        self._updated[storage_type] = now
+        return tokens
+
+    def __add_active(self, storage_type, n):
+        with self._lock:
+            self._active[storage_type] = self._active.get(storage_type, 0) + n
@@ -8,14 +8,26 @@ Author:
 import re
 import os
 import errno
+import fcntl
 import json
+import socket
 import shutil
 import time
 import hashlib
-from copy import deepcopy
+import threading
+import tempfile
+from itertools import islice
 from collections import OrderedDict
-from subprocess import Popen, check_call, check_output, \
-    PIPE, CalledProcessError
+from concurrent.futures import ThreadPoolExecutor, Future, CancelledError
+from contextlib import ExitStack, contextmanager
+from subprocess import CalledProcessError
+from .caper_http import CaperHTTP
+from .caper_cache import CaperCache
+from .caper_telemetry import CaperTelemetry
+from .caper_retry import CaperRetry
+from .caper_throttle import CaperThrottle
+from .caper_storage import create_storage_drivers, STORAGE_DRIVER_CLI, \
+    MULTIPART_PARTS_DIRNAME
 
 
 URI_URL = 'url'     # URL (http, https, ftp)
@@ -28,6 +40,25 @@ MIN_DURATION_SEC_PRESIGNED_URL_S3 = 3600
 MAX_DURATION_SEC_PRESIGNED_URL_GCS = 604800
 MIN_DURATION_SEC_PRESIGNED_URL_GCS = 3600
 
+DEFAULT_MAX_CONCURRENT_TRANSFERS = {
+    URI_URL: 4,
+    URI_S3: 8,
+    URI_GCS: 8,
+    URI_LOCAL: 4,
+}
+
+# local to cloud uploads larger than a part size are split into parts
+DEFAULT_MULTIPART_UPLOAD_PART_SIZE = 64 * 1024 * 1024
+DEFAULT_MULTIPART_UPLOAD_NUM_THREADS = 4
+
+# strategies for local to local copy
+LOCAL_COPY_REFLINK = 'reflink'      # copy-on-write clone (FICLONE)
+LOCAL_COPY_HARDLINK = 'hardlink'    # hard link on the same filesystem
+LOCAL_COPY_ZERO_COPY = 'zero_copy'  # copy_file_range or sendfile
+LOCAL_COPY_COPY = 'copy'            # plain copy
+LOCAL_COPY_STRATEGIES = (LOCAL_COPY_REFLINK, LOCAL_COPY_HARDLINK,
+                         LOCAL_COPY_ZERO_COPY, LOCAL_COPY_COPY)
+
 def init_caper_uri(tmp_dir, tmp_s3_bucket=None, tmp_gcs_bucket=None,
                    http_user=None, http_password=None,
                    use_netrc=False,
@@ -39,6 +70,22 @@ def init_caper_uri(tmp_dir, tmp_s3_bucket=None, tmp_gcs_bucket=None,
                    duration_sec_presigned_url_s3=MAX_DURATION_SEC_PRESIGNED_URL_S3,
                    duration_sec_presigned_url_gcs=MAX_DURATION_SEC_PRESIGNED_URL_GCS,
                    mapping_path_to_url=None,
+                   max_concurrent_transfers=None,
+                   max_transfer_bandwidth=None,
+                   local_cache_max_size=None,
+                   stat_cache_ttl_sec=None,
+                   verify_checksum=False,
+                   stream_transfer=False,
+                   storage_driver=STORAGE_DRIVER_CLI,
+                   emulated_storage_dir=None,
+                   batch_transfer=False,
+                   local_copy_strategy=LOCAL_COPY_STRATEGIES,
+                   transfer_log_file=None,
+                   transfer_max_retries=None,
+                   transfer_retry_budget=None,
+                   multipart_upload_part_size=None,
+                   multipart_upload_num_threads=None,
+                   expand_glob=False,
                    verbose=False):
     """Initialize static members in CaperURI class
     Arguments:
@@ -77,6 +124,9 @@ def init_caper_uri(tmp_dir, tmp_s3_bucket=None, tmp_gcs_bucket=None,
         duration_sec_presigned_url_gcs:
             Expiration period in second for presigned URLs for GCS URI
             "gsutil signurl -d <duration_sec_presigned_url_gcs>s"
+            Presigned URLs (for both S3 and GCS) are cached on tmp_dir
+            and reused until CaperURI.PRESIGNED_URL_EXPIRY_MARGIN_SEC
+            before expiration.
 
         mapping_path_to_url:
             A dict that defines a mapping from local file path prefix
@@ -96,6 +146,107 @@ def init_caper_uri(tmp_dir, tmp_s3_bucket=None, tmp_gcs_bucket=None,
               '/var/www/some': 'http://my.server.com/some',
               '/var/www/some/where': 'http://my.server.com/some/where'
             }
+
+        max_concurrent_transfers:
+            A dict that defines maximum number of concurrent file transfers
+            for each storage type (URI_URL, URI_S3, URI_GCS and URI_LOCAL).
+            A transfer counts against limits of both source and target
+            storage types. Missing storage types take defaults from
+            DEFAULT_MAX_CONCURRENT_TRANSFERS.
+
+        max_transfer_bandwidth:
+            A dict that defines maximum bandwidth in bytes per second
+            for each storage type. Like max_concurrent_transfers,
+            a transfer counts against limits of both source and target
+            storage types. No limit for missing storage types.
+            See CaperThrottle for details.
+
+        local_cache_max_size:
+            Maximum total size in bytes of local copies of remote files
+            (gs://, s3:// and URLs) on tmp_dir. If defined, these copies
+            are managed by a content-addressed cache (CaperCache)
+            with LRU eviction.
+
+        stat_cache_ttl_sec:
+            Time-to-live in seconds for cached results of
+            file_exists() and get_file_size() on cloud URIs and URLs.
+            0 to disable stat cache. Defaults to CaperURI.STAT_CACHE_TTL_SEC.
+
+        verify_checksum:
+            Compare MD5 hashes in addition to file sizes to decide whether
+            an existing target file is a copy of a source file.
+            Hashes are taken from metadata for cloud objects and URLs.
+            Hashes of local files are cached on tmp_dir.
+
+        stream_transfer:
+            Stream URL to cloud (gs://, s3://) and cloud to cloud transfers
+            through a pipe with a bounded buffer instead of staging
+            a whole file on tmp_dir. Size (and MD5 hash if verify_checksum)
+            of a target is verified after upload.
+
+        storage_driver:
+            Driver for gs:// and s3:// (see caper_storage.py).
+                cli: gsutil and aws CLIs (default).
+                sdk: in-process clients (google-cloud-storage, boto3)
+                    reused for all operations.
+                emulated: gs:// and s3:// buckets emulated on a local
+                    directory emulated_storage_dir for offline tests
+                    and benchmarks.
+            Use CaperURI.register_storage_driver() for a custom driver.
+
+        batch_transfer:
+            Collect pending file transfers (from/to gs:// and s3://)
+            while deepcopying and run them as a batch with a single call
+            of a storage driver (e.g. "gsutil -m cp -I" for all files
+            to the same directory). Other drivers copy files in a batch
+            on a thread pool. Concurrency in a batch is bounded by
+            max_concurrent_transfers of source and target storages.
+            Files failed in a batch are copied again one by one.
+
+        local_copy_strategy:
+            List (or comma-separated string) of strategies for local to
+            local copy. They are tried in the order until one succeeds.
+                reflink: copy-on-write clone (e.g. btrfs, xfs).
+                hardlink: hard link on the same filesystem. Note that
+                    a target shares contents with a source.
+                zero_copy: in-kernel copy with copy_file_range/sendfile.
+                copy: plain copy.
+            Defaults to all strategies in the above order. A plain copy
+            is always tried last.
+
+        transfer_log_file:
+            JSON-lines file to append an event for each file operation
+            (e.g. copy, stat, list, lock_wait) to. Events are aggregated
+            on CaperURI.TELEMETRY (CaperTelemetry) regardless of it.
+
+        transfer_max_retries:
+            Maximum number of retries for each file operation
+            (e.g. copy, stat, read, write) on transient errors
+            (see CaperRetry for classification of errors).
+            0 to disable retry. Defaults to CaperRetry.MAX_RETRIES.
+
+        transfer_retry_budget:
+            Maximum total number of retries for all file operations.
+            Defaults to CaperRetry.RETRY_BUDGET.
+
+        multipart_upload_part_size:
+            Local to cloud (gs://, s3://) uploads larger than this
+            (in bytes) are split into parts uploaded concurrently
+            (S3 multipart upload, GCS compose). Completed parts are
+            tracked on tmp_dir so that an interrupted upload is resumed.
+            0 to disable. See StorageDriver.upload_parallel().
+            Defaults to 0 (disabled) for the cli storage driver and
+            DEFAULT_MULTIPART_UPLOAD_PART_SIZE for others.
+
+        multipart_upload_num_threads:
+            Number of threads to upload parts of a file.
+            Defaults to DEFAULT_MULTIPART_UPLOAD_NUM_THREADS.
+
+        expand_glob:
+            Expand glob patterns (*, ?, [...] and ** for any number of
+            directories) in values of JSON files into arrays of matching
+            files while deepcopying. Local paths, gs:// and s3:// are
+            supported. See CaperURI.expand_globs().
     """
     assert(tmp_dir is not None)
     path = os.path.abspath(os.path.expanduser(tmp_dir))
@@ -110,7 +261,15 @@ def init_caper_uri(tmp_dir, tmp_s3_bucket=None, tmp_gcs_bucket=None,
     CaperURI.HTTP_USER = http_user
     CaperURI.HTTP_PASSWORD = http_password
     CaperURI.USE_NETRC = use_netrc
+    CaperURI.HTTP = CaperHTTP(http_user=http_user,
+                              http_password=http_password,
+                              use_netrc=use_netrc,
+                              verbose=verbose)
     CaperURI.USE_GSUTIL_OVER_AWS_S3 = use_gsutil_over_aws_s3
+    CaperURI.STORAGE_DRIVERS = create_storage_drivers(
+        storage_driver,
+        use_gsutil_over_aws_s3=use_gsutil_over_aws_s3,
+        emulated_storage_dir=emulated_storage_dir)
     CaperURI.USE_PRESIGNED_URL_S3 = use_presigned_url_s3
     CaperURI.USE_PRESIGNED_URL_GCS = use_presigned_url_gcs
     if gcp_private_key_file is not None:
@@ -140,15 +299,69 @@ def init_caper_uri(tmp_dir, tmp_s3_bucket=None, tmp_gcs_bucket=None,
         CaperURI.MAPPING_PATH_TO_URL = {}
         for k, v in mapping_path_to_url.items():
             CaperURI.MAPPING_PATH_TO_URL[k] = v.rstrip().rstrip('/')
+    CaperURI.MAX_CONCURRENT_TRANSFERS = dict(DEFAULT_MAX_CONCURRENT_TRANSFERS)
+    if max_concurrent_transfers is not None:
+        CaperURI.MAX_CONCURRENT_TRANSFERS.update(max_concurrent_transfers)
+    CaperURI.MAX_TRANSFER_BANDWIDTH = dict(max_transfer_bandwidth or {})
+    CaperURI.THROTTLE = CaperThrottle(
+        max_concurrent=CaperURI.MAX_CONCURRENT_TRANSFERS,
+        max_bandwidth=CaperURI.MAX_TRANSFER_BANDWIDTH)
+    CaperURI.DEEPCOPY_NUM_THREADS = sum(
+        CaperURI.MAX_CONCURRENT_TRANSFERS.values())
+    if local_cache_max_size is not None:
+        CaperURI.CACHE = CaperCache(CaperURI.TMP_DIR,
+                                    max_size=local_cache_max_size,
+                                    verbose=verbose)
+    else:
+        CaperURI.CACHE = None
+    if stat_cache_ttl_sec is not None:
+        CaperURI.STAT_CACHE_TTL_SEC = stat_cache_ttl_sec
+    CaperURI.STAT_CACHE.clear()
+    CaperURI.VERIFY_CHECKSUM = verify_checksum
+    CaperURI.STREAM_TRANSFER = stream_transfer
+    CaperURI.BATCH_TRANSFER = batch_transfer
+    CaperURI.TELEMETRY = CaperTelemetry(log_file=transfer_log_file)
+    CaperURI.RETRY = CaperRetry(
+        max_retries=CaperRetry.MAX_RETRIES if transfer_max_retries is None
+        else transfer_max_retries,
+        retry_budget=CaperRetry.RETRY_BUDGET if transfer_retry_budget is None
+        else transfer_retry_budget,
+        verbose=verbose)
+    if local_copy_strategy is None:
+        local_copy_strategy = LOCAL_COPY_STRATEGIES
+    elif isinstance(local_copy_strategy, str):
+        local_copy_strategy = local_copy_strategy.split(',')
+    for strategy in local_copy_strategy:
+        if strategy not in LOCAL_COPY_STRATEGIES:
+            raise ValueError('Unsupported local copy strategy: {}. '
+                             'Supported: {}'.format(
+                                strategy, LOCAL_COPY_STRATEGIES))
+    CaperURI.LOCAL_COPY_STRATEGIES = tuple(
+        OrderedDict.fromkeys(list(local_copy_strategy) + [LOCAL_COPY_COPY]))
+    if multipart_upload_part_size is None:
+        # gsutil makes a composite object without MD5 hash, which
+        # needs crcmod to be downloaded. opt-in for cli
+        multipart_upload_part_size = 0 \
+            if storage_driver == STORAGE_DRIVER_CLI \
+            else DEFAULT_MULTIPART_UPLOAD_PART_SIZE
+    CaperURI.MULTIPART_UPLOAD_PART_SIZE = multipart_upload_part_size
+    CaperURI.MULTIPART_UPLOAD_NUM_THREADS = \
+        DEFAULT_MULTIPART_UPLOAD_NUM_THREADS \
+        if multipart_upload_num_threads is None \
+        else multipart_upload_num_threads
+    CaperURI.EXPAND_GLOB = expand_glob
     CaperURI.VERBOSE = verbose
 
 
 class CaperURI(object):
-    """Easy transfer between cloud/local storages based on cloud
-    platform CLIs (gsutil, aws s3).
+    """Easy transfer between cloud/local storages based on storage
+    drivers (caper_storage.py) for gs:// and s3://. Cloud platform CLIs
+    (gsutil, aws s3) are used by default.
 
     Args:
-        URI or local path for a file (not a directory).
+        URI or local path for a file or a directory. Cloud URIs
+        (gs://, s3://) ending with a slash (/) are directories (prefixes).
+        See is_dir().
 
     Supported URI's:
         URL:
@@ -175,15 +388,42 @@ class CaperURI(object):
         .json: recursively find all URIs in values only (not keys)
         .tsv: find all URIs in all columns and rows
         .csv: find all URIs in all columns and rows
+
+    Glob patterns in JSON files are expanded into arrays of matching
+    files before deepcopying them if EXPAND_GLOB (see expand_globs()).
+
+    Parallel deepcopy collects all URIs in a file first and then
+    deepcopies them on a thread pool. The number of concurrent file
+    transfers is bounded by MAX_CONCURRENT_TRANSFERS for each storage type.
+    All transfers are throttled by MAX_CONCURRENT_TRANSFERS and
+    MAX_TRANSFER_BANDWIDTH (see CaperThrottle) for each storage type.
+
+    Batch transfer collects all URIs in a file first and then transfers
+    them with a single call of a storage driver for each pair of source
+    and target storages. Results are verified with stat_many().
+
+    Operations on remote storages (copy, stat, list, read, write, sign
+    and rm) are retried on transient errors with exponential backoff
+    and jitter (see CaperRetry).
+
+    A directory is copied (see copy_dir()), removed and stat-ed file by
+    file with a single listing for all files in it. Deepcopy does not
+    support directories.
     """
 
+    # instances are created for every path/URI while deepcopying
+    __slots__ = ('_uri', '_uri_type', '_can_deepcopy')
+
     TMP_DIR = None
     TMP_S3_BUCKET = None
     TMP_GCS_BUCKET = None
     HTTP_USER = None
     HTTP_PASSWORD = None
     USE_NETRC = False
+    HTTP = None
     USE_GSUTIL_OVER_AWS_S3 = False
+    # {scheme: StorageDriver}
+    STORAGE_DRIVERS = {}
     USE_PRESIGNED_URL_S3 = False
     USE_PRESIGNED_URL_GCS = False
     GCP_PRIVATE_KEY_FILE = None
@@ -191,16 +431,61 @@ class CaperURI(object):
     DURATION_SEC_PRESIGNED_URL_S3 = None
     DURATION_SEC_PRESIGNED_URL_GCS = None
     MAPPING_PATH_TO_URL = {}
+    MAX_CONCURRENT_TRANSFERS = DEFAULT_MAX_CONCURRENT_TRANSFERS
+    MAX_TRANSFER_BANDWIDTH = {}
+    THROTTLE = CaperThrottle()
+    DEEPCOPY_NUM_THREADS = 1
+    CACHE = None
+    STAT_CACHE_TTL_SEC = 300
+    # {uri: (timestamp, exists, size, checksum)}
+    STAT_CACHE = {}
+    # cancel_event for operations on each thread. see cancel_scope()
+    THREAD_LOCAL = threading.local()
+    # deepcopy dependencies across threads. see __depend_on()
+    # {(id(memo), key): [keys of nested files]}
+    DEEPCOPY_WAIT_FOR = {}
+    DEEPCOPY_WAIT_FOR_LOCK = threading.Lock()
+    VERIFY_CHECKSUM = False
+    STREAM_TRANSFER = False
+    BATCH_TRANSFER = False
+    LOCAL_COPY_STRATEGIES = (LOCAL_COPY_COPY,)
+    MULTIPART_UPLOAD_PART_SIZE = 0
+    MULTIPART_UPLOAD_NUM_THREADS = DEFAULT_MULTIPART_UPLOAD_NUM_THREADS
+    EXPAND_GLOB = False
+    TELEMETRY = CaperTelemetry()
+    RETRY = CaperRetry()
     VERBOSE = False
 
-    CURL_HTTP_ERROR_PREFIX = '_CaperURI_HTTP_ERROR_'
-    CURL_HTTP_ERROR_WRITE_OUT = CURL_HTTP_ERROR_PREFIX + '%{http_code}'
-    RE_PATTERN_CURL_HTTP_ERR = r'_CaperURI_HTTP_ERROR_(\d*)'
-    DELAY_SEC_CURL_AUTH = 2
-
+    # strings that can be a URI (URL, gs://, s3://) or an absolute path
+    # (/ or ~). others (e.g. sample names, numbers, flags) are not
+    # deepcopied at all and a CaperURI object is not created for them
+    RE_URI_CANDIDATE = re.compile(r'(?:https?://|ftp://|s3://|gs://|[/~])')
+    RE_GLOB = re.compile(r'[*?\[]')
     LOCK_EXT = '.lock'
-    LOCK_WAIT_SEC = 30
-    LOCK_MAX_ITER = 100
+    # lock on a cloud storage (or a local filesystem without flock support)
+    # expires unless its owner renews it
+    LOCK_LEASE_SEC = 120
+    LOCK_POLL_MIN_SEC = 1
+    LOCK_POLL_MAX_SEC = 30
+    LOCK_MAX_WAIT_SEC = 3000
+    ERRNO_FLOCK_NOT_SUPPORTED = (errno.ENOLCK, errno.EOPNOTSUPP,
+                                 errno.EINVAL)
+    # max age of a cached stat for .lock file, resolved by stat_many()
+    LOCK_STAT_MAX_AGE_SEC = 60
+    MD5_DIRNAME = '.caper_md5'
+    PRESIGNED_URL_DIRNAME = '.caper_presigned_url'
+    # cached presigned URL is not used if it expires within this margin
+    PRESIGNED_URL_EXPIRY_MARGIN_SEC = 1800
+    MD5_CHUNK_SIZE = 1024 * 1024
+    # rows of TSV/CSV are deepcopied and written chunk by chunk
+    DEEPCOPY_TSV_CHUNK_NUM_LINES = 10000
+    STREAM_TMP_DIRNAME = '.caper_stream'
+    # states of multipart uploads to be resumed
+    MULTIPART_DIRNAME = '.caper_multipart'
+    # ioctl request code for reflink on Linux
+    FICLONE = 0x40049409
+    ZERO_COPY_CHUNK_SIZE = 64 * 1024 * 1024
+    STREAM_CHUNK_SIZE = 1024 * 1024
 
     def __init__(self, uri_or_path):
         if CaperURI.TMP_DIR is None:
@@ -252,6 +537,15 @@ class CaperURI(object):
     def get_uri(self):
         return self._uri
 
+    @staticmethod
+    def is_uri_candidate(s):
+        """Check if a string can be a deepcopyable URI or path
+        without creating a CaperURI object or accessing a filesystem.
+        False means that CaperURI(s).can_deepcopy() is always False.
+        """
+        return isinstance(s, str) and \
+            CaperURI.RE_URI_CANDIDATE.match(s) is not None
+
     def is_valid_uri(self):
         # deepcopy is only available for valid URIs
         return self._can_deepcopy
@@ -260,7 +554,265 @@ class CaperURI(object):
         return self._can_deepcopy
 
     def file_exists(self):
-        return CaperURI.__file_exists(self._uri)
+        """Check if file exists. A local directory exists if it is
+        a directory. A cloud directory (prefix) exists if it has any file.
+        """
+        if self.is_dir():
+            if self._uri_type == URI_LOCAL:
+                return True
+            return bool(self.list_dir())
+        exists, _, _ = CaperURI.__stat(self._uri)
+        return exists
+
+    def is_dir(self):
+        """Check if self is a directory without accessing a cloud storage.
+        Cloud URIs (gs://, s3://) are directories if they end with
+        a slash (/). Local paths are directories if they exist as
+        directories.
+        """
+        if self._uri_type in (URI_GCS, URI_S3):
+            return self._uri.endswith('/')
+        elif self._uri_type == URI_LOCAL:
+            return os.path.isdir(self._uri)
+        return False
+
+    def list_dir(self):
+        """List all files in a directory recursively with a single
+        listing. Results for cloud files are stored on STAT_CACHE.
+        Lock files and parts of multipart uploads are not listed.
+
+        Returns:
+            OrderedDict of {relative path: (size, checksum)} sorted by
+            relative path. checksum is a hexadecimal MD5 hash if
+            available (None for local files).
+        """
+        result = {}
+        if self._uri_type in (URI_GCS, URI_S3):
+            prefix = self._uri.rstrip('/') + '/'
+            with CaperURI.TELEMETRY.measure(
+                    'list', src_type=self._uri_type, src=prefix,
+                    recursive=True) as event:
+                objects = CaperURI.__retry(
+                    lambda: CaperURI.get_storage_driver(prefix).list(
+                        prefix, recursive=True),
+                    self._uri_type, event=event)
+                event['num_objects'] = len(objects)
+            for uri, (size, checksum) in objects.items():
+                CaperURI.__update_stat(uri, True, size, checksum)
+                result[uri[len(prefix):]] = (size, checksum)
+
+        elif self._uri_type == URI_LOCAL:
+            for d, _, files in os.walk(self._uri):
+                for f in files:
+                    path = os.path.join(d, f)
+                    if os.path.isfile(path):
+                        result[os.path.relpath(path, self._uri)] = (
+                            os.path.getsize(path), None)
+        else:
+            raise NotImplementedError('uri_type: {}'.format(
+                self._uri_type))
+
+        return OrderedDict(
+            (k, result[k]) for k in sorted(result)
+            if not k.endswith(CaperURI.LOCK_EXT)
+            and MULTIPART_PARTS_DIRNAME not in k.split('/'))
+
+    @staticmethod
+    def stat_many(uris, max_age_sec=None):
+        """Check if files exist and get their sizes and checksums at once.
+        Cloud URIs (gs://, s3://) in the same directory are resolved with
+        a single non-recursive listing of it. Others are checked one by
+        one.
+        Results are stored on STAT_CACHE.
+
+        Args:
+            max_age_sec:
+                Use cached results younger than this.
+                Defaults to STAT_CACHE_TTL_SEC. 0 to bypass cache.
+        Returns:
+            A dict of {uri: (exists, size, checksum)}. checksum is
+            a hexadecimal MD5 hash if available. Otherwise None.
+        """
+        result = {}
+        cloud_uris = []
+        for uri in OrderedDict.fromkeys(uris):
+            uri_type = CaperURI.__get_uri_type(uri)
+            cached = CaperURI.__get_cached_stat(uri, max_age_sec)
+            if cached is not None:
+                result[uri] = cached
+            elif uri_type in (URI_GCS, URI_S3):
+                cloud_uris.append(uri)
+            else:
+                result[uri] = CaperURI.__stat(uri, max_age_sec=max_age_sec)
+
+        for prefix, uris_ in CaperURI.__group_by_prefix(cloud_uris).items():
+            if CaperURI.VERBOSE:
+                print('[CaperURI] listing {} for {} files'.format(
+                    prefix, len(uris_)))
+            with CaperURI.TELEMETRY.measure(
+                    'list', src_type=CaperURI.__get_uri_type(prefix),
+                    src=prefix, recursive=False,
+                    num_uris=len(uris_)) as event:
+                objects = CaperURI.__retry(
+                    lambda: CaperURI.get_storage_driver(prefix).list(
+                        prefix, recursive=False),
+                    CaperURI.__get_uri_type(prefix), event=event)
+                event['num_objects'] = len(objects)
+            for uri in uris_:
+                if uri in objects:
+                    size, checksum = objects[uri]
+                    result[uri] = (True, size, checksum)
+                else:
+                    result[uri] = (False, None, None)
+                CaperURI.__update_stat(uri, *result[uri])
+        return result
+
+    @staticmethod
+    def expand_globs(patterns):
+        """Expand glob patterns of local paths and cloud URIs (gs://, s3://)
+        into matching files. "*", "?" and "[...]" do not match a slash (/)
+        and "**" matches any number of directories. Each directory
+        (prefix) before the first wildcard is listed only once for all
+        patterns in it. Results for cloud files are stored on STAT_CACHE
+        so that matched files are not stat-ed again. Relative local
+        patterns are relative to the working directory.
+
+        Returns:
+            OrderedDict of {pattern: OrderedDict of {uri: size}}.
+            Matches are sorted and empty if nothing matches.
+            A pattern which exists as a file (e.g. a file name with
+            literal "[") is not expanded and matches itself only.
+        """
+        keys = {}
+        for pattern in OrderedDict.fromkeys(patterns):
+            uri_type = CaperURI.__get_uri_type(pattern)
+            if uri_type not in (URI_LOCAL, URI_GCS, URI_S3):
+                raise NotImplementedError(
+                    'Glob is not supported for uri_type: {}'.format(uri_type))
+            path = CaperURI.__get_glob_path(pattern)
+            m = CaperURI.RE_GLOB.search(path)
+            if m is None:
+                raise ValueError('Not a glob pattern: {}'.format(pattern))
+            prefix = path[:path.rfind('/', 0, m.start()) + 1]
+            if uri_type != URI_LOCAL and prefix.count('/') < 3:
+                raise ValueError(
+                    'Glob in a bucket name is not supported: {}'.format(
+                        pattern))
+            keys[pattern] = (path, prefix, '/' in path[len(prefix):])
+
+        # a recursive listing also covers its sub-directories
+        listings = OrderedDict()
+        for prefix, recursive in sorted(
+                set(k[1:] for k in keys.values()),
+                key=lambda k: (not k[1], len(k[0]))):
+            if not any(r and prefix.startswith(p) for p, r in listings):
+                listings[(prefix, recursive)] = CaperURI.__list_prefix(
+                    prefix, recursive)
+
+        result = OrderedDict()
+        for pattern, (path, prefix, recursive) in keys.items():
+            objects = next(
+                objects for (p, r), objects in listings.items()
+                if (p, r) == (prefix, recursive) or r and prefix.startswith(p))
+            # a listing always includes a file at the pattern itself
+            if path in objects:
+                result[pattern] = OrderedDict([(path, objects[path])])
+                continue
+            regex = CaperURI.__glob_to_regex(path)
+            result[pattern] = OrderedDict(
+                (uri, objects[uri]) for uri in sorted(objects)
+                if regex.match(uri))
+        return result
+
+    @staticmethod
+    def presign_many(uris):
+        """Make presigned URLs for cloud URIs (gs://, s3://) at once.
+        Presigned URLs are cached on TMP_DIR for each (URI, duration) and
+        reused until PRESIGNED_URL_EXPIRY_MARGIN_SEC before expiration.
+        URIs not in cache are signed with a single call of a storage
+        driver for each scheme.
+
+        Returns:
+            A dict of {uri: url}
+        """
+        result = {}
+        pending = OrderedDict()
+        for uri in OrderedDict.fromkeys(uris):
+            duration = CaperURI.__get_presign_duration(uri)
+            url = CaperURI.__get_cached_presigned_url(uri, duration)
+            if url is None:
+                pending.setdefault(uri.split('://', 1)[0], []).append(uri)
+            else:
+                result[uri] = url
+
+        for scheme, uris_ in pending.items():
+            duration = CaperURI.__get_presign_duration(uris_[0])
+            if CaperURI.VERBOSE:
+                print('[CaperURI] presign {n} {scheme}:// URIs '
+                      'for {dur} sec'.format(
+                        n=len(uris_), scheme=scheme, dur=duration))
+            expires = time.time() + duration
+            uri_type = CaperURI.__get_uri_type(uris_[0])
+            with CaperURI.TELEMETRY.measure(
+                    'sign', src_type=uri_type, num_uris=len(uris_)) as event:
+                urls = CaperURI.__retry(
+                    lambda: CaperURI.get_storage_driver(uris_[0]).presign_many(
+                        uris_, duration,
+                        private_key_file=CaperURI.GCP_PRIVATE_KEY_FILE),
+                    uri_type, event=event)
+            for uri in uris_:
+                result[uri] = urls[uri]
+                CaperURI.__write_sidecar(
+                    CaperURI.__get_presigned_url_sidecar(uri, duration),
+                    {'uri': uri, 'duration': duration,
+                     'expires': expires, 'url': urls[uri]},
+                    private=True)
+        return result
+
+    @staticmethod
+    @contextmanager
+    def cancel_scope(cancel_event):
+        """Operations on the current thread in this context can be
+        cancelled by setting cancel_event (threading.Event).
+        A cancelled operation raises CancelledError at the next
+        checkpoint (see check_cancelled()).
+        """
+        org_cancel_event = getattr(CaperURI.THREAD_LOCAL, 'cancel_event',
+                                   None)
+        CaperURI.THREAD_LOCAL.cancel_event = cancel_event
+        try:
+            yield cancel_event
+        finally:
+            CaperURI.THREAD_LOCAL.cancel_event = org_cancel_event
+
+    @staticmethod
+    def check_cancelled():
+        """Checkpoint for cancellation. It is called before each file
+        transfer, while waiting for a lock and between chunks of
+        streaming. A running subprocess (e.g. gsutil cp) is not
+        interrupted.
+
+        Raises:
+            CancelledError if cancel_event of the current thread is set.
+        """
+        cancel_event = getattr(CaperURI.THREAD_LOCAL, 'cancel_event', None)
+        if cancel_event is not None and cancel_event.is_set():
+            raise CancelledError()
+
+    @staticmethod
+    def register_storage_driver(scheme, driver):
+        """Use a storage driver (caper_storage.StorageDriver) for URIs
+        with a scheme (e.g. gs, s3).
+        """
+        CaperURI.STORAGE_DRIVERS[scheme] = driver
+
+    @staticmethod
+    def get_storage_driver(uri):
+        scheme = uri.split('://', 1)[0]
+        if scheme not in CaperURI.STORAGE_DRIVERS:
+            raise NotImplementedError(
+                'No storage driver for scheme: {}'.format(scheme))
+        return CaperURI.STORAGE_DRIVERS[scheme]
 
     def get_local_file(self, no_copy=False):
         """Get local version of URI. Make a copy if required
@@ -290,9 +842,10 @@ class CaperURI(object):
         return self.copy(target_uri_type=uri_type, no_copy=no_copy)
 
     def copy(self, target_uri_type=None, target_uri=None, soft_link=False,
-             no_copy=False):
+             no_copy=False, overwrite=False):
         """Make a copy of self on a "target_uri_type" tmp_dir or
         tmp_bucket. Or copy self to "target_uri".
+        A directory is synced to a target directory (see copy_dir()).
 
         Args:
             target_uri_type, target_uri:
@@ -300,6 +853,9 @@ class CaperURI(object):
 
             soft_link:
                 soft link target if possible. e.g. from local to local
+
+            overwrite:
+                copy even if target is already a copy of self.
         """
         # XOR: only one of target_uri and target_uri_type
         # should be specified
@@ -317,10 +873,16 @@ class CaperURI(object):
         if path is None and uri_type == self._uri_type:
             return self._uri
 
+        # remote to local copy on TMP_DIR is managed by cache
+        use_cache = CaperURI.CACHE is not None and path is None \
+            and uri_type == URI_LOCAL and self._uri_type != URI_LOCAL
+
         # here, path is target path
         # get target path
         if uri_type == URI_URL:
-            assert(path is None and no_copy)
+            assert(path is None)
+            # URL is read-only
+            no_copy = True
             path = self.__get_url()
             method = 'url_forming'
 
@@ -340,9 +902,16 @@ class CaperURI(object):
         else:
             raise NotImplementedError('uri_type: {}'.format(uri_type))
 
+        if self.is_dir():
+            if no_copy:
+                return path.rstrip('/') + '/'
+            return self.copy_dir(path, sync=not overwrite,
+                                 soft_link=soft_link)
+
         # special treatment for URL to cloud (gcs, s3)
+        # it's streamed without a local copy if STREAM_TRANSFER
         if uri_type in (URI_GCS, URI_S3) and \
-                self._uri_type == URI_URL:
+                self._uri_type == URI_URL and not CaperURI.STREAM_TRANSFER:
             # # there is no way to get URL's file size before it's downloaded
             # # (since "Content-Length" header is optional)
             # # and not all websites support it (e.g. AWS)
@@ -367,16 +936,17 @@ class CaperURI(object):
             elif uri_type == URI_S3 and self._uri_type == URI_S3:
                 return self._uri
 
-        if CaperURI.VERBOSE and uri_type not in (URI_URL,):
+        if uri_type not in (URI_URL,):
             if soft_link and self._uri_type == URI_LOCAL \
                     and uri_type == URI_LOCAL:
                 method = 'symlinking'
             else:
                 method = 'copying'
-            print('[CaperURI] {method} from '
-                  '{src} to {target}, src: {uri}'.format(
-                    method=method,
-                    src=self._uri_type, target=uri_type, uri=self._uri))
+            if CaperURI.VERBOSE:
+                print('[CaperURI] {method} from '
+                      '{src} to {target}, src: {uri}'.format(
+                        method=method,
+                        src=self._uri_type, target=uri_type, uri=self._uri))
 
         action = 'skipped'
         if not no_copy:
@@ -385,125 +955,321 @@ class CaperURI(object):
             cu_target = CaperURI(path)
             cu_target.__wait_for_lock()
 
-            # if target file not exists or file sizes are different
-            # then do copy!
-            if uri_type not in (URI_URL,) and (not cu_target.file_exists() or \
-                    self.get_file_size() != cu_target.get_file_size()):
-
-                action = 'done'
-                cu_lock = CaperURI(path + CaperURI.LOCK_EXT)
-                try:
-                    # create an empty .lock file
-                    cu_lock.write_str_to_file('', quiet=True)
-
-                    # do copy
-                    if uri_type == URI_GCS:
-                        if self._uri_type == URI_URL:
-                            assert(False)
-
-                        elif self._uri_type == URI_GCS or \
-                                self._uri_type == URI_S3 \
-                                or self._uri_type == URI_LOCAL:
-                            check_call(['gsutil', '-q', 'cp', self._uri, path])
-                        else:
-                            path = None
-
-                    elif uri_type == URI_S3:
-                        if self._uri_type == URI_URL:
-                            assert(False)
-
-                        elif self._uri_type == URI_GCS:
-                            check_call(['gsutil', '-q', 'cp', self._uri, path])
-
-                        elif self._uri_type == URI_S3 or \
-                                self._uri_type == URI_LOCAL:
-                            if CaperURI.USE_GSUTIL_OVER_AWS_S3:
-                                check_call(['gsutil', '-q', 'cp',
-                                            self._uri, path])
-                            else:
-                                check_call(['aws', 's3', 'cp',
-                                            '--only-show-errors',
-                                            self._uri, path])
+            # if target file not exists or file sizes
+            # (or checksums) are different then do copy!
+            need_copy = uri_type not in (URI_URL,) and \
+                (overwrite or not self.__is_copied_to(cu_target))
+            if need_copy:
+                lock = cu_target.__lock()
+                # local target can be copied by another process while
+                # waiting for a lock. re-check it since it's cheap
+                if uri_type == URI_LOCAL and not overwrite and \
+                        self.__is_copied_to(cu_target):
+                    lock.close()
+                    need_copy = False
+
+            if need_copy:
+                with CaperURI.TELEMETRY.measure(
+                        'copy', src_type=self._uri_type, target_type=uri_type,
+                        src=self._uri, target=path) as event:
+                    # bound number of concurrent transfers per storage type
+                    slot_wait_start = time.time()
+                    transfer_slots = CaperURI.THROTTLE.acquire(
+                        self._uri_type, uri_type)
+                    event['slot_wait'] = time.time() - slot_wait_start
+                    event['throttle_wait'] = 0.0
+                    event['throttle'] = CaperURI.THROTTLE.get_state(
+                        self._uri_type, uri_type)
+                    try:
+                        method, action, streamed = CaperURI.__retry(
+                            lambda: self.__transfer_to(
+                                path, uri_type, method, soft_link, use_cache,
+                                event=event),
+                            self._uri_type, uri_type, event=event)
+                    finally:
+                        transfer_slots.close()
+                        # target has been changed
+                        CaperURI.__invalidate_stat(path)
+                        # remove .lock file
+                        lock.close()
+
+                    if self._uri_type == URI_LOCAL and not soft_link:
+                        CaperURI.__update_stat(
+                            path, True, os.path.getsize(self._uri))
+                    elif streamed is not None:
+                        CaperURI.__update_stat(path, True, *streamed)
+
+                    event['method'] = method
+                    event['status'] = action
+                    if action == 'done' and not soft_link:
+                        if streamed is not None:
+                            event['bytes'] = streamed[0]
+                        elif uri_type == URI_LOCAL:
+                            event['bytes'] = os.path.getsize(path)
                         else:
-                            path = None
-
-                    elif uri_type == URI_LOCAL:
-                        if self._uri_type == URI_LOCAL:
-                            if soft_link:
-                                if CaperURI.VERBOSE:
-                                    method = 'symlinking'
-                                try:
-                                    os.symlink(self._uri, path)
-                                except OSError as e:
-                                    if e.errno == errno.EEXIST:
-                                        os.remove(path)
-                                        os.symlink(self._uri, path)
-                            else:
-                                if CaperURI.VERBOSE:
-                                    method = 'copying'
-                                shutil.copy2(self._uri, path)
-
-                        elif self._uri_type == URI_URL:
-                            # we need "curl -C -" to resume downloading
-                            # but it always fails with HTTP ERR 416 when file
-                            # is already fully downloaded, i.e. path exists
-                            _, _, _, http_err = CaperURI.__curl_auto_auth(
-                                ['curl', '-RL', '-f', '-C', '-',
-                                 self._uri, '-o', path],
-                                ignored_http_err=(416,))
-                            if http_err in (416,):
-                                action = 'skipped'
-
-                        elif self._uri_type == URI_GCS or \
-                            self._uri_type == URI_S3 and \
-                                CaperURI.USE_GSUTIL_OVER_AWS_S3:
-                            check_call(['gsutil', '-q', 'cp', self._uri, path])
-                        elif self._uri_type == URI_S3:
-                            check_call(['aws', 's3', 'cp',
-                                        '--only-show-errors',
-                                        self._uri, path])
-                        else:
-                            path = None
-
-                    else:
-                        raise NotImplementedError('uri_type: {}'.format(
-                            uri_type))
+                            event['bytes'] = self.get_file_size()
+            else:
+                CaperURI.TELEMETRY.record(CaperURI.TELEMETRY.new_event(
+                    'copy', src_type=self._uri_type, target_type=uri_type,
+                    src=self._uri, target=path, method=method,
+                    status=action))
 
-                    if path is None:
-                        raise NotImplementedError('uri_types: {}, {}'.format(
-                            self._uri_type, uri_type))
-                finally:
-                    # remove .lock file
-                    cu_lock.rm(quiet=True)
+        if use_cache and not no_copy:
+            # add files not in cache yet (e.g. copied before cache is enabled)
+            if action == 'done' or not CaperURI.CACHE.touch(path):
+                CaperURI.CACHE.add(path)
 
         if CaperURI.VERBOSE and uri_type not in (URI_URL,):
             print('[CaperURI] {method} {action}, target: {target}'.format(
                     method=method, action=action, target=path))
         return path
 
-    def get_file_contents(self):
-        """Get file contents
+    def copy_dir(self, target_uri, sync=False, soft_link=False,
+                 parallel=True):
+        """Copy all files in a directory (self) to a target directory
+        keeping their relative paths. Source is listed only once and
+        files are copied on a thread pool (DEEPCOPY_NUM_THREADS) with
+        copy() so that each of them is throttled, retried and locked.
+
+        Args:
+            target_uri:
+                Target directory (local path, gs:// or s3://).
+            sync:
+                Incremental sync. Target is also listed only once and
+                only new or changed files are copied. A file is changed
+                if its size is different, or its MD5 hash is different
+                when VERIFY_CHECKSUM and both hashes are available.
+                Otherwise, all files are copied and overwritten.
+                Files in target only are not removed in both modes.
+            parallel:
+                Copy files on a thread pool.
+        Returns:
+            Target directory ending with a slash (/)
         """
+        target_dir = target_uri.rstrip('/') + '/'
+        target_type = CaperURI.__get_uri_type(target_dir)
+        if CaperURI.VERBOSE:
+            print('[CaperURI] {method} directory from {src} to {target}, '
+                  'src: {uri}'.format(
+                    method='syncing' if sync else 'copying',
+                    src=self._uri_type, target=target_type, uri=self._uri))
+        src_dir = self._uri.rstrip('/') + '/'
+        files = self.list_dir()
+        if sync:
+            target_files = CaperURI(target_dir).list_dir()
+            pending = [
+                rel for rel, stat in files.items()
+                if CaperURI.__is_changed(
+                    src_dir + rel, stat, target_dir + rel,
+                    target_files.get(rel))]
+            for rel in files:
+                if rel not in target_files or rel in pending:
+                    continue
+                CaperURI.TELEMETRY.record(CaperURI.TELEMETRY.new_event(
+                    'copy', src_type=self._uri_type, target_type=target_type,
+                    src=src_dir + rel, target=target_dir + rel,
+                    method='syncing', status='skipped'))
+        else:
+            pending = list(files)
+
+        cancel_event = getattr(CaperURI.THREAD_LOCAL, 'cancel_event', None)
+
+        def copy(rel):
+            with CaperURI.cancel_scope(cancel_event):
+                return CaperURI(src_dir + rel).copy(
+                    target_uri=target_dir + rel, soft_link=soft_link,
+                    overwrite=True)
+
+        if parallel and len(pending) > 1:
+            with ThreadPoolExecutor(CaperURI.DEEPCOPY_NUM_THREADS) as executor:
+                list(executor.map(copy, pending))
+        else:
+            for rel in pending:
+                copy(rel)
+
         if CaperURI.VERBOSE:
+            print('[CaperURI] {method} directory done, copied: {n}/{total}, '
+                  'target: {target}'.format(
+                    method='syncing' if sync else 'copying',
+                    n=len(pending), total=len(files), target=target_dir))
+        return target_dir
+
+    def __transfer_to(self, path, uri_type, method, soft_link=False,
+                      use_cache=False, event=None):
+        """Transfer self to a target path. It's called for each try
+        of a transfer (see __retry()) so it should start over or resume
+        a partial transfer. Bytes to be transferred are throttled by
+        bandwidth limits (see __throttle_bandwidth()).
+
+        Returns:
+            Tuple of (method, action, streamed). action is "skipped"
+            if target was already a complete copy (e.g. resumed URL).
+            streamed is (size, md5) of streamed contents or None.
+        """
+        CaperURI.check_cancelled()
+        action = 'done'
+        streamed = None
+        if use_cache and os.path.exists(path) \
+                and os.stat(path).st_nlink > 1:
+            # do not overwrite a cached object
+            # shared by hard links
+            os.remove(path)
+
+        # do copy
+        if CaperURI.STREAM_TRANSFER and \
+                uri_type in (URI_GCS, URI_S3) and \
+                self._uri_type in (URI_URL, URI_GCS, URI_S3) \
+                and self._uri_type != uri_type:
+            method = 'streaming'
+            streamed = self.__stream_to(path, event=event)
+
+        elif uri_type in (URI_GCS, URI_S3):
+            driver = CaperURI.get_storage_driver(path)
+            if self._uri_type == URI_URL:
+                assert(False)
+            CaperURI.__throttle_bandwidth(
+                self.get_file_size(), self._uri_type, uri_type, event=event)
+
+            if self._uri_type == URI_LOCAL:
+                num_parts = self.__upload_to(driver, path)
+                if num_parts > 1:
+                    method = 'copying ({} parts)'.format(num_parts)
+
+            elif self._uri_type in (URI_GCS, URI_S3):
+                src_driver = CaperURI.get_storage_driver(self._uri)
+                if driver.can_copy_from(src_driver):
+                    driver.copy(self._uri, path)
+                else:
+                    driver.write_stream(
+                        path, src_driver.iter_content(self._uri))
+            else:
+                raise NotImplementedError('uri_types: {}, {}'.format(
+                    self._uri_type, uri_type))
+
+        elif uri_type == URI_LOCAL:
+            if self._uri_type == URI_LOCAL:
+                if soft_link:
+                    method = 'symlinking'
+                    try:
+                        os.symlink(self._uri, path)
+                    except OSError as e:
+                        if e.errno == errno.EEXIST:
+                            os.remove(path)
+                            os.symlink(self._uri, path)
+                else:
+                    strategy = CaperURI.__copy_local(self._uri, path)
+                    method = 'copying ({})'.format(strategy)
+                    if strategy in (LOCAL_COPY_ZERO_COPY, LOCAL_COPY_COPY):
+                        # data are actually copied
+                        CaperURI.__throttle_bandwidth(
+                            os.path.getsize(path), URI_LOCAL, event=event)
+
+            elif self._uri_type == URI_URL:
+                if CaperURI.VERIFY_CHECKSUM and \
+                        os.path.exists(path) and \
+                        self.get_checksum() is not None:
+                    # path is not a partial copy of URL
+                    # since checksums are different
+                    os.remove(path)
+                # resume downloading if path exists
+                offset = os.path.getsize(path) if os.path.exists(path) else 0
+                size = self.get_file_size()
+                if size is not None:
+                    CaperURI.__throttle_bandwidth(
+                        size - offset, self._uri_type, uri_type, event=event)
+                if not CaperURI.HTTP.download(self._uri, path):
+                    action = 'skipped'
+                elif size is None:
+                    # URL without Content-Length
+                    CaperURI.__throttle_bandwidth(
+                        os.path.getsize(path) - offset,
+                        self._uri_type, uri_type, event=event)
+
+            elif self._uri_type in (URI_GCS, URI_S3):
+                CaperURI.__throttle_bandwidth(
+                    self.get_file_size(), self._uri_type, uri_type,
+                    event=event)
+                CaperURI.get_storage_driver(self._uri).download(
+                    self._uri, path)
+            else:
+                raise NotImplementedError('uri_types: {}, {}'.format(
+                    self._uri_type, uri_type))
+
+        else:
+            raise NotImplementedError('uri_type: {}'.format(uri_type))
+        return method, action, streamed
+
+    def __upload_to(self, driver, path):
+        """Upload a local file. A large file is uploaded in parts
+        (see StorageDriver.upload_parallel()) and states of them are
+        stored on TMP_DIR/MULTIPART_DIRNAME/ for resuming.
+
+        Returns:
+            Number of parts
+        """
+        if not CaperURI.MULTIPART_UPLOAD_PART_SIZE:
+            driver.upload(self._uri, path)
+            return 1
+        state_file = os.path.join(
+            CaperURI.TMP_DIR, CaperURI.MULTIPART_DIRNAME,
+            hashlib.md5('{}\n{}'.format(
+                self._uri, path).encode()).hexdigest() + '.json')
+        return driver.upload_parallel(
+            self._uri, path, CaperURI.MULTIPART_UPLOAD_PART_SIZE,
+            num_threads=CaperURI.MULTIPART_UPLOAD_NUM_THREADS,
+            state_file=state_file)
+
+    def get_file_contents(self, quiet=False):
+        """Get file contents
+        """
+        if CaperURI.VERBOSE and not quiet:
             print('[CaperURI] read from {src}, src: {uri}'.format(
                 src=self._uri_type, uri=self._uri))
 
-        if self._uri_type == URI_URL:
-            stdout, _, _, _ = CaperURI.__curl_auto_auth(
-                ['curl', '-L', '-f', self._uri])
-            return stdout
+        with CaperURI.TELEMETRY.measure(
+                'read', src_type=self._uri_type, src=self._uri) as event:
+            if self._uri_type == URI_URL:
+                s = CaperURI.__retry(
+                    lambda: CaperURI.HTTP.get_contents(self._uri),
+                    self._uri_type, event=event)
+
+            elif self._uri_type in (URI_GCS, URI_S3):
+                s = CaperURI.__retry(
+                    lambda: CaperURI.get_storage_driver(self._uri).read(
+                        self._uri),
+                    self._uri_type, event=event).decode()
+
+            elif self._uri_type == URI_LOCAL:
+                with open(self._uri, 'r') as fp:
+                    s = fp.read()
+            else:
+                raise NotImplementedError('uri_type: {}'.format(
+                    self._uri_type))
+            event['bytes'] = len(s)
+        return s
+
+    def iter_lines(self):
+        """Iterate over lines of file without reading the whole file
+        into memory. Files on cloud storages are streamed with
+        a storage driver.
+
+        Yields:
+            Decoded line with a trailing newline
+        """
+        if CaperURI.VERBOSE:
+            print('[CaperURI] stream from {src}, src: {uri}'.format(
+                src=self._uri_type, uri=self._uri))
 
-        elif self._uri_type == URI_GCS or self._uri_type == URI_S3 \
-                and CaperURI.USE_GSUTIL_OVER_AWS_S3:
-            return check_output(['gsutil', '-q', 'cat', self._uri]).decode()
+        if self._uri_type == URI_URL:
+            yield from CaperURI.HTTP.iter_lines(self._uri)
 
-        elif self._uri_type == URI_S3:
-            return check_output(['aws', 's3', 'cp', '--only-show-errors',
-                                 self._uri, '-']).decode()
+        elif self._uri_type in (URI_GCS, URI_S3):
+            yield from CaperURI.get_storage_driver(self._uri).iter_lines(
+                self._uri)
 
         elif self._uri_type == URI_LOCAL:
             with open(self._uri, 'r') as fp:
-                return fp.read()
+                yield from fp
         else:
             raise NotImplementedError('uri_type: {}'.format(
                 self._uri_type))
@@ -511,22 +1277,22 @@ class CaperURI(object):
     def get_file_size(self):
         """Get file size
         Returns:
-            File size in bytes or None (for all URLS,
-                hard to estimate file size for redirected URLs)
+            File size in bytes or None (for URLs without Content-Length
+                or with encoded contents). Total size of all files
+                for a directory.
         """
-        if self._uri_type == URI_URL:
-            return None
+        if self.is_dir():
+            return sum(size for size, _ in self.list_dir().values())
 
-        elif self._uri_type == URI_GCS or self._uri_type == URI_S3 \
-                and CaperURI.USE_GSUTIL_OVER_AWS_S3:
-            s = check_output(['gsutil', '-q', 'ls', '-l', self._uri]).decode()
-            # example ['1000982', '2019-05-21T21:06:47Z', ...]
-            return int(s.strip('\n').split()[0])
+        elif self._uri_type == URI_URL:
+            return CaperURI.__stat(self._uri)[1]
 
-        elif self._uri_type == URI_S3:
-            s = check_output(['aws', 's3', 'ls', self._uri]).decode()
-            # example ['2019-05-21', '14:06:47', '1000982', 'x.txt']
-            return int(s.strip('\n').split()[2])
+        elif self._uri_type in (URI_GCS, URI_S3):
+            exists, size, _ = CaperURI.__stat(self._uri)
+            if not exists:
+                raise FileNotFoundError(
+                    'File does not exist: {}'.format(self._uri))
+            return size
 
         elif self._uri_type == URI_LOCAL:
             return os.path.getsize(self._uri)
@@ -535,27 +1301,145 @@ class CaperURI(object):
             raise NotImplementedError('uri_type: {}'.format(
                 self._uri_type))
 
+    def get_checksum(self):
+        """Get MD5 hash of file. It's taken from metadata for cloud objects
+        and URLs. For local files, it's calculated once and cached on
+        TMP_DIR for each (inode, mtime, size).
+
+        Returns:
+            Hexadecimal MD5 hash or None if not available
+            (e.g. composite objects on GCS, multipart uploads on S3
+            and URLs without MD5 hash in headers).
+        """
+        if self._uri_type == URI_LOCAL:
+            return CaperURI.__get_local_md5(self._uri)
+
+        exists, _, checksum = CaperURI.__stat(self._uri)
+        if exists and checksum is None and \
+                self._uri_type in (URI_GCS, URI_S3):
+            # single file stat does not get metadata
+            exists, _, checksum = CaperURI.stat_many(
+                [self._uri], max_age_sec=0)[self._uri]
+        if not exists:
+            raise FileNotFoundError(
+                'File does not exist: {}'.format(self._uri))
+        return checksum
+
     def write_str_to_file(self, s, quiet=False):
         if CaperURI.VERBOSE and not quiet:
             print('[CaperURI] write to '
                   '{target}, target: {uri}, size: {size}'.format(
                     target=self._uri_type, uri=self._uri, size=len(s)))
 
-        if self._uri_type == URI_LOCAL:
-            os.makedirs(os.path.dirname(self._uri), exist_ok=True)
-            with open(self._uri, 'w') as fp:
-                fp.write(s)
-        elif self._uri_type == URI_GCS or self._uri_type == URI_S3 \
-                and CaperURI.USE_GSUTIL_OVER_AWS_S3:
-            p = Popen(['gsutil', '-q', 'cp', '-',
-                       self._uri], stdin=PIPE)
-            p.communicate(input=s.encode('ascii'))
-        elif self._uri_type == URI_S3:
-            p = Popen(['aws', 's3', 'cp', '--only-show-errors', '-',
-                       self._uri], stdin=PIPE)
-            p.communicate(input=s.encode('ascii'))
+        size = len(s.encode('ascii'))
+        with CaperURI.TELEMETRY.measure(
+                'write', target_type=self._uri_type, target=self._uri,
+                bytes=size) as event:
+            if self._uri_type == URI_LOCAL:
+                os.makedirs(os.path.dirname(self._uri), exist_ok=True)
+                with open(self._uri, 'w') as fp:
+                    fp.write(s)
+            elif self._uri_type in (URI_GCS, URI_S3):
+                CaperURI.__retry(
+                    lambda: CaperURI.get_storage_driver(self._uri).write(
+                        self._uri, s.encode('ascii')),
+                    self._uri_type, event=event)
+            else:
+                raise NotImplementedError('uri_type: {}'.format(
+                    self._uri_type))
+        CaperURI.__update_stat(self._uri, True, size)
+        return self._uri
+
+    def __iter_content(self):
+        """Stream contents of file chunk by chunk
+
+        Yields:
+            Bytes of STREAM_CHUNK_SIZE at most
+        """
+        if self._uri_type == URI_URL:
+            yield from CaperURI.HTTP.iter_content(self._uri)
+            return
+
+        elif self._uri_type in (URI_GCS, URI_S3):
+            yield from CaperURI.get_storage_driver(self._uri).iter_content(
+                self._uri, chunk_size=CaperURI.STREAM_CHUNK_SIZE)
+
+        elif self._uri_type == URI_LOCAL:
+            with open(self._uri, 'rb') as fp:
+                yield from iter(
+                    lambda: fp.read(CaperURI.STREAM_CHUNK_SIZE), b'')
         else:
-            raise NotImplementedError('uri_type: {}'.format(self._uri_type))
+            raise NotImplementedError('uri_type: {}'.format(
+                self._uri_type))
+
+    def __stream_to(self, path, event=None):
+        """Stream self to a cloud URI (path) with a storage driver
+        (e.g. through a pipe to CLI's stdin).
+        Only a chunk is kept in memory at a time and each chunk is
+        throttled by bandwidth limits. Uploaded file is
+        verified against size (and MD5 hash if VERIFY_CHECKSUM) of
+        streamed contents and it is removed if verification fails.
+
+        Returns:
+            Tuple of (size, md5) of streamed contents.
+        """
+        streamed = {'size': 0, 'md5': hashlib.md5()}
+        uri_type = CaperURI.__get_uri_type(path)
+
+        def iter_content():
+            for chunk in self.__iter_content():
+                CaperURI.check_cancelled()
+                CaperURI.__throttle_bandwidth(
+                    len(chunk), self._uri_type, uri_type, event=event)
+                streamed['size'] += len(chunk)
+                streamed['md5'].update(chunk)
+                yield chunk
+
+        CaperURI.get_storage_driver(path).write_stream(path, iter_content())
+        size = streamed['size']
+        md5 = streamed['md5'].hexdigest()
+
+        # verify uploaded file
+        cu = CaperURI(path)
+        exists, target_size, _ = CaperURI.__stat(path, max_age_sec=0)
+        if not exists or target_size != size:
+            error = 'size: {}, streamed: {}'.format(target_size, size)
+        elif CaperURI.VERIFY_CHECKSUM and \
+                cu.get_checksum() not in (None, md5):
+            error = 'md5: {}, streamed: {}'.format(cu.get_checksum(), md5)
+        else:
+            return size, md5
+        if exists:
+            cu.rm(quiet=True)
+        raise Exception('Verification failed after streaming. {}, '
+                        'src: {}, target: {}'.format(error, self._uri, path))
+
+    def __write_local_file(self, path):
+        """Move a local file (e.g. temporary file) to self.
+        """
+        size = os.path.getsize(path)
+        if CaperURI.VERBOSE:
+            print('[CaperURI] write to '
+                  '{target}, target: {uri}, size: {size}'.format(
+                    target=self._uri_type, uri=self._uri, size=size))
+
+        with CaperURI.TELEMETRY.measure(
+                'write', src_type=URI_LOCAL, target_type=self._uri_type,
+                src=path, target=self._uri, bytes=size) as event:
+            if self._uri_type == URI_LOCAL:
+                os.makedirs(os.path.dirname(self._uri), exist_ok=True)
+                shutil.move(path, self._uri)
+                return self._uri
+            elif self._uri_type in (URI_GCS, URI_S3):
+                CaperURI.__retry(
+                    lambda: CaperURI.get_storage_driver(self._uri).upload(
+                        path, self._uri),
+                    URI_LOCAL, self._uri_type, event=event)
+            else:
+                raise NotImplementedError('uri_type: {}'.format(
+                    self._uri_type))
+        os.remove(path)
+        CaperURI.__update_stat(self._uri, True, size)
         return self._uri
 
     def __get_rel_uri(self):
@@ -616,14 +1500,7 @@ class CaperURI(object):
 
             elif CaperURI.USE_PRESIGNED_URL_GCS:
                 assert(CaperURI.GCP_PRIVATE_KEY_FILE is not None)
-                s = check_output(
-                    ['gsutil', '-q', 'signurl', '-d',
-                     str(CaperURI.DURATION_SEC_PRESIGNED_URL_GCS) + 's',
-                     CaperURI.GCP_PRIVATE_KEY_FILE,
-                     self._uri]).decode()
-                # example: URL     HTTP Method     Expiration      Signed URL
-                # taking fourth column of line 2
-                url = s.strip('\n').split('\n')[1].split('\t')[3]
+                url = CaperURI.presign_many([self._uri])[self._uri]
                 if CaperURI.VERBOSE:
                     print('[CaperURI] presigned gcs url for {dur} sec. '
                           'src: {src}, url: {url}'.format(
@@ -635,11 +1512,8 @@ class CaperURI(object):
             return url
 
         elif self._uri_type == URI_S3:
-            if CaperURI.use_presigned_url_s3:
-                url = check_output(
-                    ['aws', 's3', 'presign', '--expires-in',
-                     CaperURI.DURATION_SEC_PRESIGNED_URL_S3,
-                     self._uri]).decode().strip('\n')
+            if CaperURI.USE_PRESIGNED_URL_S3:
+                url = CaperURI.presign_many([self._uri])[self._uri]
                 if CaperURI.VERBOSE:
                     print('[CaperURI] presigned s3 url for {dur} sec. '
                           'src: {src}, url: {url}'.format(
@@ -704,98 +1578,393 @@ class CaperURI(object):
             else:
                 self._can_deepcopy = False
             self._uri = os.path.abspath(path)
+        elif self._uri_type in (URI_GCS, URI_S3):
+            # a directory (prefix) is not deepcopied, same as
+            # a local directory
+            self._can_deepcopy = not self._uri.endswith('/')
         else:
             self._can_deepcopy = True
 
+    @staticmethod
+    def __deepcopy_values(values, uri_type, uri_exts, parallel=False,
+                          memo=None):
+        """Deepcopy each distinct value in values.
+        If parallel, all values are deepcopied on a thread pool.
+
+        Returns:
+            A dict of {value: (new_file, updated)}. Values that cannot
+            be a URI (see is_uri_candidate()) are not included.
+        """
+        match = CaperURI.RE_URI_CANDIDATE.match
+        unique_values = [v for v in OrderedDict.fromkeys(values) if match(v)]
+        CaperURI.__prefetch_stat(unique_values, uri_type, uri_exts)
+        if CaperURI.BATCH_TRANSFER:
+            CaperURI.__batch_transfer(unique_values, uri_type, uri_exts)
+        if uri_type == URI_URL:
+            CaperURI.__prefetch_presigned_urls(unique_values, uri_exts)
+
+        cancel_event = getattr(CaperURI.THREAD_LOCAL, 'cancel_event', None)
+        # nested files being deepcopied by callers (see deepcopy())
+        chain = getattr(CaperURI.THREAD_LOCAL, 'deepcopy_chain', ())
+
+        def deepcopy_value(v):
+            org_chain = getattr(CaperURI.THREAD_LOCAL, 'deepcopy_chain', ())
+            CaperURI.THREAD_LOCAL.deepcopy_chain = chain
+            try:
+                with CaperURI.cancel_scope(cancel_event):
+                    return CaperURI(v).deepcopy(
+                        uri_type=uri_type, uri_exts=uri_exts,
+                        parallel=parallel, memo=memo)
+            finally:
+                CaperURI.THREAD_LOCAL.deepcopy_chain = org_chain
+
+        if parallel and len(unique_values) > 1:
+            with ThreadPoolExecutor(CaperURI.DEEPCOPY_NUM_THREADS) as executor:
+                results = list(executor.map(deepcopy_value, unique_values))
+        else:
+            results = [deepcopy_value(v) for v in unique_values]
+        return dict(zip(unique_values, results))
+
+    @staticmethod
+    def __find_json_values(d, values):
+        """Find all string values in a JSON object recursively
+        """
+        if isinstance(d, dict):
+            for v in d.values():
+                CaperURI.__find_json_values(v, values)
+        elif isinstance(d, list):
+            for v in d:
+                CaperURI.__find_json_values(v, values)
+        elif isinstance(d, str):
+            values.append(d)
+        return values
+
+    @staticmethod
+    def __expand_json_globs(d):
+        """Expand glob patterns in string values of a JSON object in place
+        (see expand_globs()). A pattern without any match or existing as
+        a file is kept as it is since it can be a path with literal
+        wildcard characters. A pattern in a list is replaced with its
+        matches in place (e.g. ["a_*", "b"] to ["a_1", "a_2", "b"]).
+        Otherwise, it is replaced with a list of matches.
+
+        Returns:
+            True if any value is expanded
+        """
+        patterns = [
+            v for v in CaperURI.__find_json_values(d, [])
+            if CaperURI.RE_URI_CANDIDATE.match(v)
+            and CaperURI.RE_GLOB.search(v)
+            and CaperURI.__get_uri_type(v) != URI_URL]
+        if not patterns:
+            return False
+        new_files = {}
+        for pattern, matches in CaperURI.expand_globs(patterns).items():
+            if CaperURI.VERBOSE:
+                print('[CaperURI] expanded glob {} to {} files'.format(
+                    pattern, len(matches)))
+            if not matches:
+                print('[CaperURI] no files match glob pattern, '
+                      'kept as it is: {}'.format(pattern))
+            elif list(matches) != [CaperURI.__get_glob_path(pattern)]:
+                new_files[pattern] = list(matches)
+
+        updated = False
+        stack = [d] if isinstance(d, (dict, list)) else []
+        while stack:
+            node = stack.pop()
+            if isinstance(node, dict):
+                for k, v in node.items():
+                    if isinstance(v, str) and v in new_files:
+                        node[k] = new_files[v]
+                        updated = True
+                    elif isinstance(v, (dict, list)):
+                        stack.append(v)
+                continue
+            values = []
+            for v in node:
+                if isinstance(v, str) and v in new_files:
+                    values.extend(new_files[v])
+                    updated = True
+                else:
+                    values.append(v)
+                    if isinstance(v, (dict, list)):
+                        stack.append(v)
+            node[:] = values
+        return updated
+
+    @staticmethod
+    def __update_json_values(d, new_files):
+        """Replace string values in a JSON object in place with
+        deepcopied ones in a single pass.
+
+        Args:
+            new_files:
+                A dict of {value: (new_file, updated)}
+                (see __deepcopy_values())
+        Returns:
+            True if any value is replaced
+        """
+        updated = False
+        stack = [d] if isinstance(d, (dict, list)) else []
+        while stack:
+            node = stack.pop()
+            items = node.items() if isinstance(node, dict) \
+                else enumerate(node)
+            for k, v in items:
+                if isinstance(v, str):
+                    result = new_files.get(v)
+                    if result is not None and result[1]:
+                        # replacing a value of an existing key/index
+                        # is safe while iterating
+                        node[k] = result[0]
+                        updated = True
+                elif isinstance(v, (dict, list)):
+                    stack.append(v)
+        return updated
+
+    @staticmethod
+    def __prefetch_stat(values, uri_type, uri_exts):
+        """Resolve states of cloud sources/targets (and target .lock files)
+        of all transfers with stat_many() before any transfer starts.
+        Nested files (e.g. .tsv in .json) are resolved when they are
+        deepcopied. Values are classified without constructing CaperURI
+        first. Only values to be stat-ed are constructed.
+        """
+        uris = []
+        cloud = (URI_GCS, URI_S3)
+        for v in values:
+            src_uri_type = CaperURI.__get_uri_type(v)
+            if src_uri_type == uri_type or \
+                    src_uri_type not in cloud and uri_type not in cloud or \
+                    os.path.splitext(v)[1] in uri_exts:
+                continue
+            cu = CaperURI(v)
+            if not cu._can_deepcopy:
+                continue
+            if cu._uri_type in (URI_GCS, URI_S3):
+                uris.append(cu._uri)
+            if uri_type == URI_GCS:
+                target = cu.__get_gcs_file_name()
+            elif uri_type == URI_S3:
+                target = cu.__get_s3_file_name()
+            else:
+                continue
+            uris.extend([target, target + CaperURI.LOCK_EXT])
+        if len(uris) > 1:
+            CaperURI.stat_many(uris)
+
+    @staticmethod
+    def __prefetch_presigned_urls(values, uri_exts):
+        """Presign all cloud URIs in values at once with presign_many()
+        so that each URI is converted to a URL with a cached one.
+        """
+        uris = []
+        for v in values:
+            src_uri_type = CaperURI.__get_uri_type(v)
+            if os.path.splitext(v)[1] in uri_exts:
+                continue
+            if src_uri_type == URI_S3 and CaperURI.USE_PRESIGNED_URL_S3 or \
+                    src_uri_type == URI_GCS and \
+                    CaperURI.USE_PRESIGNED_URL_GCS and \
+                    not CaperURI.PUBLIC_GCS:
+                cu = CaperURI(v)
+                if cu._can_deepcopy:
+                    uris.append(cu._uri)
+        if len(uris) > 1:
+            CaperURI.presign_many(uris)
+
+    @staticmethod
+    def __batch_transfer(values, uri_type, uri_exts):
+        """Transfer files (from/to gs:// and s3://) in values as a batch
+        for each storage driver before they are deepcopied one by one.
+        Files to be deepcopied recursively (e.g. .tsv in .json) and URLs
+        are not included.
+
+        Targets are verified with stat_many() after a batch so that
+        deepcopying a value afterwards skips a successful transfer and
+        retries a failed one. Targets already copied or locked by others
+        are skipped. Targets are not locked during a batch since writing
+        a lock file on a bucket costs a CLI call for each file.
+        Storage drivers write a target atomically (an object on a bucket
+        or a temporary local file renamed on completion) so that
+        duplicate copies by other processes are harmless.
+        """
+        if uri_type not in (URI_LOCAL, URI_GCS, URI_S3):
+            return
+        batches = OrderedDict()
+        for v in values:
+            if CaperURI.__get_uri_type(v) in (uri_type, URI_URL) or \
+                    os.path.splitext(v)[1] in uri_exts:
+                continue
+            cu = CaperURI(v)
+            if not cu._can_deepcopy:
+                continue
+            if uri_type == URI_GCS:
+                target = cu.__get_gcs_file_name()
+            elif uri_type == URI_S3:
+                target = cu.__get_s3_file_name()
+            else:
+                target = cu.__get_local_file_name()
+
+            if cu._uri_type == URI_LOCAL:
+                driver = CaperURI.get_storage_driver(target)
+            elif uri_type == URI_LOCAL:
+                driver = CaperURI.get_storage_driver(cu._uri)
+            else:
+                driver = CaperURI.get_storage_driver(target)
+                if not driver.can_copy_from(
+                        CaperURI.get_storage_driver(cu._uri)):
+                    continue
+
+            lock_uri = target + CaperURI.LOCK_EXT
+            if uri_type == URI_LOCAL:
+                locked = os.path.exists(lock_uri)
+            else:
+                locked = CaperURI.__stat(
+                    lock_uri, max_age_sec=CaperURI.LOCK_STAT_MAX_AGE_SEC)[0]
+            if locked or cu.__is_copied_to(CaperURI(target)):
+                continue
+            batch = batches.setdefault(
+                (id(driver), cu._uri_type), (driver, []))[1]
+            batch.append((cu._uri, target))
+
+        for (_, src_uri_type), (driver, transfers) in batches.items():
+            if CaperURI.VERBOSE:
+                print('[CaperURI] batch transfer from {src} to {target}, '
+                      'num_files: {n}'.format(
+                        src=src_uri_type, target=uri_type,
+                        n=len(transfers)))
+            with CaperURI.TELEMETRY.measure(
+                    'batch_copy', src_type=src_uri_type, target_type=uri_type,
+                    num_files=len(transfers)) as event:
+                stack = CaperURI.THROTTLE.acquire(src_uri_type, uri_type)
+                event['throttle_wait'] = 0.0
+                try:
+                    CaperURI.__throttle_bandwidth(
+                        sum(CaperURI(src).get_file_size() or 0
+                            for src, _ in transfers),
+                        src_uri_type, uri_type, event=event)
+                    if uri_type == URI_LOCAL:
+                        for _, target in transfers:
+                            os.makedirs(os.path.dirname(target),
+                                        exist_ok=True)
+                            if os.path.exists(target) and \
+                                    os.stat(target).st_nlink > 1:
+                                # do not overwrite a cached object
+                                os.remove(target)
+                    # a batch holds a single transfer slot. bound
+                    # concurrency of a driver (e.g. gsutil -m) instead
+                    results = driver.transfer_many(
+                        transfers, num_threads=min(
+                            CaperURI.MAX_CONCURRENT_TRANSFERS.get(t, 1)
+                            for t in (src_uri_type, uri_type)))
+                finally:
+                    stack.close()
+
+                if uri_type == URI_LOCAL:
+                    for _, target in transfers:
+                        CaperURI.__invalidate_stat(target)
+                else:
+                    CaperURI.stat_many([t for _, t in transfers],
+                                       max_age_sec=0)
+                copied = [src for src, target in transfers
+                          if CaperURI(src).__is_copied_to(CaperURI(target))]
+                event['num_copied'] = len(copied)
+                event['bytes'] = sum(
+                    CaperURI(src).get_file_size() for src in copied)
+
+            if CaperURI.VERBOSE:
+                for (src, target), e in results.items():
+                    if e is not None:
+                        print('[CaperURI] batch transfer failed. it will be '
+                              'retried. src: {}, target: {}, error: {}'.format(
+                                src, target, e))
+
     def __deepcopy_tsv(self, uri_type=None, uri_exts=(), delim='\t',
-                       no_copy_root=False):
+                       no_copy_root=False, parallel=False, memo=None):
         if uri_type is None or len(uri_exts) == 0:
             return self._uri
         fname_wo_ext, ext = os.path.splitext(self._uri)
         assert(ext in ('.tsv', '.csv'))
 
-        contents = self.get_file_contents()
+        # stream rows chunk by chunk and write new rows
+        # on a temporary local file
+        tmp_dir = os.path.join(CaperURI.TMP_DIR, CaperURI.STREAM_TMP_DIRNAME)
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, tmp_f = tempfile.mkstemp(suffix=ext, dir=tmp_dir)
+        lines = self.iter_lines()
         updated = False
-
-        new_contents = []
-        for line in contents.split('\n'):
-            new_values = []
-            for v in line.split(delim):
-                c = CaperURI(v)
-                new_file, updated_ = c.deepcopy(
-                    uri_type=uri_type, uri_exts=uri_exts)
-                updated |= updated_
-                if updated_:
-                    new_values.append(new_file)
-                else:
-                    new_values.append(v)
-
-            new_contents.append(delim.join(new_values))
-
-        if updated:
-            new_uri = '{prefix}.{uri_type}{ext}'.format(
-                prefix=fname_wo_ext, uri_type=uri_type, ext=ext)
-            s = '\n'.join(new_contents)
-            if not no_copy_root:
-                new_uri = CaperURI(new_uri).get_file(uri_type=uri_type,
-                                                     no_copy=True)
-            cu = CaperURI(new_uri)
-            # we can't write on URLs
-            if cu.uri_type == URI_URL:
-                cu.set_uri_type_no_copy(uri_type)
-            return cu.write_str_to_file(s), updated
-        elif not no_copy_root and self._uri_type != uri_type:
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                while True:
+                    CaperURI.check_cancelled()
+                    chunk = list(islice(
+                        lines, CaperURI.DEEPCOPY_TSV_CHUNK_NUM_LINES))
+                    if not chunk:
+                        break
+                    rows = []
+                    for line in chunk:
+                        newline = '\n' if line.endswith('\n') else ''
+                        rows.append((line[:len(line) - len(newline)].split(
+                            delim), newline))
+                    new_files = CaperURI.__deepcopy_values(
+                        [v for row, _ in rows for v in row], uri_type,
+                        uri_exts, parallel=parallel, memo=memo)
+
+                    for row, newline in rows:
+                        new_values = []
+                        for v in row:
+                            result = new_files.get(v)
+                            if result is not None and result[1]:
+                                new_values.append(result[0])
+                                updated = True
+                            else:
+                                new_values.append(v)
+                        fp.write(delim.join(new_values) + newline)
+
+            if updated:
+                new_uri = '{prefix}.{uri_type}{ext}'.format(
+                    prefix=fname_wo_ext, uri_type=uri_type, ext=ext)
+                if not no_copy_root:
+                    new_uri = CaperURI(new_uri).get_file(uri_type=uri_type,
+                                                         no_copy=True)
+                cu = CaperURI(new_uri)
+                # we can't write on URLs
+                if cu.uri_type == URI_URL:
+                    cu.set_uri_type_no_copy(uri_type)
+                return cu.__write_local_file(tmp_f), updated
+        finally:
+            lines.close()
+            if os.path.exists(tmp_f):
+                os.remove(tmp_f)
+
+        if not no_copy_root and self._uri_type != uri_type:
             return self.get_file(uri_type=uri_type), True
         else:
             return self._uri, False
 
     def __deepcopy_json(self, uri_type=None, uri_exts=(),
-                        no_copy_root=False):
+                        no_copy_root=False, parallel=False, memo=None):
         if uri_type is None or len(uri_exts) == 0:
             return self._uri
         fname_wo_ext, ext = os.path.splitext(self._uri)
         assert(ext in ('.json'))
 
-        contents = self.get_file_contents()
-
-        def recurse_dict(d, uri_type, d_parent=None, d_parent_key=None,
-                         lst=None, lst_idx=None, updated=False):
-            if isinstance(d, dict):
-                for k, v in d.items():
-                    updated |= recurse_dict(v, uri_type, d_parent=d,
-                                            d_parent_key=k, updated=updated)
-            elif isinstance(d, list):
-                for i, v in enumerate(d):
-                    updated |= recurse_dict(v, uri_type, lst=d,
-                                            lst_idx=i, updated=updated)
-            elif isinstance(d, str):
-                assert(d_parent is not None or lst is not None)
-                c = CaperURI(d)
-                new_file, updated_ = c.deepcopy(
-                    uri_type=uri_type, uri_exts=uri_exts)
-                updated |= updated_
-
-                if updated_:
-                    if d_parent is not None:
-                        d_parent[d_parent_key] = new_file
-                    elif lst is not None:
-                        lst[lst_idx] = new_file
-                    else:
-                        raise ValueError('Recursion failed.')
-                return updated
-
-            return updated
-
-        org_d = json.loads(contents, object_pairs_hook=OrderedDict)
-        # make a copy to compare to original later
-        new_d = deepcopy(org_d)
-        # recurse for all values in new_d
-        updated = recurse_dict(new_d, uri_type)
+        # parsed JSON object is rewritten in place
+        # so that there is only one copy of it in memory
+        d = json.loads(self.get_file_contents(),
+                       object_pairs_hook=OrderedDict)
+        expanded = CaperURI.EXPAND_GLOB and CaperURI.__expand_json_globs(d)
+        # deepcopy all values first and then update them in d
+        new_files = CaperURI.__deepcopy_values(
+            CaperURI.__find_json_values(d, []), uri_type, uri_exts,
+            parallel=parallel, memo=memo)
+        updated = CaperURI.__update_json_values(d, new_files) or expanded
 
         if updated:
             new_uri = '{prefix}.{uri_type}{ext}'.format(
                 prefix=fname_wo_ext, uri_type=uri_type, ext=ext)
-            j = json.dumps(new_d, indent=4)
             if not no_copy_root:
                 new_uri = CaperURI(new_uri).get_file(uri_type=uri_type,
                                                      no_copy=True)
@@ -803,29 +1972,222 @@ class CaperURI(object):
             # we can't write on URLs
             if cu.uri_type == URI_URL:
                 cu.set_uri_type_no_copy(uri_type)
-            return cu.write_str_to_file(j), updated
+
+            # serialize directly to a temporary local file
+            # instead of making a whole JSON string
+            tmp_dir = os.path.join(CaperURI.TMP_DIR,
+                                   CaperURI.STREAM_TMP_DIRNAME)
+            os.makedirs(tmp_dir, exist_ok=True)
+            fd, tmp_f = tempfile.mkstemp(suffix=ext, dir=tmp_dir)
+            try:
+                with os.fdopen(fd, 'w') as fp:
+                    json.dump(d, fp, indent=4)
+                return cu.__write_local_file(tmp_f), updated
+            finally:
+                if os.path.exists(tmp_f):
+                    os.remove(tmp_f)
         elif not no_copy_root and self._uri_type != uri_type:
             return self.get_file(uri_type=uri_type), True
         else:
             return self._uri, False
 
     def deepcopy(self, uri_type=None, uri_exts=(),
-                 no_copy_root=False):
+                 no_copy_root=False, parallel=False, memo=None):
         """Supported file extensions: .json, .tsv and .csv
+
+        Args:
+            parallel:
+                Deepcopy all URIs found in a file on a thread pool.
+                Nested files (e.g. .tsv in .json) are rewritten
+                after all URIs in them are deepcopied.
+            memo:
+                A dict of {(URI, uri_type): Future} shared by all
+                recursive calls in a single deepcopy pass so that
+                each distinct URI is deepcopied only once. Created
+                automatically for the root call.
+        Raises:
+            ValueError if a nested file refers to itself directly or
+            through other nested files. A cycle across threads
+            (parallel) is found with a wait-for graph of nested files.
+        """
+        if memo is None:
+            memo = {}
+        CaperURI.check_cancelled()
+        # URIs (and the root) owned by callers in the current call chain.
+        # waiting for one of them would never end
+        chain = getattr(CaperURI.THREAD_LOCAL, 'deepcopy_chain', ())
+        key = (self._uri, uri_type)
+        if key in chain:
+            raise ValueError('Circular reference found while deepcopying: '
+                             '{}'.format(' -> '.join(
+                                [k[0] for k in chain] + [self._uri])))
+        if not self._can_deepcopy or no_copy_root:
+            return self.__deepcopy_in_chain(
+                chain, key, uri_type, uri_exts, no_copy_root=no_copy_root,
+                parallel=parallel, memo=memo)
+
+        # dict.setdefault is atomic so that only one thread
+        # (the owner of a new Future) deepcopies a URI.
+        # others wait for the result
+        new_future = Future()
+        future = memo.setdefault(key, new_future)
+        if future is not new_future:
+            if future.done():
+                return future.result()
+            with CaperURI.__depend_on(memo, chain, key, wait=True):
+                return future.result()
+        try:
+            with CaperURI.__depend_on(memo, chain, key):
+                result = self.__deepcopy_in_chain(
+                    chain, key, uri_type, uri_exts, parallel=parallel,
+                    memo=memo)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        future.set_result(result)
+        return result
+
+    @staticmethod
+    @contextmanager
+    def __depend_on(memo, chain, key, wait=False):
+        """Add an edge from a file being deepcopied by a caller
+        (the last one in chain) to a nested file (key) to a wait-for graph
+        shared by all threads in a deepcopy pass (memo).
+        Before waiting for another thread's Future (wait), check if it
+        already depends on the caller. Otherwise, both would wait forever.
+
+        Raises:
+            ValueError if waiting makes a cycle.
         """
+        if not chain:
+            yield
+            return
+        graph = CaperURI.DEEPCOPY_WAIT_FOR
+        node = (id(memo), chain[-1])
+        with CaperURI.DEEPCOPY_WAIT_FOR_LOCK:
+            if wait:
+                path = CaperURI.__find_wait_for_path(
+                    memo, key, chain[-1])
+                if path is not None:
+                    raise ValueError(
+                        'Circular reference found while deepcopying: '
+                        '{}'.format(' -> '.join(
+                            [k[0] for k in path] + [key[0]])))
+            graph.setdefault(node, []).append(key)
+        try:
+            yield
+        finally:
+            with CaperURI.DEEPCOPY_WAIT_FOR_LOCK:
+                graph[node].remove(key)
+                if not graph[node]:
+                    del graph[node]
+
+    @staticmethod
+    def __find_wait_for_path(memo, src, dest):
+        """Find a path from src to dest on a wait-for graph
+        (see __depend_on()).
+
+        Returns:
+            List of keys from src to dest or None if not found.
+        """
+        stack = [[src]]
+        visited = set()
+        while stack:
+            path = stack.pop()
+            if path[-1] == dest:
+                return path
+            if path[-1] in visited:
+                continue
+            visited.add(path[-1])
+            for k in CaperURI.DEEPCOPY_WAIT_FOR.get(
+                    (id(memo), path[-1]), ()):
+                stack.append(path + [k])
+        return None
+
+    def __deepcopy_in_chain(self, chain, key, *args, **kwargs):
+        CaperURI.THREAD_LOCAL.deepcopy_chain = chain + (key,)
+        try:
+            return self.__deepcopy(*args, **kwargs)
+        finally:
+            CaperURI.THREAD_LOCAL.deepcopy_chain = chain
+
+    def plan_deepcopy(self, uri_type=None, uri_exts=()):
+        """Plan a deepcopy without copying any file. Find all URIs in
+        self and nested files (with extensions in uri_exts) recursively
+        and resolve a target, size and action for each distinct file.
+        Nested files themselves are not planned since they are rewritten
+        after all files in them are copied (see CaperStage).
+
+        Returns:
+            List of dicts with src, target, size (None if not available)
+            and action ("copy", or "skip" if target is already a copy).
+        """
+        entries = OrderedDict()
+        self.__plan_deepcopy(uri_type, uri_exts, entries, set())
+        return list(entries.values())
+
+    def __plan_deepcopy(self, uri_type, uri_exts, entries, visited):
+        visited.add(self._uri)
+        ext = os.path.splitext(self._uri)[1]
+        if ext == '.json':
+            d = json.loads(self.get_file_contents())
+            if CaperURI.EXPAND_GLOB:
+                CaperURI.__expand_json_globs(d)
+            values = CaperURI.__find_json_values(d, [])
+        elif ext in ('.tsv', '.csv'):
+            delim = '\t' if ext == '.tsv' else ','
+            values = [v for line in self.iter_lines()
+                      for v in line.rstrip('\n').split(delim)]
+        else:
+            raise NotImplementedError('ext: {}.'.format(ext))
+
+        match = CaperURI.RE_URI_CANDIDATE.match
+        values = [v for v in OrderedDict.fromkeys(values) if match(v)]
+        CaperURI.__prefetch_stat(values, uri_type, uri_exts)
+        for v in values:
+            CaperURI.check_cancelled()
+            cu = CaperURI(v)
+            if not cu._can_deepcopy:
+                continue
+            if os.path.splitext(cu._uri)[1] in uri_exts:
+                if cu._uri not in visited:
+                    cu.__plan_deepcopy(uri_type, uri_exts, entries, visited)
+                continue
+            if cu._uri_type == uri_type or cu._uri in entries:
+                continue
+            if uri_type == URI_GCS:
+                target = cu.__get_gcs_file_name()
+            elif uri_type == URI_S3:
+                target = cu.__get_s3_file_name()
+            elif uri_type == URI_LOCAL:
+                target = cu.__get_local_file_name()
+            else:
+                raise NotImplementedError('uri_type: {}'.format(uri_type))
+            copied = cu.__is_copied_to(CaperURI(target))
+            entries[cu._uri] = OrderedDict([
+                ('src', cu._uri),
+                ('target', target),
+                ('size', cu.get_file_size()),
+                ('action', 'skip' if copied else 'copy')])
+
+    def __deepcopy(self, uri_type=None, uri_exts=(),
+                   no_copy_root=False, parallel=False, memo=None):
         fname_wo_ext, ext = os.path.splitext(self._uri)
 
         if self._can_deepcopy:
             if ext in uri_exts:
                 if ext == '.json':
                     return self.__deepcopy_json(uri_type, uri_exts,
-                                                no_copy_root=no_copy_root)
+                                                no_copy_root=no_copy_root,
+                                                parallel=parallel, memo=memo)
                 elif ext == '.tsv':
                     return self.__deepcopy_tsv(uri_type, uri_exts, delim='\t',
-                                               no_copy_root=no_copy_root)
+                                               no_copy_root=no_copy_root,
+                                               parallel=parallel, memo=memo)
                 elif ext == '.csv':
                     return self.__deepcopy_tsv(uri_type, uri_exts, delim=',',
-                                               no_copy_root=no_copy_root)
+                                               no_copy_root=no_copy_root,
+                                               parallel=parallel, memo=memo)
                 else:
                     NotImplementedError('ext: {}.'.format(ext))
 
@@ -835,23 +2197,235 @@ class CaperURI(object):
         return self._uri, False
 
     def rm(self, quiet=False):
-        """Remove file
+        """Remove file. A directory is removed with all files in it.
+        Files in a cloud directory are listed once and removed on
+        a thread pool.
         """
         if CaperURI.VERBOSE and not quiet:
             print('[CaperURI] remove {}'.format(self._uri))
-        if self._uri_type == URI_GCS or self._uri_type == URI_S3 \
-                and CaperURI.USE_GSUTIL_OVER_AWS_S3:
-            return check_call(['gsutil', '-q', 'rm', self._uri])
+        if self.is_dir():
+            if self._uri_type == URI_LOCAL:
+                with CaperURI.TELEMETRY.measure(
+                        'rm', target_type=self._uri_type, target=self._uri):
+                    shutil.rmtree(self._uri)
+                return
+            prefix = self._uri.rstrip('/') + '/'
+            cancel_event = getattr(CaperURI.THREAD_LOCAL, 'cancel_event',
+                                   None)
+
+            def rm(rel):
+                with CaperURI.cancel_scope(cancel_event):
+                    CaperURI(prefix + rel).rm(quiet=True)
+
+            with ThreadPoolExecutor(CaperURI.DEEPCOPY_NUM_THREADS) as executor:
+                list(executor.map(rm, self.list_dir()))
+            return
+        CaperURI.__invalidate_stat(self._uri)
+        with CaperURI.TELEMETRY.measure(
+                'rm', target_type=self._uri_type, target=self._uri) as event:
+            if self._uri_type in (URI_GCS, URI_S3):
+                CaperURI.__retry(
+                    lambda: CaperURI.get_storage_driver(self._uri).delete(
+                        self._uri),
+                    self._uri_type, event=event)
+                CaperURI.__update_stat(self._uri, False, None)
+
+            elif self._uri_type == URI_LOCAL:
+                os.remove(self._uri)
+            else:
+                raise NotImplementedError('uri_type: {}'.format(
+                    self._uri_type))
+
+    def __is_copied_to(self, cu_target):
+        """Check if target exists and it's a copy of self.
+        Sizes are compared first and then MD5 hashes are compared if
+        VERIFY_CHECKSUM and both are available.
+        A local copy of URL is revalidated with validators (ETag and
+        Last-Modified) stored on download if available (see CaperHTTP).
+        """
+        if not cu_target.file_exists():
+            return False
+        if self._uri_type == URI_URL and cu_target._uri_type == URI_LOCAL:
+            with CaperURI.TELEMETRY.measure(
+                    'stat', src_type=URI_URL, src=self._uri) as event:
+                downloaded = CaperURI.__retry(
+                    lambda: CaperURI.HTTP.is_downloaded(
+                        self._uri, cu_target._uri),
+                    URI_URL, event=event)
+                if downloaded is None:
+                    # no validators, nothing requested
+                    event['status'] = 'skipped'
+            if downloaded is not None:
+                return downloaded
+        size = self.get_file_size()
+        if size is not None and size != cu_target.get_file_size():
+            return False
+        if CaperURI.VERIFY_CHECKSUM:
+            checksum = self.get_checksum()
+            if checksum is not None:
+                target_checksum = cu_target.get_checksum()
+                if target_checksum is not None:
+                    return checksum == target_checksum
+        # size is not available for URLs
+        return size is not None
 
-        elif self._uri_type == URI_S3:
-            return check_call(['aws', 's3', 'rm', '--only-show-errors',
-                               self._uri])
+    @staticmethod
+    def __is_changed(src, src_stat, target, target_stat):
+        """Compare listed (size, checksum) of a source file and its
+        target for an incremental sync. Checksums are compared as
+        __is_copied_to() does. Local MD5 hashes are calculated (and
+        cached) only when needed.
+        """
+        if target_stat is None or src_stat[0] != target_stat[0]:
+            return True
+        if CaperURI.VERIFY_CHECKSUM:
+            checksums = []
+            for uri, (_, checksum) in ((src, src_stat),
+                                       (target, target_stat)):
+                if checksum is None and \
+                        CaperURI.__get_uri_type(uri) == URI_LOCAL:
+                    checksum = CaperURI.__get_local_md5(uri)
+                checksums.append(checksum)
+            if None not in checksums:
+                return checksums[0] != checksums[1]
+        return False
 
-        elif self._uri_type == URI_LOCAL:
-            os.remove(self._uri)
+    @staticmethod
+    def __copy_local(src, path):
+        """Copy a local file with the first successful strategy in
+        LOCAL_COPY_STRATEGIES. Metadata (e.g. mtime) is copied as
+        shutil.copy2() does. A copy is made on a temporary file and then
+        renamed to path so that an existing path (which can be a hard
+        link to another file) is never overwritten in place.
+
+        Returns:
+            Strategy used
+        """
+        tmp_path = '{}.{}.{}'.format(path, os.getpid(), threading.get_ident())
+        try:
+            for strategy in CaperURI.LOCAL_COPY_STRATEGIES:
+                try:
+                    if strategy == LOCAL_COPY_REFLINK:
+                        CaperURI.__reflink(src, tmp_path)
+                    elif strategy == LOCAL_COPY_HARDLINK:
+                        os.link(src, tmp_path)
+                    elif strategy == LOCAL_COPY_ZERO_COPY:
+                        CaperURI.__zero_copy(src, tmp_path)
+                    else:
+                        shutil.copy2(src, tmp_path)
+                except OSError:
+                    if strategy == LOCAL_COPY_COPY:
+                        raise
+                    if os.path.lexists(tmp_path):
+                        os.remove(tmp_path)
+                    continue
+                if strategy != LOCAL_COPY_HARDLINK:
+                    shutil.copystat(src, tmp_path)
+                os.replace(tmp_path, path)
+                return strategy
+        finally:
+            # rename does nothing if path is already a hard link to src
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+
+    @staticmethod
+    def __reflink(src, path):
+        with open(src, 'rb') as fsrc, open(path, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), CaperURI.FICLONE, fsrc.fileno())
+
+    @staticmethod
+    def __zero_copy(src, path):
+        """Copy in kernel with copy_file_range (Python >= 3.8) or
+        sendfile without reading data into user space.
+        """
+        if hasattr(os, 'copy_file_range'):
+            copy_range = os.copy_file_range
+        elif hasattr(os, 'sendfile'):
+            def copy_range(fd_src, fd_dst, count):
+                return os.sendfile(fd_dst, fd_src, None, count)
         else:
-            raise NotImplementedError('uri_type: {}'.format(
-                self._uri_type))
+            raise OSError(errno.ENOTSUP, 'Zero-copy is not supported.')
+
+        with open(src, 'rb') as fsrc, open(path, 'wb') as fdst:
+            while copy_range(fsrc.fileno(), fdst.fileno(),
+                             CaperURI.ZERO_COPY_CHUNK_SIZE):
+                pass
+
+    @staticmethod
+    def __get_local_md5(path):
+        """Get MD5 hash of a local file. Hash is stored on a sidecar file
+        on TMP_DIR with (inode, mtime, size) of the file so that the file
+        is hashed again only when it's changed.
+        """
+        path = os.path.abspath(os.path.expanduser(path))
+        st = os.stat(path)
+        key = [st.st_ino, st.st_mtime_ns, st.st_size]
+        h = hashlib.md5(path.encode('utf-8')).hexdigest()
+        sidecar = os.path.join(CaperURI.TMP_DIR, CaperURI.MD5_DIRNAME,
+                               h[:2], h)
+        try:
+            with open(sidecar, 'r') as fp:
+                d = json.loads(fp.read())
+            if d['key'] == key:
+                return d['md5']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        md5 = hashlib.md5()
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(CaperURI.MD5_CHUNK_SIZE), b''):
+                md5.update(chunk)
+        md5 = md5.hexdigest()
+
+        CaperURI.__write_sidecar(
+            sidecar, {'path': path, 'key': key, 'md5': md5})
+        return md5
+
+    @staticmethod
+    def __get_presign_duration(uri):
+        if uri.startswith('gs://'):
+            return CaperURI.DURATION_SEC_PRESIGNED_URL_GCS
+        return CaperURI.DURATION_SEC_PRESIGNED_URL_S3
+
+    @staticmethod
+    def __get_presigned_url_sidecar(uri, duration):
+        h = hashlib.md5('{}\t{}'.format(uri, duration).encode(
+            'utf-8')).hexdigest()
+        return os.path.join(CaperURI.TMP_DIR, CaperURI.PRESIGNED_URL_DIRNAME,
+                            h[:2], h)
+
+    @staticmethod
+    def __get_cached_presigned_url(uri, duration):
+        """
+        Returns:
+            Presigned URL or None if not cached or expiring soon.
+        """
+        sidecar = CaperURI.__get_presigned_url_sidecar(uri, duration)
+        try:
+            with open(sidecar, 'r') as fp:
+                d = json.loads(fp.read())
+            if d['uri'] == uri and d['duration'] == duration and \
+                    d['expires'] - time.time() > \
+                    CaperURI.PRESIGNED_URL_EXPIRY_MARGIN_SEC:
+                return d['url']
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+    @staticmethod
+    def __write_sidecar(sidecar, d, private=False):
+        """Write a dict on a sidecar file on TMP_DIR atomically.
+        A private sidecar (e.g. with a presigned URL) is readable by
+        owner only.
+        """
+        os.makedirs(os.path.dirname(sidecar), exist_ok=True)
+        tmp_sidecar = '{}.{}.{}'.format(sidecar, os.getpid(),
+                                          threading.get_ident())
+        fd = os.open(tmp_sidecar, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0o600 if private else 0o644)
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(json.dumps(d))
+        os.replace(tmp_sidecar, sidecar)
 
     @staticmethod
     def __get_uri_type(uri):
@@ -864,134 +2438,395 @@ class CaperURI(object):
         else:
             return URI_LOCAL
 
+    @staticmethod
+    def __throttle_bandwidth(num_bytes, *uri_types, event=None):
+        """Wait for bandwidth limits (MAX_TRANSFER_BANDWIDTH) of storage
+        types before (or after if size is not known) transferring
+        num_bytes. Waited time is added to event['throttle_wait'].
+        """
+        waited = CaperURI.THROTTLE.consume(
+            num_bytes, *uri_types, sleep=CaperURI.__sleep)
+        if event is not None:
+            event['throttle_wait'] += waited
+
+    @staticmethod
+    def __retry(func, *uri_types, event=None):
+        """Call func() with a retry policy (RETRY) on transient errors.
+        A rate-limit response pauses all operations on the same remote
+        storage, which is the last non-local one in uri_types
+        (i.e. target of a transfer if it's remote).
+        """
+        remote_uri_types = [t for t in uri_types if t != URI_LOCAL]
+        key = remote_uri_types[-1] if remote_uri_types else URI_LOCAL
+        return CaperURI.RETRY.run(func, key=key, event=event,
+                                  sleep=CaperURI.__sleep)
+
+    @staticmethod
+    def __sleep(sec):
+        """Sleep but wake up as soon as the current thread is cancelled
+        (see cancel_scope()).
+        """
+        cancel_event = getattr(CaperURI.THREAD_LOCAL, 'cancel_event', None)
+        if cancel_event is None:
+            time.sleep(sec)
+        else:
+            cancel_event.wait(sec)
+        CaperURI.check_cancelled()
+
     def __wait_for_lock(self):
-        # wait until .lock file disappears
-        it = 0
-        cu_lock = CaperURI(self._uri + CaperURI.LOCK_EXT)
-        while cu_lock.file_exists():
-            it += 1
-            if it > CaperURI.LOCK_MAX_ITER:
-                raise Exception('File has been locked for too long.', self._uri)
-            elif CaperURI.VERBOSE:
-                print('[CaperURI] wait {} sec for file being unlocked. '
-                      'retries: {}, max_retries: {}. uri: {}'.format(
-                        CaperURI.LOCK_WAIT_SEC, it,
-                        CaperURI.LOCK_MAX_ITER, self._uri))
-            time.sleep(CaperURI.LOCK_WAIT_SEC)
+        """Wait until self is unlocked.
+        For a local file, wait on flock of .lock file and wake up
+        as soon as it is released. A lock of a killed process is
+        released automatically.
+        Otherwise, poll .lock file with exponential backoff. A lock is
+        stale if its lease has expired or its owner process has died.
+        """
+        lock_uri = self._uri + CaperURI.LOCK_EXT
+        if self._uri_type == URI_LOCAL:
+            try:
+                fd = os.open(lock_uri, os.O_RDONLY)
+            except FileNotFoundError:
+                return
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    if CaperURI.VERBOSE:
+                        print('[CaperURI] wait for file being unlocked. '
+                              'owner: {}, uri: {}'.format(
+                                CaperURI.__read_lock_record(lock_uri),
+                                self._uri))
+                    with CaperURI.TELEMETRY.measure(
+                            'lock_wait', target_type=self._uri_type,
+                            target=self._uri):
+                        fcntl.flock(fd, fcntl.LOCK_SH)
+                return
+            except OSError as e:
+                # flock is not supported (e.g. some network filesystems)
+                if e.errno not in CaperURI.ERRNO_FLOCK_NOT_SUPPORTED:
+                    raise
+            finally:
+                os.close(fd)
+
+        # lock can be created/removed by other processes.
+        # use a cached stat only if it's resolved very recently
+        # (e.g. by stat_many() before deepcopy) and then do not use cache
+        if not CaperURI.__stat(
+                lock_uri, max_age_sec=CaperURI.LOCK_STAT_MAX_AGE_SEC)[0]:
+            return
+        delay = CaperURI.LOCK_POLL_MIN_SEC
+        waited = 0
+        with CaperURI.TELEMETRY.measure(
+                'lock_wait', target_type=self._uri_type,
+                target=self._uri) as event:
+            while True:
+                record = CaperURI.__read_lock_record(lock_uri)
+                if CaperURI.__is_stale_lock(record, waited):
+                    if CaperURI.VERBOSE:
+                        print('[CaperURI] remove stale lock. owner: {}, '
+                              'uri: {}'.format(record, self._uri))
+                    event['stale'] = True
+                    try:
+                        CaperURI(lock_uri).rm(quiet=True)
+                    except (CalledProcessError, FileNotFoundError):
+                        pass
+                    return
+                CaperURI.check_cancelled()
+                if waited >= CaperURI.LOCK_MAX_WAIT_SEC:
+                    raise Exception('File has been locked for too long.',
+                                    self._uri)
+                elif CaperURI.VERBOSE:
+                    print('[CaperURI] wait {} sec for file being unlocked. '
+                          'waited: {} sec, owner: {}, uri: {}'.format(
+                            delay, waited, record, self._uri))
+                CaperURI.__sleep(delay)
+                waited += delay
+                delay = min(delay * 2, CaperURI.LOCK_POLL_MAX_SEC)
+                if not CaperURI.__stat(lock_uri, max_age_sec=0)[0]:
+                    return
+
+    def __lock(self):
+        """Lock self (target of a transfer) by creating .lock file,
+        which records hostname and PID of the owner.
+        For a local file, .lock file is exclusively locked with flock.
+        Otherwise, lease of a lock is renewed on a background thread
+        until it is released.
+
+        Returns:
+            ExitStack object. Call close() on it to release a lock.
+        """
+        lock_uri = self._uri + CaperURI.LOCK_EXT
+        stack = ExitStack()
+        if self._uri_type == URI_LOCAL:
+            fd = CaperURI.__flock_exclusive(lock_uri)
+            if fd is not None:
+                stack.callback(CaperURI.__funlock, lock_uri, fd)
+                return stack
+
+        cu_lock = CaperURI(lock_uri)
+        cu_lock.write_str_to_file(CaperURI.__new_lock_record(), quiet=True)
+        stop = threading.Event()
+
+        def renew_lease():
+            while not stop.wait(CaperURI.LOCK_LEASE_SEC / 3):
+                try:
+                    cu_lock.write_str_to_file(
+                        CaperURI.__new_lock_record(), quiet=True)
+                except Exception as e:
+                    print('[CaperURI] failed to renew lock. '
+                          'uri: {}, error: {}'.format(lock_uri, e))
+
+        def release():
+            stop.set()
+            th.join()
+            cu_lock.rm(quiet=True)
+
+        th = threading.Thread(target=renew_lease, daemon=True)
+        th.start()
+        stack.callback(release)
+        return stack
 
     @staticmethod
-    def __file_exists(uri):
+    def __flock_exclusive(lock_path):
+        """Create a .lock file and lock it exclusively.
+
+        Returns:
+            File descriptor or None if flock is not supported.
+        """
+        while True:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                # previous owner removes .lock file before releasing it
+                # so make sure that we locked the current one
+                try:
+                    locked = os.fstat(fd).st_ino == os.stat(lock_path).st_ino
+                except FileNotFoundError:
+                    locked = False
+                if locked:
+                    os.ftruncate(fd, 0)
+                    os.write(fd, CaperURI.__new_lock_record().encode())
+                    return fd
+            except OSError as e:
+                os.close(fd)
+                if e.errno in CaperURI.ERRNO_FLOCK_NOT_SUPPORTED:
+                    return None
+                raise
+            os.close(fd)
+
+    @staticmethod
+    def __funlock(lock_path, fd):
+        try:
+            os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+    @staticmethod
+    def __new_lock_record():
+        return json.dumps({
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'expires': time.time() + CaperURI.LOCK_LEASE_SEC})
+
+    @staticmethod
+    def __read_lock_record(lock_uri):
+        """
+        Returns:
+            A dict of lock record or None if not available
+            (e.g. an empty .lock file created by an old version of Caper).
+        """
+        try:
+            record = json.loads(CaperURI(lock_uri).get_file_contents(
+                quiet=True))
+        except Exception:
+            return None
+        return record if isinstance(record, dict) else None
+
+    @staticmethod
+    def __is_stale_lock(record, waited):
+        if record is None:
+            # no expiry stamp. assume it has expired after a lease
+            return waited >= CaperURI.LOCK_LEASE_SEC
+        if record.get('host') == socket.gethostname():
+            try:
+                os.kill(record.get('pid'), 0)
+            except ProcessLookupError:
+                return True
+            except (PermissionError, TypeError):
+                pass
+        return time.time() > record.get('expires', 0)
+
+    @staticmethod
+    def __stat(uri, max_age_sec=None):
+        """Check if file exists and get its size. Results for cloud URIs
+        and URLs are cached for STAT_CACHE_TTL_SEC.
+
+        Args:
+            max_age_sec:
+                Use a cached result younger than this.
+                Defaults to STAT_CACHE_TTL_SEC. 0 to bypass cache.
+        Returns:
+            Tuple of (exists, size, checksum). size is None for URLs or
+            if file does not exist. checksum is available if storage
+            driver or URL's headers provide it.
+        """
         uri_type = CaperURI.__get_uri_type(uri)
         if uri_type == URI_LOCAL:
             path = os.path.expanduser(uri)
-            return os.path.isfile(path)
+            if os.path.isfile(path):
+                return True, os.path.getsize(path), None
+            return False, None, None
+
+        cached = CaperURI.__get_cached_stat(uri, max_age_sec)
+        if cached is not None:
+            return cached
+
+        with CaperURI.TELEMETRY.measure(
+                'stat', src_type=uri_type, src=uri) as event:
+            if uri_type == URI_URL:
+                exists, size, checksum = CaperURI.__retry(
+                    lambda: CaperURI.HTTP.stat(uri), uri_type, event=event)
+            elif uri_type in (URI_GCS, URI_S3):
+                exists, size, checksum = CaperURI.__retry(
+                    lambda: CaperURI.get_storage_driver(uri).stat(uri),
+                    uri_type, event=event)
+            else:
+                raise NotImplementedError('uri_type: {}'.format(uri_type))
+            event['exists'] = exists
+        CaperURI.__update_stat(uri, exists, size, checksum)
+        return exists, size, checksum
+
+    @staticmethod
+    def __get_cached_stat(uri, max_age_sec=None):
+        """
+        Returns:
+            Cached (exists, size, checksum) or None if not found or expired.
+        """
+        if max_age_sec is None:
+            max_age_sec = CaperURI.STAT_CACHE_TTL_SEC
         else:
-            try:
-                if uri_type == URI_URL:
-                    # ignore 416, 404, 403 since it's just a checking
-                    _, _, rc, _ = CaperURI.__curl_auto_auth(
-                        ['curl', '--head', '-f', uri],
-                        ignored_http_err=(416, 404, 403, 401))
-                elif uri_type == URI_GCS or uri_type == URI_S3 \
-                        and CaperURI.USE_GSUTIL_OVER_AWS_S3:
-                    rc = check_call(['gsutil', '-q', 'ls', uri], stderr=PIPE)
-                elif uri_type == URI_S3:
-                    s = check_output(['aws', 's3', 'ls', uri], stderr=PIPE).decode()
-                    rc = 1
-                    for line in s.strip('\n').split('\n'):
-                        basename = line.split()[-1]
-                        if basename == os.path.basename(uri):
-                            rc = 0
-                            break
-                else:
-                    raise NotImplementedError('uri_type: {}'.format(uri_type))
-            except CalledProcessError as e:
-                rc = e.returncode
-            return rc == 0
+            max_age_sec = min(max_age_sec, CaperURI.STAT_CACHE_TTL_SEC)
+        cached = CaperURI.STAT_CACHE.get(uri)
+        if cached is not None and time.time() - cached[0] < max_age_sec:
+            return cached[1:]
+        return None
 
     @staticmethod
-    def __curl_auto_auth(cmd_wo_auth, ignored_http_err=()):
-        """Try without HTTP auth first if it fails then try with auth
+    def __update_stat(uri, exists, size, checksum=None):
+        if CaperURI.__get_uri_type(uri) != URI_LOCAL:
+            CaperURI.STAT_CACHE[uri] = (time.time(), exists, size, checksum)
+
+    @staticmethod
+    def __invalidate_stat(uri):
+        CaperURI.STAT_CACHE.pop(uri, None)
+
+    @staticmethod
+    def __list_prefix(prefix, recursive):
+        """List files in a local directory or a cloud prefix for glob
+        expansion.
 
         Returns:
-            stdout: decoded STDOUT
-            stderr: decoded STDERR
-            rc: return code
+            A dict of {uri: size}
         """
-        try:
-            # print http_code to STDOUT
-            cmd_wo_auth = cmd_wo_auth + [
-                '-w', CaperURI.CURL_HTTP_ERROR_WRITE_OUT]
-
-            p = Popen(cmd_wo_auth, stdout=PIPE, stderr=PIPE)
-            stdout, stderr = p.communicate()
-            stdout = stdout.decode()
-            stderr = stderr.decode()
-            rc = p.returncode
-            # parse stdout to get http_error
-            m = re.findall(CaperURI.RE_PATTERN_CURL_HTTP_ERR, stdout)
-            if len(m) > 0:
-                http_err = int(m[-1])
-                # remove error code from stdout
-                stdout = CaperURI.CURL_HTTP_ERROR_PREFIX.join(
-                    stdout.split(CaperURI.CURL_HTTP_ERROR_PREFIX)[:-1])
-            else:
-                http_err = None
+        if CaperURI.__get_uri_type(prefix) == URI_LOCAL:
+            result = {}
+            for d, dirs, files in os.walk(prefix):
+                for f in files:
+                    path = os.path.join(d, f)
+                    if os.path.isfile(path):
+                        result[path] = os.path.getsize(path)
+                if not recursive:
+                    break
+            return result
+
+        uri_type = CaperURI.__get_uri_type(prefix)
+        if CaperURI.VERBOSE:
+            print('[CaperURI] listing {} for glob, recursive: {}'.format(
+                prefix, recursive))
+        with CaperURI.TELEMETRY.measure(
+                'list', src_type=uri_type, src=prefix,
+                recursive=recursive) as event:
+            objects = CaperURI.__retry(
+                lambda: CaperURI.get_storage_driver(prefix).list(
+                    prefix, recursive=recursive),
+                uri_type, event=event)
+            event['num_objects'] = len(objects)
+        result = {}
+        for uri, (size, checksum) in objects.items():
+            CaperURI.__update_stat(uri, True, size, checksum)
+            result[uri] = size
+        return result
 
-            if CaperURI.HTTP_USER is None and not CaperURI.USE_NETRC:
-                # if auth info is not given
-                pass
-            elif http_err in (401, 403):  # permission or auth http error
-                if CaperURI.VERBOSE:
-                    print('[CaperURI] got HTTP_ERR {}. wait for {} seconds. '
-                          're-trying with auth...'.format(
-                            http_err, CaperURI.DELAY_SEC_CURL_AUTH))
-                time.sleep(CaperURI.DELAY_SEC_CURL_AUTH)
-
-                # now try with AUTH
-                if CaperURI.USE_NETRC:
-                    cmd_w_auth = cmd_wo_auth + ['-n']
-                else:
-                    cmd_w_auth = cmd_wo_auth + [
-                        '-u', '{}:{}'.format(CaperURI.HTTP_USER,
-                                             CaperURI.HTTP_PASSWORD)]
-                p = Popen(cmd_w_auth, stdout=PIPE, stderr=PIPE)
-                stdout, stderr = p.communicate()
-                stdout = stdout.decode()
-                stderr = stderr.decode()
-                rc = p.returncode
-
-                # parse stdout to get http_error
-                m = re.findall(CaperURI.RE_PATTERN_CURL_HTTP_ERR, stdout)
-                if len(m) > 0:
-                    http_err = int(m[-1])
-                    if CaperURI.CURL_HTTP_ERROR_PREFIX in stdout:
-                        # remove error code from stdout
-                        stdout = CaperURI.CURL_HTTP_ERROR_PREFIX.join(
-                            stdout.split(
-                                CaperURI.CURL_HTTP_ERROR_WRITE_OUT)[:-1])
+    @staticmethod
+    def __get_glob_path(pattern):
+        """Absolute path for a local glob pattern. Cloud URI as it is.
+        """
+        if CaperURI.__get_uri_type(pattern) == URI_LOCAL:
+            return os.path.abspath(os.path.expanduser(pattern))
+        return pattern
+
+    @staticmethod
+    def __glob_to_regex(pattern):
+        """Translate a glob pattern into a regular expression.
+        Unlike fnmatch, wildcards do not match a slash (/) except for **.
+        """
+        regex = []
+        i = 0
+        while i < len(pattern):
+            c = pattern[i]
+            if pattern.startswith('**/', i):
+                regex.append('(?:.*/)?')
+                i += 3
+                continue
+            elif pattern.startswith('**', i):
+                regex.append('.*')
+                i += 2
+                continue
+            elif c == '*':
+                regex.append('[^/]*')
+            elif c == '?':
+                regex.append('[^/]')
+            elif c == '[':
+                j = pattern.find(']', i + 2)
+                if j < 0:
+                    regex.append(re.escape(c))
                 else:
-                    http_err = None
+                    chars = pattern[i + 1:j].replace('\\', '\\\\')
+                    if chars.startswith('!'):
+                        chars = '^' + chars[1:]
+                    regex.append('[{}]'.format(chars))
+                    i = j + 1
+                    continue
+            else:
+                regex.append(re.escape(c))
+            i += 1
+        return re.compile(''.join(regex) + r'\Z')
 
-        except CalledProcessError as e:
-            stdout = None
-            stderr = None
-            rc = e.returncode
-            http_err = None
+    @staticmethod
+    def __group_by_prefix(uris):
+        """Group cloud URIs by their directories. A directory is listed
+        non-recursively so that a listing is bounded by the number of
+        files in it. Directories are never merged into a common parent
+        since it (e.g. TMP_GCS_BUCKET) can have any number of files under
+        it. A single URI in a directory is grouped with itself as a
+        prefix, which lists only objects starting with it.
+
+        Returns:
+            A dict of {prefix: [uri, ...]}
+        """
+        dirs = OrderedDict()
+        for uri in uris:
+            dirs.setdefault(uri.rsplit('/', 1)[0] + '/', []).append(uri)
+
+        groups = OrderedDict()
+        for dirname, uris_ in dirs.items():
+            if len(uris_) == 1:
+                groups[uris_[0]] = uris_
+            else:
+                groups[dirname] = uris_
+        return groups
 
-        if rc == 0 or http_err in (200,):  # OKAY
-            pass
-        elif http_err in ignored_http_err:
-            # range request bug in curl
-            if http_err in (416,):
-                if CaperURI.VERBOSE:
-                    print('[CaperURI] file already exists. '
-                          'skip downloading and ignore HTTP_ERR 416')
-        else:
-            raise Exception(
-                'cURL RC: {}, HTTP_ERR: {}, STDERR: {}'.format(
-                    rc, http_err, stderr))
-        return stdout, stderr, rc, http_err
 
 def main():
     """To test CaperURI
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""AsyncCaperURI: asyncio API for CaperURI
+
+Author:
+    Jin Lee (leepc12@gmail.com) at ENCODE-DCC
+"""
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .caper_uri import CaperURI
+
+
+class AsyncCaperURI(object):
+    """asyncio API for CaperURI. Each operation runs a synchronous
+    CaperURI method on a shared thread pool so that an event loop is
+    never blocked. Many operations can run concurrently from a single
+    event loop thread. Initialize CaperURI with init_caper_uri() first.
+
+    Example:
+        async def main():
+            cu = AsyncCaperURI('gs://bucket/a.json')
+            if await cu.file_exists():
+                new_json, _ = await cu.deepcopy(URI_LOCAL, ('.json',))
+
+    Cancelling a task (e.g. task.cancel() or asyncio.wait_for() timeout)
+    cancels an operation. An operation not started yet is not run at all.
+    A running operation stops at the next checkpoint (before each file
+    transfer, while waiting for a lock and between chunks of streaming;
+    see CaperURI.check_cancelled()) and releases its locks and transfer
+    slots. A running subprocess (e.g. gsutil cp) is not interrupted.
+    Cancellation returns immediately without waiting for a checkpoint.
+    """
+
+    # number of threads in a shared thread pool
+    NUM_THREADS = 16
+    EXECUTOR = None
+    EXECUTOR_LOCK = threading.Lock()
+
+    def __init__(self, uri_or_path):
+        if isinstance(uri_or_path, CaperURI):
+            self._cu = uri_or_path
+        else:
+            self._cu = CaperURI(uri_or_path)
+
+    def __str__(self):
+        return str(self._cu)
+
+    @property
+    def uri_type(self):
+        return self._cu.uri_type
+
+    def get_uri(self):
+        return self._cu.get_uri()
+
+    def get_caper_uri(self):
+        """
+        Returns:
+            Synchronous CaperURI object
+        """
+        return self._cu
+
+    async def file_exists(self):
+        return await AsyncCaperURI.__run(self._cu.file_exists)
+
+    async def get_file_size(self):
+        return await AsyncCaperURI.__run(self._cu.get_file_size)
+
+    async def get_checksum(self):
+        return await AsyncCaperURI.__run(self._cu.get_checksum)
+
+    async def get_file_contents(self):
+        return await AsyncCaperURI.__run(self._cu.get_file_contents)
+
+    async def write_str_to_file(self, s):
+        return await AsyncCaperURI.__run(self._cu.write_str_to_file, s)
+
+    async def get_file(self, uri_type, no_copy=False):
+        return await AsyncCaperURI.__run(
+            self._cu.get_file, uri_type, no_copy=no_copy)
+
+    async def list_dir(self):
+        return await AsyncCaperURI.__run(self._cu.list_dir)
+
+    async def copy(self, target_uri_type=None, target_uri=None,
+                   soft_link=False, no_copy=False, overwrite=False):
+        return await AsyncCaperURI.__run(
+            self._cu.copy, target_uri_type=target_uri_type,
+            target_uri=target_uri, soft_link=soft_link, no_copy=no_copy,
+            overwrite=overwrite)
+
+    async def copy_dir(self, target_uri, sync=False, soft_link=False,
+                       parallel=True):
+        return await AsyncCaperURI.__run(
+            self._cu.copy_dir, target_uri, sync=sync, soft_link=soft_link,
+            parallel=parallel)
+
+    async def deepcopy(self, uri_type=None, uri_exts=(),
+                       no_copy_root=False, parallel=False):
+        """See CaperURI.deepcopy(). Cancellation stops all transfers
+        of a deepcopy, including those on a thread pool if parallel.
+        """
+        return await AsyncCaperURI.__run(
+            self._cu.deepcopy, uri_type=uri_type, uri_exts=uri_exts,
+            no_copy_root=no_copy_root, parallel=parallel)
+
+    async def rm(self, quiet=False):
+        return await AsyncCaperURI.__run(self._cu.rm, quiet=quiet)
+
+    @staticmethod
+    async def stat_many(uris, max_age_sec=None):
+        return await AsyncCaperURI.__run(
+            CaperURI.stat_many, uris, max_age_sec=max_age_sec)
+
+    @staticmethod
+    async def __run(func, *args, **kwargs):
+        cancel_event = threading.Event()
+
+        def run():
+            with CaperURI.cancel_scope(cancel_event):
+                return func(*args, **kwargs)
+
+        future = AsyncCaperURI.__get_executor().submit(run)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            cancel_event.set()
+            future.cancel()
+            raise
+
+    @staticmethod
+    def __get_executor():
+        with AsyncCaperURI.EXECUTOR_LOCK:
+            if AsyncCaperURI.EXECUTOR is None:
+                AsyncCaperURI.EXECUTOR = ThreadPoolExecutor(
+                    AsyncCaperURI.NUM_THREADS)
+            return AsyncCaperURI.EXECUTOR
@@ -22,5 +22,6 @@ setuptools.setup(
         'License :: OSI Approved :: MIT License',
         'Operating System :: POSIX :: Linux',
     ],
-    install_requires=['pyhocon', 'requests', 'pyopenssl']
+    install_requires=['pyhocon', 'requests', 'pyopenssl'],
+    extras_require={'sdk': ['google-cloud-storage', 'boto3']}
 )
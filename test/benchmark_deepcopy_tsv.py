@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""Benchmark for deepcopying a large TSV to an emulated gs:// bucket
+
+Most cells of a TSV (sample names, numbers and flags) cannot be a URI.
+This measures time to deepcopy it and number of CaperURI objects
+constructed for it. Not collected by pytest.
+
+Usage:
+    python test/benchmark_deepcopy_tsv.py --rows 100000 --cols 10 \
+        --file-every 1000
+
+Author:
+    Jin Lee (leepc12@gmail.com) at ENCODE-DCC
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+try:
+    import caper
+except:
+    import sys, os
+    script_path = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(os.path.join(script_path, '../'))
+    import caper
+
+from caper import caper_uri
+from caper.caper_uri import CaperURI, URI_GCS
+
+
+def write_tsv(root, num_rows, num_cols, file_every):
+    """A local file path for every file_every rows in the first column.
+    Other cells are not URIs.
+    """
+    data_dir = os.path.join(root, 'data')
+    os.makedirs(data_dir)
+    tsv = os.path.join(root, 'samples.tsv')
+    with open(tsv, 'w') as fp:
+        for i in range(num_rows):
+            if i % file_every:
+                path = 'sample{}_rep1'.format(i)
+            else:
+                path = os.path.join(data_dir, '{}.txt'.format(i))
+                with open(path, 'w') as fp_data:
+                    fp_data.write(str(i))
+            row = [path, 'sample{}'.format(i), str(i), '0.5', 'true']
+            row += ['x{}'.format(j) for j in range(num_cols - len(row))]
+            fp.write('\t'.join(row[:num_cols]) + '\n')
+    return tsv
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--cols', type=int, default=10)
+    parser.add_argument('--file-every', type=int, default=1000)
+    parser.add_argument('--parallel', action='store_true')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        caper_uri.init_caper_uri(
+            tmp_dir=os.path.join(root, 'tmp_dir'),
+            tmp_gcs_bucket='gs://tmp-bucket/caper',
+            storage_driver='emulated',
+            emulated_storage_dir=os.path.join(root, 'buckets'))
+        tsv = write_tsv(root, args.rows, args.cols, args.file_every)
+
+        # count CaperURI objects
+        num_objects = [0]
+        init = CaperURI.__init__
+
+        def count_init(self, uri_or_path):
+            num_objects[0] += 1
+            init(self, uri_or_path)
+
+        CaperURI.__init__ = count_init
+        try:
+            start = time.time()
+            CaperURI(tsv).deepcopy(URI_GCS, uri_exts=('.tsv',),
+                                   parallel=args.parallel)
+            elapsed = time.time() - start
+        finally:
+            CaperURI.__init__ = init
+        print('cells: {}, elapsed: {:.2f} sec, CaperURI objects: {}'.format(
+            args.rows * args.cols, elapsed, num_objects[0]))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
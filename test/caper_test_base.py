@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""Base TestCase for CaperURI on an emulated object store
+
+Author:
+    Jin Lee (leepc12@gmail.com) at ENCODE-DCC
+"""
+
+import unittest
+import os
+import shutil
+import tempfile
+
+try:
+    import caper
+except:
+    import sys, os
+    script_path = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(os.path.join(script_path, '../'))
+    import caper
+
+from caper import caper_uri
+
+
+class CaperURIEmulatedTestCase(unittest.TestCase):
+    """gs:// and s3:// are emulated on a local directory in a temporary
+    root. Local files are written to a data directory in it.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.data_dir = os.path.join(self.root, 'data')
+        os.makedirs(self.data_dir)
+        caper_uri.init_caper_uri(
+            tmp_dir=os.path.join(self.root, 'tmp_dir'),
+            tmp_gcs_bucket='gs://tmp-bucket/caper',
+            tmp_s3_bucket='s3://tmp-bucket/caper',
+            storage_driver='emulated',
+            emulated_storage_dir=os.path.join(self.root, 'buckets'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        caper_uri.init_caper_uri(tmp_dir=tempfile.gettempdir())
+
+    def write(self, basename, contents):
+        path = os.path.join(self.data_dir, basename)
+        with open(path, 'w') as fp:
+            fp.write(contents)
+        return path
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""Tester for CaperCache
+
+Author:
+    Jin Lee (leepc12@gmail.com) at ENCODE-DCC
+"""
+
+import unittest
+import os
+import shutil
+import tempfile
+
+try:
+    import caper
+except:
+    import sys, os
+    script_path = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(os.path.join(script_path, '../'))
+    import caper
+
+from caper.caper_cache import CaperCache
+
+
+class TestCaperCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, rel_path, contents):
+        path = os.path.join(self.tmp_dir, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fp:
+            fp.write(contents)
+        return path
+
+    def test_dedup(self):
+        cache = CaperCache(self.tmp_dir)
+        a = cache.add(self.write('bucket1/a.txt', 'hello'))
+        b = cache.add(self.write('bucket2/b.txt', 'hello'))
+        self.assertTrue(os.path.samefile(a, b))
+        stats = cache.get_stats()
+        self.assertEqual(stats['num_objects'], 1)
+        self.assertEqual(stats['num_paths'], 2)
+        self.assertEqual(stats['total_size'], 5)
+
+    def test_lru_eviction(self):
+        cache = CaperCache(self.tmp_dir)
+        a = cache.add(self.write('a.txt', 'a' * 100))
+        b = cache.add(self.write('b.txt', 'b' * 100))
+        c = cache.add(self.write('c.txt', 'c' * 100))
+        cache.touch(a)
+
+        # objects accessed by a current process are not evicted
+        self.assertEqual(cache.prune(max_size=100), [])
+
+        # new process
+        cache = CaperCache(self.tmp_dir, max_size=200)
+        self.assertEqual(len(cache.prune()), 1)
+        self.assertFalse(os.path.exists(b))
+        self.assertTrue(os.path.exists(a))
+        self.assertTrue(os.path.exists(c))
+        self.assertEqual(cache.get_stats()['total_size'], 200)
+
+    def test_add_does_not_sweep(self):
+        cache = CaperCache(self.tmp_dir, max_size=1000)
+        a = cache.add(self.write('a.txt', 'a' * 100))
+        os.remove(a)
+        cache.add(self.write('b.txt', 'b' * 100))
+        # stale path is swept by prune() only
+        self.assertEqual(cache.get_stats()['num_paths'], 2)
+        self.assertEqual(cache.prune(), [])
+        self.assertEqual(cache.get_stats()['num_paths'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""Tester for CaperHTTP
+
+Author:
+    Jin Lee (leepc12@gmail.com) at ENCODE-DCC
+"""
+
+import unittest
+import os
+import re
+import shutil
+import tempfile
+import threading
+import subprocess
+from subprocess import CalledProcessError
+from unittest import mock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+try:
+    import caper
+except:
+    import sys, os
+    script_path = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(os.path.join(script_path, '../'))
+    import caper
+
+from caper.caper_http import CaperHTTP
+
+
+DATA = b'0123456789abcdef\n' * 20000
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """Serves DATA on /data with support for ranged requests.
+    ETag, If-None-Match and If-Range are supported if etag is defined.
+    """
+    protocol_version = 'HTTP/1.1'
+    etag = None
+    # (method, status) of each request
+    responses = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.__respond(body=False)
+
+    def do_GET(self):
+        self.__respond(body=True)
+
+    def __respond(self, body):
+        if self.path != '/data':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        etag = RangeRequestHandler.etag
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            self.__respond_status(304)
+            return
+        start, end = 0, len(DATA) - 1
+        status = 200
+        m = re.findall(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if 'If-Range' in self.headers and \
+                self.headers['If-Range'] != etag:
+            # changed. send a whole file
+            m = None
+        if m:
+            start = int(m[0][0])
+            if m[0][1]:
+                end = int(m[0][1])
+            if start >= len(DATA):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(
+                    len(DATA)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+        chunk = DATA[start:end + 1]
+        self.send_response(status)
+        RangeRequestHandler.responses.append((self.command, status))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(len(chunk)))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, end, len(DATA)))
+        self.end_headers()
+        if body:
+            self.wfile.write(chunk)
+
+    def __respond_status(self, status):
+        self.send_response(status)
+        RangeRequestHandler.responses.append((self.command, status))
+        self.send_header('ETag', RangeRequestHandler.etag)
+        self.end_headers()
+
+
+class TestCaperHTTP(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(
+            ('localhost', 0), RangeRequestHandler)
+        self.url = 'http://localhost:{}/data'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'data')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+        RangeRequestHandler.etag = None
+        RangeRequestHandler.responses.clear()
+
+    def test_exists_and_contents(self):
+        http = CaperHTTP()
+        self.assertTrue(http.exists(self.url))
+        self.assertFalse(http.exists(self.url + '_not_found'))
+        self.assertEqual(http.get_contents(self.url), DATA.decode())
+
+    def test_ftp(self):
+        # ftp:// is handled by curl. served by a local HTTP server here
+        ftp_url = 'ftp://localhost/data'
+
+        def to_http(func):
+            def f(cmd, **kwargs):
+                return func([self.url if c == ftp_url else c for c in cmd],
+                            **kwargs)
+            return f
+
+        http = CaperHTTP()
+        with mock.patch('caper.caper_http.run',
+                        side_effect=to_http(subprocess.run)) as m, \
+                mock.patch('caper.caper_http.Popen',
+                           side_effect=to_http(subprocess.Popen)):
+            self.assertEqual(http.stat(ftp_url), (True, len(DATA), None))
+            self.assertEqual(http.get_contents(ftp_url), DATA.decode())
+            self.assertEqual(b''.join(http.iter_content(ftp_url)), DATA)
+            self.assertTrue(http.download(ftp_url, self.path))
+        self.assertEqual(m.call_args[0][0][0], 'curl')
+        with open(self.path, 'rb') as fp:
+            self.assertEqual(fp.read(), DATA)
+
+        # curl: (78) remote file not found
+        with mock.patch('caper.caper_http.run', side_effect=CalledProcessError(
+                78, 'curl')):
+            self.assertFalse(http.exists(ftp_url))
+        with mock.patch('caper.caper_http.run', side_effect=CalledProcessError(
+                7, 'curl')):
+            self.assertRaises(CalledProcessError, http.exists, ftp_url)
+
+    def test_download_resume(self):
+        http = CaperHTTP(num_threads=1)
+        with open(self.path, 'wb') as fp:
+            fp.write(DATA[:1000])
+        self.assertTrue(http.download(self.url, self.path))
+        with open(self.path, 'rb') as fp:
+            self.assertEqual(fp.read(), DATA)
+        # already complete
+        self.assertFalse(http.download(self.url, self.path))
+
+    def test_download_parallel(self):
+        http = CaperHTTP(num_threads=4)
+        org_min_size = CaperHTTP.PARALLEL_MIN_FILE_SIZE
+        org_part_size = CaperHTTP.PARALLEL_PART_SIZE
+        CaperHTTP.PARALLEL_MIN_FILE_SIZE = 1
+        CaperHTTP.PARALLEL_PART_SIZE = 30000
+        try:
+            self.assertTrue(http.download(self.url, self.path))
+        finally:
+            CaperHTTP.PARALLEL_MIN_FILE_SIZE = org_min_size
+            CaperHTTP.PARALLEL_PART_SIZE = org_part_size
+        with open(self.path, 'rb') as fp:
+            self.assertEqual(fp.read(), DATA)
+        self.assertFalse(os.path.exists(
+            self.path + CaperHTTP.PARALLEL_TMP_EXT))
+
+    def test_download_revalidate(self):
+        RangeRequestHandler.etag = '"v1"'
+        http = CaperHTTP(num_threads=1)
+        self.assertIsNone(http.is_downloaded(self.url, self.path))
+        self.assertTrue(http.download(self.url, self.path))
+        self.assertTrue(os.path.exists(
+            self.path + CaperHTTP.VALIDATORS_EXT))
+
+        # not modified (304)
+        del RangeRequestHandler.responses[:]
+        self.assertTrue(http.is_downloaded(self.url, self.path))
+        self.assertFalse(http.download(self.url, self.path))
+        self.assertEqual(RangeRequestHandler.responses,
+                         [('HEAD', 304), ('GET', 304)])
+        # validators are for another URL
+        self.assertIsNone(http.is_downloaded(self.url + '?x', self.path))
+
+        # modified
+        RangeRequestHandler.etag = '"v2"'
+        self.assertFalse(http.is_downloaded(self.url, self.path))
+        self.assertTrue(http.download(self.url, self.path))
+        self.assertTrue(http.is_downloaded(self.url, self.path))
+
+        # partial file is not validated and it's downloaded again
+        # from the beginning (If-Range) if modified
+        with open(self.path, 'r+b') as fp:
+            fp.truncate(1000)
+        self.assertIsNone(http.is_downloaded(self.url, self.path))
+        RangeRequestHandler.etag = '"v3"'
+        del RangeRequestHandler.responses[:]
+        self.assertTrue(http.download(self.url, self.path))
+        self.assertEqual(RangeRequestHandler.responses, [('GET', 200)])
+        with open(self.path, 'rb') as fp:
+            self.assertEqual(fp.read(), DATA)
+
+
+if __name__ == '__main__':
+    unittest.main()
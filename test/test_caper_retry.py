@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""Tester for CaperRetry
+
+Author:
+    Jin Lee (leepc12@gmail.com) at ENCODE-DCC
+"""
+
+import unittest
+import os
+import errno
+import shutil
+import tempfile
+from subprocess import CalledProcessError
+from unittest import mock
+
+try:
+    import caper
+except:
+    import sys, os
+    script_path = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(os.path.join(script_path, '../'))
+    import caper
+
+from caper import caper_uri
+from caper.caper_uri import CaperURI, URI_GCS
+from caper.caper_http import CaperHTTPError
+from caper.caper_retry import CaperRetry
+
+
+class TestCaperRetry(unittest.TestCase):
+
+    def test_classify(self):
+        retry = CaperRetry()
+        self.assertEqual(retry.classify(CaperHTTPError(503, 'http://a')),
+                         (True, False, None))
+        self.assertEqual(
+            retry.classify(CaperHTTPError(429, 'http://a', retry_after=7)),
+            (True, True, 7))
+        self.assertFalse(retry.classify(CaperHTTPError(404, 'http://a'))[0])
+        self.assertTrue(retry.classify(CalledProcessError(1, 'gsutil'))[0])
+        self.assertFalse(retry.classify(CalledProcessError(
+            1, 'gsutil', stderr=b'CommandException: No URLs matched'))[0])
+        self.assertEqual(retry.classify(CalledProcessError(
+            1, 'aws', output='An error occurred (SlowDown)')),
+            (True, True, None))
+        self.assertTrue(retry.classify(
+            OSError(errno.ECONNRESET, 'reset'))[0])
+        self.assertFalse(retry.classify(OSError(errno.ENOSPC, 'full'))[0])
+        self.assertFalse(retry.classify(FileNotFoundError('x'))[0])
+
+        # botocore.exceptions.ClientError
+        e = Exception('x')
+        e.response = {'Error': {'Code': 'SlowDown'},
+                      'ResponseMetadata': {'HTTPStatusCode': 503}}
+        self.assertEqual(retry.classify(e), (True, True, None))
+        e.response = {'Error': {'Code': 'AccessDenied'},
+                      'ResponseMetadata': {'HTTPStatusCode': 403}}
+        self.assertFalse(retry.classify(e)[0])
+
+    def test_run(self):
+        retry = CaperRetry(max_retries=3, base_delay_sec=1.0,
+                           max_delay_sec=4.0, retry_budget=4)
+        sleep = mock.MagicMock()
+        func = mock.MagicMock(side_effect=[
+            CaperHTTPError(500, 'http://a'),
+            CaperHTTPError(500, 'http://a'), 'ok'])
+        event = {'retries': 0}
+        self.assertEqual(retry.run(func, key='url', event=event,
+                                   sleep=sleep), 'ok')
+        self.assertEqual(event['retries'], 2)
+        # full jitter within a cap of exponential backoff
+        self.assertLess(sleep.call_args_list[0][0][0], 1.0)
+        self.assertLess(sleep.call_args_list[1][0][0], 2.0)
+
+        # fatal error is not retried
+        func = mock.MagicMock(side_effect=FileNotFoundError('x'))
+        self.assertRaises(FileNotFoundError, retry.run, func, sleep=sleep)
+        self.assertEqual(func.call_count, 1)
+
+        # max_retries
+        func = mock.MagicMock(side_effect=CaperHTTPError(500, 'http://a'))
+        self.assertRaises(CaperHTTPError, retry.run, func, sleep=sleep)
+        self.assertEqual(func.call_count, 3)
+        self.assertEqual(retry.num_retries, 4)
+
+        # budget is exhausted
+        func = mock.MagicMock(side_effect=[CaperHTTPError(500, 'http://a'),
+                                           'ok'])
+        self.assertRaises(CaperHTTPError, retry.run, func, sleep=sleep)
+
+    def test_rate_limit(self):
+        retry = CaperRetry(base_delay_sec=0.0)
+        clock = [1000.0]
+        sleep = mock.MagicMock(
+            side_effect=lambda sec: clock.__setitem__(0, clock[0] + sec))
+        func = mock.MagicMock(side_effect=[
+            CaperHTTPError(429, 'http://a', retry_after=30), 'ok'])
+        with mock.patch('caper.caper_retry.time.time',
+                        side_effect=lambda: clock[0]):
+            retry.run(func, key='gcs', sleep=sleep)
+            self.assertEqual(sleep.call_args_list[0][0][0], 30)
+
+            # other operations on the same storage wait for rate-limit
+            # but not on other storages
+            clock[0] -= 20
+            sleep.reset_mock()
+            retry.run(lambda: None, key='gcs', sleep=sleep)
+            self.assertEqual(sleep.call_args[0][0], 20)
+            clock[0] -= 20
+            sleep.reset_mock()
+            retry.run(lambda: None, key='s3', sleep=sleep)
+            sleep.assert_not_called()
+
+
+class TestCaperURIRetry(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        caper_uri.init_caper_uri(
+            tmp_dir=os.path.join(self.root, 'tmp_dir'),
+            tmp_gcs_bucket='gs://tmp-bucket/caper',
+            storage_driver='emulated',
+            emulated_storage_dir=os.path.join(self.root, 'buckets'),
+            transfer_log_file=os.path.join(self.root, 'log.jsonl'))
+        CaperURI.RETRY = CaperRetry(base_delay_sec=0.0)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        caper_uri.init_caper_uri(tmp_dir=tempfile.gettempdir())
+
+    def test_copy(self):
+        a = os.path.join(self.root, 'a.txt')
+        with open(a, 'w') as fp:
+            fp.write('a' * 100)
+        driver = CaperURI.get_storage_driver('gs://')
+        errors = [CalledProcessError(1, 'gsutil'),
+                  CaperHTTPError(503, 'gs://tmp-bucket')]
+        org_upload = driver.upload
+
+        def upload(path, uri):
+            if errors:
+                raise errors.pop(0)
+            org_upload(path, uri)
+
+        with mock.patch.object(driver, 'upload', side_effect=upload) as m:
+            gcs_a = CaperURI(a).get_file(URI_GCS)
+        self.assertEqual(m.call_count, 3)
+        self.assertEqual(CaperURI(gcs_a).get_file_contents(), 'a' * 100)
+
+        summary = CaperURI.TELEMETRY.get_summary()
+        copy = [row for row in summary if row['op'] == 'copy'][0]
+        self.assertEqual(copy['retries'], 2)
+        self.assertEqual(copy['failed'], 0)
+
+        # fatal error
+        with mock.patch.object(driver, 'read',
+                               side_effect=PermissionError('x')) as m:
+            self.assertRaises(PermissionError,
+                              CaperURI(gcs_a).get_file_contents)
+        self.assertEqual(m.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
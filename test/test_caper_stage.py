@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Tester for CaperStage (two-phase deepcopy) on an emulated object store
+
+Author:
+    Jin Lee (leepc12@gmail.com) at ENCODE-DCC
+"""
+
+import unittest
+import os
+import json
+from unittest import mock
+
+try:
+    import caper
+except:
+    import sys, os
+    script_path = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(os.path.join(script_path, '../'))
+    import caper
+
+from caper.caper_uri import CaperURI, URI_GCS
+from caper.caper_stage import CaperStage
+from caper.caper_storage import EmulatedStorageDriver
+
+try:
+    from .caper_test_base import CaperURIEmulatedTestCase
+except ImportError:
+    from caper_test_base import CaperURIEmulatedTestCase
+
+
+class TestCaperStage(CaperURIEmulatedTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.a = self.write('a.txt', 'a' * 100)
+        self.b = self.write('b.txt', 'b' * 200)
+        self.tsv = self.write('c.tsv', '{}\t{}\n'.format(self.a, self.b))
+        self.inputs = self.write('inputs.json', json.dumps(
+            {'a': self.a, 'tsv': self.tsv, 'x': 'not_a_file'}))
+        self.plan_file = os.path.join(self.root, 'inputs.gcs.plan.json')
+
+    def test_plan_deepcopy(self):
+        entries = CaperURI(self.inputs).plan_deepcopy(
+            URI_GCS, uri_exts=('.json', '.tsv'))
+        # nested TSV is not an entry but files in it are
+        self.assertEqual([e['src'] for e in entries], [self.a, self.b])
+        self.assertEqual([e['size'] for e in entries], [100, 200])
+        self.assertEqual([e['action'] for e in entries], ['copy', 'copy'])
+        for e in entries:
+            self.assertTrue(e['target'].startswith('gs://tmp-bucket/caper/'))
+            # planning does not copy anything
+            self.assertFalse(CaperURI(e['target']).file_exists())
+
+        # already copied files are skipped
+        CaperURI(self.a).copy(target_uri=entries[0]['target'])
+        entries = CaperURI(self.inputs).plan_deepcopy(
+            URI_GCS, uri_exts=('.json', '.tsv'))
+        self.assertEqual([e['action'] for e in entries], ['skip', 'copy'])
+
+    def test_create(self):
+        stage = CaperStage.create(
+            self.inputs, self.plan_file, URI_GCS, ('.json', '.tsv'),
+            no_copy_root=True)
+        self.assertTrue(os.path.exists(self.plan_file))
+        summary = stage.get_summary()
+        self.assertEqual(summary['num_files'], 2)
+        self.assertEqual(summary['num_pending'], 2)
+        self.assertEqual(summary['total_bytes'], 300)
+        self.assertEqual(summary['pending_bytes'], 300)
+        self.assertGreater(summary['estimated_sec'], 0)
+
+    def test_throughput(self):
+        stage = CaperStage.create(
+            self.inputs, self.plan_file, URI_GCS, ('.json', '.tsv'),
+            no_copy_root=True)
+        # two concurrent transfers and another one in a session a day later
+        with open(stage.journal_file, 'w') as fp:
+            for src, start, end in (('x', 0, 10), ('y', 5, 10),
+                                    ('z', 86400, 86410)):
+                fp.write(json.dumps({'src': src, 'target': src,
+                                     'bytes': 100, 'start': start,
+                                     'end': end}) + '\n')
+        summary = CaperStage(self.plan_file).get_summary()
+        self.assertEqual(summary['throughput'], 15.0)
+        self.assertEqual(summary['estimated_sec'], 20.0)
+
+    def test_execute_and_resume(self):
+        CaperStage.create(
+            self.inputs, self.plan_file, URI_GCS, ('.json', '.tsv'),
+            no_copy_root=True)
+
+        write_stream = EmulatedStorageDriver.write_stream
+
+        def fail_on_b(driver, uri, chunks):
+            if uri.endswith('/b.txt'):
+                raise PermissionError('denied')
+            return write_stream(driver, uri, chunks)
+
+        stage = CaperStage(self.plan_file)
+        with mock.patch.object(EmulatedStorageDriver, 'write_stream',
+                               fail_on_b):
+            self.assertRaises(Exception, stage.execute)
+        with open(stage.journal_file) as fp:
+            journal = [json.loads(line) for line in fp]
+        self.assertEqual([r['src'] for r in journal], [self.a])
+
+        # only a failed file is copied on resume
+        stage = CaperStage(self.plan_file)
+        self.assertEqual(
+            [e['src'] for e in stage.get_pending_entries()], [self.b])
+        with mock.patch.object(CaperURI, 'copy',
+                               side_effect=CaperURI.copy,
+                               autospec=True) as copy:
+            new_inputs, updated = stage.execute()
+        copied = [c[0][0].get_uri() for c in copy.call_args_list
+                  if c[1].get('target_uri')]
+        self.assertEqual(copied, [self.b])
+        self.assertEqual(stage.get_summary()['num_pending'], 0)
+
+        # root file is not copied but nested TSV is
+        self.assertTrue(updated)
+        self.assertEqual(os.path.dirname(new_inputs), self.data_dir)
+        with open(new_inputs) as fp:
+            d = json.load(fp)
+        self.assertTrue(d['a'].startswith('gs://tmp-bucket/caper/'))
+        self.assertTrue(d['tsv'].startswith('gs://tmp-bucket/caper/'))
+        self.assertEqual(d['x'], 'not_a_file')
+        tsv = CaperURI(d['tsv']).get_file_contents().strip().split('\t')
+        self.assertTrue(all(v.startswith('gs://') for v in tsv))
+
+
+if __name__ == '__main__':
+    unittest.main()
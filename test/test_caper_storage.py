@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+"""Tester for storage drivers and CaperURI on an emulated object store
+
+Author:
+    Jin Lee (leepc12@gmail.com) at ENCODE-DCC
+"""
+
+import unittest
+import io
+import gc
+import os
+import json
+import shutil
+import hashlib
+import subprocess
+import tempfile
+import time
+from subprocess import CalledProcessError
+from unittest import mock
+
+try:
+    import caper
+except:
+    import sys, os
+    script_path = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(os.path.join(script_path, '../'))
+    import caper
+
+from caper import caper_uri
+from caper.caper_uri import CaperURI, URI_GCS, URI_S3
+from caper.caper_retry import CaperRetry
+from caper.caper_storage import EmulatedStorageDriver, GsutilDriver, \
+    GCSClientDriver, AwsS3Driver, create_storage_drivers
+
+try:
+    from .caper_test_base import CaperURIEmulatedTestCase
+except ImportError:
+    from caper_test_base import CaperURIEmulatedTestCase
+
+
+class TestEmulatedStorageDriver(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.driver = EmulatedStorageDriver(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_read_write(self):
+        uri = 'gs://bucket/a/b.txt'
+        self.assertEqual(self.driver.stat(uri), (False, None, None))
+        self.driver.write(uri, b'0123456789')
+        self.assertEqual(self.driver.stat(uri), (
+            True, 10, '781e5e245d69b566979b86e28d23f2c7'))
+        self.assertEqual(self.driver.read(uri), b'0123456789')
+        self.assertEqual(self.driver.read_range(uri, 2, 4), b'234')
+        self.assertEqual(
+            b''.join(self.driver.iter_content(uri, chunk_size=3)),
+            b'0123456789')
+
+        self.driver.copy(uri, 's3://bucket2/c.txt')
+        self.assertEqual(self.driver.read('s3://bucket2/c.txt'),
+                         b'0123456789')
+
+        self.driver.delete(uri)
+        self.assertFalse(self.driver.stat(uri)[0])
+        self.assertRaises(FileNotFoundError, self.driver.delete, uri)
+
+    def test_md5_cache(self):
+        uri = 'gs://bucket/a.txt'
+        self.driver.write(uri, b'0123456789')
+        md5 = hashlib.md5(b'abc').hexdigest()
+        with mock.patch('caper.caper_storage.hashlib.md5',
+                        wraps=hashlib.md5) as m:
+            for _ in range(3):
+                self.driver.stat(uri)
+                self.driver.list('gs://bucket/')
+            self.assertEqual(m.call_count, 1)
+            # hashed again once a file is changed
+            self.driver.write(uri, b'abc')
+            self.assertEqual(self.driver.stat(uri)[2], md5)
+            self.assertEqual(m.call_count, 2)
+
+    def test_cli_write_error(self):
+        p = mock.MagicMock()
+        p.wait.return_value = 1
+        for driver in (GsutilDriver(), AwsS3Driver()):
+            with mock.patch('caper.caper_storage.Popen', return_value=p):
+                self.assertRaises(CalledProcessError, driver.write,
+                                  's3://bucket/a.txt.lock', b'{}')
+
+    def test_abandon_write_stream(self):
+        def chunks():
+            yield b'a' * 10
+            # let CLI start reading
+            time.sleep(0.2)
+            raise IOError('interrupted')
+
+        # CLI with a child process which finalizes an upload on EOF
+        out = os.path.join(self.root, 'out')
+        cmd = ['sh', '-c', 'exec 3<&0; (cat <&3 > {0}.tmp && '
+               'mv {0}.tmp {0}) & wait'.format(out)]
+        with mock.patch('caper.caper_storage.Popen',
+                        side_effect=lambda _, **kwargs: subprocess.Popen(
+                            cmd, **kwargs)):
+            self.assertRaises(IOError, GsutilDriver().write_stream,
+                              'gs://bucket/out', chunks())
+        # STDIN is closed (EOF) when a process is garbage-collected
+        gc.collect()
+        time.sleep(0.5)
+        self.assertFalse(os.path.exists(out))
+
+        # BlobWriter finalizes an upload on close() and garbage collection
+        uploaded = []
+
+        class BlobWriter(io.BufferedIOBase):
+            def __init__(self):
+                self._buffer = io.BytesIO()
+
+            @property
+            def closed(self):
+                return self._buffer.closed
+
+            def write(self, b):
+                return self._buffer.write(b)
+
+            def close(self):
+                if not self._buffer.closed:
+                    uploaded.append(self._buffer.getvalue())
+                self._buffer.close()
+
+        driver = object.__new__(GCSClientDriver)
+        blob = mock.MagicMock()
+        blob.open.side_effect = lambda mode: BlobWriter()
+        with mock.patch.object(driver, '_GCSClientDriver__get_blob',
+                               return_value=blob):
+            self.assertRaises(IOError, driver.write_stream,
+                              'gs://bucket/out', chunks())
+            gc.collect()
+            self.assertEqual(uploaded, [])
+            driver.write_stream('gs://bucket/out', [b'a', b'b'])
+        self.assertEqual(uploaded, [b'ab'])
+
+    def test_cli_stderr(self):
+        # STDERR of a CLI is attached to an error so that
+        # CaperRetry does not retry a fatal one
+        def fake(popen, msg):
+            def f(cmd, **kwargs):
+                return popen(['sh', '-c', 'cat > /dev/null; echo "{}" >&2; '
+                              'exit 1'.format(msg)], **kwargs)
+            return f
+
+        with mock.patch('caper.caper_storage.run', side_effect=fake(
+                subprocess.run, 'CommandException: No URLs matched')):
+            with self.assertRaises(CalledProcessError) as cm:
+                GsutilDriver().delete('gs://bucket/a.txt.lock')
+        self.assertIn(b'No URLs matched', cm.exception.stderr)
+        self.assertFalse(CaperRetry().classify(cm.exception)[0])
+
+        for driver in (GsutilDriver(), AwsS3Driver()):
+            with mock.patch('caper.caper_storage.Popen', side_effect=fake(
+                    subprocess.Popen, 'AccessDenied')):
+                with self.assertRaises(CalledProcessError) as cm:
+                    driver.write('s3://bucket/a.txt', b'a')
+                with self.assertRaises(CalledProcessError) as cm_read:
+                    list(driver.iter_content('s3://bucket/a.txt'))
+            for e in (cm.exception, cm_read.exception):
+                self.assertEqual(e.stderr, b'AccessDenied\n')
+                self.assertFalse(CaperRetry().classify(e)[0])
+
+    def test_list(self):
+        for key in ('a/1.txt', 'a/b/2.txt', 'c/3.txt'):
+            self.driver.write('gs://bucket/' + key, key.encode())
+        self.assertEqual(
+            sorted(self.driver.list('gs://bucket/a/')),
+            ['gs://bucket/a/1.txt'])
+        self.assertEqual(
+            sorted(self.driver.list('gs://bucket/a/', recursive=True)),
+            ['gs://bucket/a/1.txt', 'gs://bucket/a/b/2.txt'])
+
+    def test_upload_parallel(self):
+        path = os.path.join(self.root, 'a.bin')
+        data = os.urandom(1000)
+        with open(path, 'wb') as fp:
+            fp.write(data)
+        state_file = os.path.join(self.root, 'state', 'a.json')
+        uri = 's3://bucket/a.bin'
+
+        upload_part = EmulatedStorageDriver.upload_part
+
+        def fail_on_3(driver, uri, upload_id, part_number, data, md5):
+            if part_number == 3:
+                raise ConnectionError('reset')
+            return upload_part(driver, uri, upload_id, part_number, data, md5)
+
+        with mock.patch.object(EmulatedStorageDriver, 'upload_part',
+                               fail_on_3):
+            self.assertRaises(ConnectionError, self.driver.upload_parallel,
+                              path, uri, 300, num_threads=2,
+                              state_file=state_file)
+        self.assertFalse(self.driver.stat(uri)[0])
+        with open(state_file) as fp:
+            state = json.load(fp)
+        self.assertEqual(sorted(state['parts']), ['1', '2', '4'])
+
+        # only a failed part is uploaded on resume
+        with mock.patch.object(EmulatedStorageDriver, 'upload_part',
+                               side_effect=upload_part,
+                               autospec=True) as m:
+            num_parts = self.driver.upload_parallel(
+                path, uri, 300, num_threads=2, state_file=state_file)
+        self.assertEqual(num_parts, 4)
+        self.assertEqual([c[0][3] for c in m.call_args_list], [3])
+        self.assertEqual(self.driver.read(uri), data)
+        self.assertFalse(os.path.exists(state_file))
+        # parts are cleaned up
+        self.assertEqual(
+            list(self.driver.list('s3://bucket/', recursive=True)), [uri])
+
+        # not split
+        self.assertEqual(self.driver.upload_parallel(
+            path, 'gs://bucket/b.bin', 1000), 1)
+        self.assertEqual(self.driver.read('gs://bucket/b.bin'), data)
+
+    def test_gsutil_upload_parallel(self):
+        path = os.path.join(self.root, 'a.bin')
+        with open(path, 'wb') as fp:
+            fp.write(b'0' * 1000)
+        with mock.patch('caper.caper_storage._check_call') as m:
+            num_parts = GsutilDriver().upload_parallel(
+                path, 'gs://b/a.bin', 300, num_threads=4)
+            self.assertEqual(num_parts, 4)
+            cmd = m.call_args[0][0]
+            self.assertIn(
+                'GSUtil:parallel_composite_upload_threshold=300', cmd)
+            self.assertIn('GSUtil:parallel_thread_count=4', cmd)
+            self.assertEqual(cmd[-3:], ['cp', path, 'gs://b/a.bin'])
+
+            # no composite upload to s3://
+            GsutilDriver().upload_parallel(path, 's3://b/a.bin', 300)
+            m.assert_called_with(['gsutil', '-q', 'cp', path, 's3://b/a.bin'])
+
+    def test_gsutil_transfer_many(self):
+        transfers = [('/a/1.txt', 'gs://b/x/1.txt'),
+                     ('/c/2.txt', 'gs://b/x/2.txt'),
+                     ('/a/3.txt', 'gs://b/y/3.txt'),
+                     ('/a/4.txt', 'gs://b/y/renamed.txt')]
+        p = mock.MagicMock(returncode=0)
+        p.communicate.return_value = (b'', b'')
+        with mock.patch('caper.caper_storage.Popen', return_value=p) as m, \
+                mock.patch('caper.caper_storage._check_call') as m_single:
+            results = GsutilDriver().transfer_many(transfers, num_threads=3)
+        # one "gsutil -m cp -I" for each target directory
+        self.assertEqual([c[0][0][-1] for c in m.call_args_list],
+                         ['gs://b/x/', 'gs://b/y/'])
+        # bounded by num_threads
+        self.assertEqual(m.call_args[0][0][:6], [
+            'gsutil', '-q', '-o', 'GSUtil:parallel_thread_count=3',
+            '-o', 'GSUtil:parallel_process_count=1'])
+        self.assertEqual(p.communicate.call_args_list[0][1]['input'],
+                         b'/a/1.txt\n/c/2.txt')
+        # basename is changed
+        m_single.assert_called_once_with(
+            ['gsutil', '-q', 'cp', '/a/4.txt', 'gs://b/y/renamed.txt'])
+        self.assertEqual(set(results), set(transfers))
+
+    def test_gsutil_presign_many(self):
+        out = ('URL\tHTTP Method\tExpiration\tSigned URL\n'
+               'gs://b/1.txt\tGET\t2019-05-22 14:06:47\thttps://x/1.txt?s=1\n'
+               'gs://b/2.txt\tGET\t2019-05-22 14:06:47\thttps://x/2.txt?s=2\n')
+        with mock.patch('caper.caper_storage.check_output',
+                        return_value=out.encode()) as m:
+            result = GsutilDriver().presign_many(
+                ['gs://b/1.txt', 'gs://b/2.txt'], 3600,
+                private_key_file='key.json')
+        m.assert_called_once_with(
+            ['gsutil', '-q', 'signurl', '-d', '3600s', 'key.json',
+             'gs://b/1.txt', 'gs://b/2.txt'], stderr=subprocess.PIPE)
+        self.assertEqual(result, {'gs://b/1.txt': 'https://x/1.txt?s=1',
+                                  'gs://b/2.txt': 'https://x/2.txt?s=2'})
+
+    def test_create_storage_drivers(self):
+        drivers = create_storage_drivers('emulated',
+                                         emulated_storage_dir=self.root)
+        self.assertIs(drivers['gs'], drivers['s3'])
+        self.assertRaises(ValueError, create_storage_drivers, 'emulated')
+        self.assertRaises(ValueError, create_storage_drivers, 'xxx')
+
+
+class TestCaperURIEmulated(CaperURIEmulatedTestCase):
+    """CaperURI with gs:// and s3:// emulated on a local directory
+    """
+
+    def test_deepcopy(self):
+        a = self.write('a.txt', 'a' * 100)
+        tsv = self.write('b.tsv', '{}\tx\n'.format(a))
+        json_file = self.write('c.json', json.dumps({'a': a, 'b': tsv}))
+
+        gcs_json, updated = CaperURI(json_file).deepcopy(
+            URI_GCS, uri_exts=('.json', '.tsv'))
+        self.assertTrue(updated)
+        self.assertTrue(gcs_json.startswith('gs://tmp-bucket/caper/'))
+
+        d = json.loads(CaperURI(gcs_json).get_file_contents())
+        self.assertEqual(CaperURI(d['a']).get_file_size(), 100)
+        self.assertEqual(CaperURI(d['b']).get_file_contents(),
+                         '{}\tx\n'.format(d['a']))
+
+        # gs:// to s3:// with a stream
+        CaperURI.STREAM_TRANSFER = True
+        try:
+            s3_file = CaperURI(d['a']).copy(
+                target_uri='s3://tmp-bucket/caper/a.txt')
+        finally:
+            CaperURI.STREAM_TRANSFER = False
+        self.assertEqual(CaperURI(s3_file).get_file_contents(), 'a' * 100)
+
+        result = CaperURI.stat_many([d['a'], s3_file,
+                                     's3://tmp-bucket/caper/x.txt'])
+        self.assertEqual(result[s3_file][:2], (True, 100))
+        self.assertFalse(result['s3://tmp-bucket/caper/x.txt'][0])
+
+        CaperURI(s3_file).rm()
+        self.assertFalse(CaperURI(s3_file).file_exists())
+
+    def test_multipart_upload(self):
+        a = self.write('a.txt', 'a' * 1000)
+        caper_uri.init_caper_uri(
+            tmp_dir=os.path.join(self.root, 'tmp_dir'),
+            storage_driver='emulated',
+            emulated_storage_dir=os.path.join(self.root, 'buckets'),
+            multipart_upload_part_size=300,
+            multipart_upload_num_threads=2)
+        driver = CaperURI.get_storage_driver('s3://')
+        with mock.patch.object(driver, 'upload_part',
+                               wraps=driver.upload_part) as m:
+            s3_file = CaperURI(a).copy(target_uri='s3://bucket/a.txt')
+        self.assertEqual(m.call_count, 4)
+        self.assertEqual(CaperURI(s3_file).get_file_contents(), 'a' * 1000)
+        # states are removed once complete
+        self.assertEqual(os.listdir(os.path.join(
+            CaperURI.TMP_DIR, CaperURI.MULTIPART_DIRNAME)), [])
+
+        # opt-in for gsutil (composite object without MD5 hash)
+        caper_uri.init_caper_uri(tmp_dir=os.path.join(self.root, 'tmp_dir'))
+        self.assertEqual(CaperURI.MULTIPART_UPLOAD_PART_SIZE, 0)
+        caper_uri.init_caper_uri(
+            tmp_dir=os.path.join(self.root, 'tmp_dir'),
+            storage_driver='emulated',
+            emulated_storage_dir=os.path.join(self.root, 'buckets'))
+        self.assertEqual(CaperURI.MULTIPART_UPLOAD_PART_SIZE,
+                         caper_uri.DEFAULT_MULTIPART_UPLOAD_PART_SIZE)
+
+        # disabled
+        driver = CaperURI.get_storage_driver('gs://')
+        CaperURI.MULTIPART_UPLOAD_PART_SIZE = 0
+        with mock.patch.object(driver, 'upload_part') as m:
+            CaperURI(a).copy(target_uri='gs://bucket/a.txt')
+        m.assert_not_called()
+        self.assertEqual(
+            CaperURI('gs://bucket/a.txt').get_file_contents(), 'a' * 1000)
+
+    def test_batch_transfer(self):
+        files = [self.write('{}.txt'.format(i), str(i) * 10)
+                 for i in range(3)]
+        json_file = self.write('a.json', json.dumps({'files': files}))
+        driver = CaperURI.get_storage_driver('gs://')
+        CaperURI.BATCH_TRANSFER = True
+        try:
+            with mock.patch.object(driver, 'transfer_many',
+                                   wraps=driver.transfer_many) as m, \
+                    mock.patch.object(driver, 'upload',
+                                      wraps=driver.upload) as m_upload:
+                gcs_json, _ = CaperURI(json_file).deepcopy(
+                    URI_GCS, uri_exts=('.json',))
+            m.assert_called_once()
+            self.assertEqual(len(m.call_args[0][0]), 3)
+            # no transfer one by one after batch
+            # (rewritten JSON itself is uploaded too)
+            self.assertEqual(len([c for c in m_upload.call_args_list
+                                  if c[0][0].endswith('.txt')]), 3)
+
+            # failed in batch then copied one by one
+            with mock.patch.object(driver, 'transfer_many',
+                                   return_value={}) as m:
+                s3_json, _ = CaperURI(json_file).deepcopy(
+                    URI_S3, uri_exts=('.json',))
+            self.assertEqual(len(m.call_args[0][0]), 3)
+        finally:
+            CaperURI.BATCH_TRANSFER = False
+
+        for uri in (gcs_json, s3_json):
+            d = json.loads(CaperURI(uri).get_file_contents())
+            self.assertEqual(
+                [CaperURI(f).get_file_contents() for f in d['files']],
+                [str(i) * 10 for i in range(3)])
+
+    def test_presign_many(self):
+        CaperURI.USE_PRESIGNED_URL_S3 = True
+        driver = CaperURI.get_storage_driver('s3://')
+        uris = ['s3://bucket/a.txt', 's3://bucket/b.txt']
+        try:
+            with mock.patch.object(driver, 'presign_many',
+                                   wraps=driver.presign_many) as m:
+                urls = CaperURI.presign_many(uris)
+                # cached on disk
+                self.assertEqual(CaperURI(uris[0]).get_url(), urls[uris[0]])
+                self.assertEqual(CaperURI.presign_many(uris), urls)
+                m.assert_called_once()
+
+                # cached URL expires within a margin
+                margin = CaperURI.PRESIGNED_URL_EXPIRY_MARGIN_SEC
+                CaperURI.PRESIGNED_URL_EXPIRY_MARGIN_SEC = \
+                    CaperURI.DURATION_SEC_PRESIGNED_URL_S3
+                try:
+                    CaperURI(uris[1]).get_url()
+                finally:
+                    CaperURI.PRESIGNED_URL_EXPIRY_MARGIN_SEC = margin
+                self.assertEqual(m.call_count, 2)
+                self.assertEqual(m.call_args[0][0], [uris[1]])
+        finally:
+            CaperURI.USE_PRESIGNED_URL_S3 = False
+
+    def test_register_storage_driver(self):
+        driver = EmulatedStorageDriver(os.path.join(self.root, 'other'))
+        CaperURI.register_storage_driver('s3', driver)
+        self.assertIs(CaperURI.get_storage_driver('s3://bucket/a.txt'),
+                      driver)
+        self.assertRaises(NotImplementedError,
+                          CaperURI.get_storage_driver, 'xx://bucket/a.txt')
+
+
+if __name__ == '__main__':
+    unittest.main()
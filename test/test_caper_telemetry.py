@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Tester for CaperTelemetry
+
+Author:
+    Jin Lee (leepc12@gmail.com) at ENCODE-DCC
+"""
+
+import unittest
+import os
+import json
+import shutil
+import tempfile
+
+try:
+    import caper
+except:
+    import sys, os
+    script_path = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(os.path.join(script_path, '../'))
+    import caper
+
+from caper import caper_uri
+from caper.caper_uri import CaperURI, URI_GCS, URI_LOCAL
+from caper.caper_telemetry import CaperTelemetry
+
+
+class TestCaperTelemetry(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.root, 'log.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        caper_uri.init_caper_uri(tmp_dir=tempfile.gettempdir())
+
+    def read_events(self):
+        with open(self.log_file) as fp:
+            return [json.loads(line) for line in fp]
+
+    def test_measure(self):
+        telemetry = CaperTelemetry(log_file=self.log_file)
+        with telemetry.measure('copy', src_type='gcs', target_type='local',
+                               src='gs://a/b.txt') as event:
+            event['bytes'] = 1000
+        with self.assertRaises(ValueError):
+            with telemetry.measure('copy', src_type='gcs',
+                                   target_type='local'):
+                raise ValueError('x')
+        telemetry.record(telemetry.new_event(
+            'copy', src_type='gcs', target_type='local', status='skipped'))
+
+        events = self.read_events()
+        self.assertEqual([e['status'] for e in events],
+                         ['done', 'failed', 'skipped'])
+        self.assertEqual(events[1]['error'], 'ValueError: x')
+
+        summary = telemetry.get_summary()
+        self.assertEqual(len(summary), 1)
+        self.assertEqual(summary[0]['count'], 3)
+        self.assertEqual(summary[0]['failed'], 1)
+        self.assertEqual(summary[0]['skipped'], 1)
+        self.assertEqual(summary[0]['bytes'], 1000)
+
+        table = telemetry.format_summary().split('\n')
+        self.assertTrue(table[0].startswith('op'))
+        self.assertIn('1000B', table[1])
+
+    def test_caper_uri(self):
+        caper_uri.init_caper_uri(
+            tmp_dir=os.path.join(self.root, 'tmp_dir'),
+            tmp_gcs_bucket='gs://tmp-bucket/caper',
+            storage_driver='emulated',
+            emulated_storage_dir=os.path.join(self.root, 'buckets'),
+            transfer_log_file=self.log_file)
+        a = os.path.join(self.root, 'a.txt')
+        with open(a, 'w') as fp:
+            fp.write('a' * 100)
+
+        gcs_a = CaperURI(a).get_file(URI_GCS)
+        # skipped
+        CaperURI(a).get_file(URI_GCS)
+        CaperURI(gcs_a).get_file_contents()
+        CaperURI(gcs_a).rm()
+
+        events = self.read_events()
+        copies = [e for e in events if e['op'] == 'copy']
+        self.assertEqual([e['status'] for e in copies], ['done', 'skipped'])
+        self.assertEqual(copies[0]['src_type'], URI_LOCAL)
+        self.assertEqual(copies[0]['target_type'], URI_GCS)
+        self.assertEqual(copies[0]['bytes'], 100)
+        self.assertIn('slot_wait', copies[0])
+        ops = set(e['op'] for e in events)
+        self.assertTrue({'copy', 'stat', 'read', 'rm'} <= ops)
+        self.assertTrue(CaperURI.TELEMETRY.format_summary())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Tester for CaperThrottle
+
+Author:
+    Jin Lee (leepc12@gmail.com) at ENCODE-DCC
+"""
+
+import unittest
+import os
+import json
+import shutil
+import tempfile
+from unittest import mock
+
+try:
+    import caper
+except:
+    import sys, os
+    script_path = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(os.path.join(script_path, '../'))
+    import caper
+
+from caper import caper_uri
+from caper.caper_uri import CaperURI, URI_GCS, URI_LOCAL
+from caper.caper_check import parse_storage_dict, parse_size
+from caper.caper_throttle import CaperThrottle
+
+
+class TestCaperThrottle(unittest.TestCase):
+
+    def test_acquire(self):
+        throttle = CaperThrottle(max_concurrent={'gcs': 1, 'local': 2})
+        stack = throttle.acquire('gcs', 'local')
+        state = throttle.get_state('gcs', 'local')
+        self.assertEqual(state['gcs']['active'], 1)
+        self.assertEqual(state['gcs']['max_concurrent'], 1)
+        self.assertIsNone(state['gcs']['max_bandwidth'])
+        # no slot left for gcs
+        self.assertFalse(throttle._semaphores['gcs'].acquire(blocking=False))
+        stack.close()
+        self.assertEqual(throttle.get_state('gcs')['gcs']['active'], 0)
+
+    def test_consume(self):
+        clock = [1000.0]
+        sleep = mock.MagicMock(
+            side_effect=lambda sec: clock.__setitem__(0, clock[0] + sec))
+        with mock.patch('caper.caper_throttle.time.time',
+                        side_effect=lambda: clock[0]):
+            throttle = CaperThrottle(max_bandwidth={'gcs': 100})
+            # within a burst
+            self.assertEqual(throttle.consume(100, 'gcs', sleep=sleep), 0)
+            # larger than a burst goes into debt
+            self.assertEqual(throttle.consume(300, 'gcs', sleep=sleep), 0)
+            self.assertEqual(
+                throttle.get_state('gcs')['gcs']['tokens'], -300)
+            # next transfer waits until debt is paid off
+            self.assertEqual(throttle.consume(10, 'gcs', 'local',
+                                              sleep=sleep), 3)
+            sleep.assert_called_once_with(3)
+            # no limit
+            self.assertEqual(throttle.consume(10 ** 9, 'local',
+                                              sleep=sleep), 0)
+
+    def test_parse(self):
+        self.assertEqual(
+            parse_storage_dict('gs:100M,url:1K', val_type=parse_size),
+            {'gcs': 100 * 1024 ** 2, 'url': 1024})
+
+
+class TestCaperURIThrottle(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.root, 'log.jsonl')
+        caper_uri.init_caper_uri(
+            tmp_dir=os.path.join(self.root, 'tmp_dir'),
+            tmp_gcs_bucket='gs://tmp-bucket/caper',
+            storage_driver='emulated',
+            emulated_storage_dir=os.path.join(self.root, 'buckets'),
+            max_concurrent_transfers={URI_GCS: 2},
+            max_transfer_bandwidth={URI_GCS: 1000},
+            transfer_log_file=self.log_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        caper_uri.init_caper_uri(tmp_dir=tempfile.gettempdir())
+
+    def test_copy(self):
+        a = os.path.join(self.root, 'a.txt')
+        with open(a, 'w') as fp:
+            fp.write('a' * 1500)
+        b = os.path.join(self.root, 'b.txt')
+        with open(b, 'w') as fp:
+            fp.write('b' * 10)
+
+        with mock.patch('caper.caper_uri.time.sleep') as m:
+            CaperURI(a).get_file(URI_GCS)
+            m.assert_not_called()
+            # waits for 1500 bytes over a burst of 1000 bytes
+            CaperURI(b).get_file(URI_GCS)
+            self.assertAlmostEqual(m.call_args[0][0], 0.5, places=1)
+            # local to local is not limited
+            CaperURI(a).copy(target_uri=os.path.join(self.root, 'c.txt'))
+            m.assert_called_once()
+
+        with open(self.log_file) as fp:
+            events = [json.loads(line) for line in fp]
+        copies = [e for e in events if e['op'] == 'copy']
+        self.assertEqual(copies[0]['throttle_wait'], 0)
+        self.assertGreater(copies[1]['throttle_wait'], 0)
+        self.assertEqual(copies[1]['throttle'][URI_GCS]['active'], 1)
+        self.assertEqual(copies[1]['throttle'][URI_GCS]['max_concurrent'], 2)
+        self.assertEqual(copies[1]['throttle'][URI_GCS]['max_bandwidth'],
+                         1000)
+        self.assertIsNone(copies[1]['throttle'][URI_LOCAL]['max_bandwidth'])
+        row = [r for r in CaperURI.TELEMETRY.get_summary()
+               if r['op'] == 'copy' and r['target_type'] == URI_GCS][0]
+        self.assertGreater(row['throttled'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
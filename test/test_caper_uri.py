@@ -8,6 +8,14 @@ Author:
 import unittest
 import os
 import json
+import shutil
+import subprocess
+import time
+import tempfile
+import threading
+from functools import partial
+from unittest import mock
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
 
 try:
     import caper
@@ -18,7 +26,26 @@ except:
     import caper
 
 from caper import caper_uri
-from caper.caper_uri import CaperURI, URI_GCS, URI_LOCAL
+from caper.caper_uri import CaperURI, URI_GCS, URI_S3, URI_LOCAL, \
+    URI_URL
+
+try:
+    from .caper_test_base import CaperURIEmulatedTestCase
+except ImportError:
+    from caper_test_base import CaperURIEmulatedTestCase
+
+
+GSUTIL_LS_L = '''gs://bucket/a/1.txt:
+    Creation time:          Tue, 21 May 2019 21:06:47 GMT
+    Content-Length:         100
+    Hash (crc32c):          AAAAAA==
+    Hash (md5):             ylnRKcjHd2Gq/nM8i8rw9A==
+    ETag:                   CJCdyazLn+ICEAE=
+gs://bucket/a/b/2.txt:
+    Content-Length:         200
+    ETag:                   CJCdyazLn+ICEAE=
+TOTAL: 2 objects, 300 bytes (300 B)
+'''
 
 class TestCaperURI(unittest.TestCase):
 
@@ -48,5 +75,582 @@ class TestCaperURI(unittest.TestCase):
         # c = CaperURI('https://storage.googleapis.com/encode-pipeline-genome-data/hg38_chr19_chrM_caper.tsv').deepcopy(URI_GCS, uri_exts=('.tsv'))
         # c = CaperURI('https://storage.googleapis.com/encode-pipeline-genome-data/hg38_chr19_chrM_caper.tsv').deepcopy(URI_GCS, uri_exts=('.tsv'))
 
+
+class QuietHTTPRequestHandler(SimpleHTTPRequestHandler):
+    # number of GET/HEAD requests for each path
+    num_gets = {}
+    num_heads = {}
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        QuietHTTPRequestHandler.num_gets[self.path] = \
+            QuietHTTPRequestHandler.num_gets.get(self.path, 0) + 1
+        super(QuietHTTPRequestHandler, self).do_GET()
+
+    def do_HEAD(self):
+        QuietHTTPRequestHandler.num_heads[self.path] = \
+            QuietHTTPRequestHandler.num_heads.get(self.path, 0) + 1
+        super(QuietHTTPRequestHandler, self).do_HEAD()
+
+
+class TestCaperURILocal(unittest.TestCase):
+    """Tests without cloud storages. URLs are served from a local
+    HTTP server.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.data_dir = os.path.join(self.root, 'data')
+        os.makedirs(self.data_dir)
+        caper_uri.init_caper_uri(
+            tmp_dir=os.path.join(self.root, 'tmp_dir'),
+            max_concurrent_transfers={URI_URL: 2, URI_LOCAL: 2})
+
+        QuietHTTPRequestHandler.num_gets.clear()
+        QuietHTTPRequestHandler.num_heads.clear()
+        handler = partial(QuietHTTPRequestHandler, directory=self.data_dir)
+        self.server = ThreadingHTTPServer(('localhost', 0), handler)
+        self.url = 'http://localhost:{}/'.format(self.server.server_port)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.root)
+
+    def write_data(self, basename, contents):
+        with open(os.path.join(self.data_dir, basename), 'w') as fp:
+            fp.write(contents)
+        return self.url + basename
+
+    def test_deepcopy_parallel(self):
+        files = [self.write_data('{}.txt'.format(i), str(i) * 100)
+                 for i in range(10)]
+        fastqs = [self.write_data('{}.fastq'.format(i), str(i) * 100)
+                  for i in range(10)]
+        tsv = self.write_data(
+            'samples.tsv',
+            '\n'.join(['sample{}\t{}'.format(i, f)
+                       for i, f in enumerate(fastqs)]))
+        json_url = self.write_data('inputs.json', json.dumps({
+            'name': 'string',
+            'files': files + files,
+            'samples': tsv,
+        }))
+
+        new_json, updated = CaperURI(json_url).deepcopy(
+            URI_LOCAL, uri_exts=('.json', '.tsv'), parallel=True)
+        self.assertTrue(updated)
+        with open(new_json) as fp:
+            d = json.loads(fp.read())
+        self.assertEqual(d['name'], 'string')
+        self.assertEqual(len(d['files']), 20)
+        for i, f in enumerate(d['files']):
+            with open(f) as fp:
+                self.assertEqual(fp.read(), str(i % 10) * 100)
+        self.assertTrue(d['samples'].endswith('samples.local.tsv'))
+        with open(d['samples']) as fp:
+            lines = fp.read().split('\n')
+        fastq = lines[3].split('\t')[1]
+        self.assertTrue(fastq.startswith(CaperURI.TMP_DIR))
+        with open(fastq) as fp:
+            self.assertEqual(fp.read(), '3' * 100)
+
+    def test_deepcopy_memo(self):
+        files = [self.write_data('{}.txt'.format(i), str(i) * 100)
+                 for i in range(4)]
+        tsv = self.write_data(
+            'samples.tsv', '\n'.join(files + files))
+        json_url = self.write_data('inputs.json', json.dumps({
+            'files': files,
+            'same_files': files,
+            'samples': [tsv, tsv],
+        }))
+
+        new_json, _ = CaperURI(json_url).deepcopy(
+            URI_LOCAL, uri_exts=('.json', '.tsv'), parallel=True)
+        with open(new_json) as fp:
+            d = json.loads(fp.read())
+        self.assertEqual(d['files'], d['same_files'])
+        self.assertEqual(d['samples'][0], d['samples'][1])
+        with open(d['samples'][0]) as fp:
+            self.assertEqual(fp.read().split('\n'), d['files'] * 2)
+        for i in range(4):
+            self.assertEqual(
+                QuietHTTPRequestHandler.num_gets['/{}.txt'.format(i)], 1)
+        self.assertEqual(QuietHTTPRequestHandler.num_gets['/samples.tsv'], 1)
+
+    def test_deepcopy_circular(self):
+        a_json = self.url + 'a.json'
+        b_tsv = self.url + 'b.tsv'
+        d_txt = self.write_data('d.txt', 'd')
+        # more than one value to deepcopy them on a thread pool
+        self.write_data('a.json', json.dumps({'b': b_tsv, 'd': d_txt}))
+        self.write_data('b.tsv', 'x\t{}\n'.format(a_json))
+        self.write_data('c.json', json.dumps({'c': self.url + 'c.json'}))
+
+        for parallel in (False, True):
+            # fails instead of waiting for itself forever
+            self.assertRaises(
+                ValueError, CaperURI(a_json).deepcopy,
+                URI_LOCAL, uri_exts=('.json', '.tsv'), parallel=parallel)
+            self.assertRaises(
+                ValueError, CaperURI(self.url + 'c.json').deepcopy,
+                URI_LOCAL, uri_exts=('.json',), parallel=parallel)
+
+    def test_deepcopy_circular_parallel(self):
+        # a cycle across two worker threads. each thread owns one file
+        # and waits for the other
+        a_tsv = self.url + 'a.tsv'
+        b_tsv = self.url + 'b.tsv'
+        self.write_data('a.tsv', 'x\t{}\n'.format(b_tsv))
+        self.write_data('b.tsv', 'x\t{}\n'.format(a_tsv))
+        root = self.write_data('root.json', json.dumps({'a': a_tsv,
+                                                        'b': b_tsv}))
+        errors = []
+
+        def deepcopy():
+            try:
+                CaperURI(root).deepcopy(
+                    URI_LOCAL, uri_exts=('.json', '.tsv'), parallel=True)
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=deepcopy)
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([type(e) for e in errors], [ValueError])
+
+    def test_local_cache(self):
+        url = self.write_data('a.txt', 'a' * 100)
+        caper_uri.init_caper_uri(
+            tmp_dir=os.path.join(self.root, 'tmp_dir'),
+            local_cache_max_size=1000)
+        try:
+            for _ in range(2):
+                path = CaperURI(url).get_local_file()
+            # cached copy is not downloaded again
+            self.assertEqual(QuietHTTPRequestHandler.num_gets['/a.txt'], 1)
+            self.assertGreater(os.stat(path).st_nlink, 1)
+            self.assertEqual(CaperURI.CACHE.get_stats()['num_paths'], 1)
+        finally:
+            caper_uri.init_caper_uri(
+                tmp_dir=os.path.join(self.root, 'tmp_dir'))
+
+    def test_stream_transfer(self):
+        url = self.write_data('a.txt', 'a' * 1000)
+        tmp_dir = os.path.join(self.root, 'tmp_dir')
+        caper_uri.init_caper_uri(
+            tmp_dir=tmp_dir, stream_transfer=True, storage_driver='emulated',
+            emulated_storage_dir=os.path.join(self.root, 'buckets'))
+        driver = CaperURI.get_storage_driver('gs://')
+        write_stream = type(driver).write_stream
+        try:
+            target = CaperURI(url).copy(target_uri='gs://bucket/a.txt')
+            self.assertEqual(CaperURI(target).get_file_contents(), 'a' * 1000)
+            # no local staging file for URL
+            self.assertFalse(os.path.exists(
+                CaperURI(url).get_local_file(no_copy=True)))
+
+            # uploaded file is verified and removed if it is truncated
+            def truncate(driver, uri, chunks):
+                return write_stream(driver, uri, [b''.join(chunks)[:-1]])
+
+            with mock.patch.object(type(driver), 'write_stream', truncate):
+                self.assertRaisesRegex(
+                    Exception, 'Verification failed',
+                    CaperURI(url).copy, target_uri='gs://bucket/b.txt')
+            self.assertFalse(CaperURI('gs://bucket/b.txt').file_exists())
+        finally:
+            caper_uri.init_caper_uri(tmp_dir=tmp_dir)
+
+    def test_deepcopy_tsv_stream(self):
+        files = [self.write_data('{}.txt'.format(i), str(i))
+                 for i in range(5)]
+        contents = 'header\tfile\n' + ''.join(
+            'sample{}\t{}\n'.format(i, f) for i, f in enumerate(files))
+        tsv = self.write_data('samples.tsv', contents)
+
+        org_num_lines = CaperURI.DEEPCOPY_TSV_CHUNK_NUM_LINES
+        CaperURI.DEEPCOPY_TSV_CHUNK_NUM_LINES = 2
+        try:
+            new_tsv, updated = CaperURI(tsv).deepcopy(
+                URI_LOCAL, uri_exts=('.tsv',), parallel=True)
+        finally:
+            CaperURI.DEEPCOPY_TSV_CHUNK_NUM_LINES = org_num_lines
+        self.assertTrue(updated)
+        with open(new_tsv) as fp:
+            lines = fp.read().split('\n')
+        self.assertEqual(len(lines), 7)
+        self.assertEqual(lines[0], 'header\tfile')
+        self.assertEqual(lines[-1], '')
+        for i, line in enumerate(lines[1:-1]):
+            name, f = line.split('\t')
+            self.assertEqual(name, 'sample{}'.format(i))
+            with open(f) as fp:
+                self.assertEqual(fp.read(), str(i))
+        # temporary files are cleaned up
+        self.assertEqual(os.listdir(os.path.join(
+            CaperURI.TMP_DIR, CaperURI.STREAM_TMP_DIRNAME)), [])
+
+    def test_uri_candidate(self):
+        for s in ('gs://a/b.txt', 's3://a/b.txt', 'http://a.com/b.txt',
+                  'https://a.com/b.txt', 'ftp://a.com/b.txt', '/a/b.txt',
+                  '~/b.txt'):
+            self.assertTrue(CaperURI.is_uri_candidate(s), s)
+        for s in ('sample1', '0.5', 'true', '', 'a/b.txt', 'gs:/a', 1, None):
+            self.assertFalse(CaperURI.is_uri_candidate(s), s)
+            if isinstance(s, str):
+                self.assertFalse(CaperURI(s).can_deepcopy())
+
+        # CaperURI is not created for non-URI cells
+        f = self.write_data('a.txt', 'a')
+        tsv = self.write_data('cells.tsv', 'sample1\t0.5\t{}\n'.format(f))
+        with mock.patch.object(CaperURI, '__init__', autospec=True,
+                               side_effect=CaperURI.__init__) as m:
+            CaperURI(tsv).deepcopy(URI_LOCAL, uri_exts=('.tsv',))
+        created = [c[0][1] for c in m.call_args_list]
+        self.assertNotIn('sample1', created)
+        self.assertNotIn('0.5', created)
+        self.assertIn(f, created)
+
+        # prefetch and batch passes construct CaperURI only for files
+        # to stat or copy. local to local needs neither
+        files = []
+        for i in range(3):
+            files.append(os.path.join(self.data_dir, '{}.txt'.format(i)))
+            with open(files[-1], 'w') as fp:
+                fp.write(str(i))
+        tsv = os.path.join(self.data_dir, 'local.tsv')
+        with open(tsv, 'w') as fp:
+            fp.write(''.join('{}\tsample1\n'.format(f) for f in files))
+        CaperURI.BATCH_TRANSFER = True
+        try:
+            with mock.patch.object(CaperURI, '__init__', autospec=True,
+                                   side_effect=CaperURI.__init__) as m:
+                CaperURI(tsv).deepcopy(URI_LOCAL, uri_exts=('.tsv',))
+        finally:
+            CaperURI.BATCH_TRANSFER = False
+        self.assertEqual(sorted(c[0][1] for c in m.call_args_list),
+                         sorted(files + [tsv]))
+
+        self.assertFalse(hasattr(CaperURI(f), '__dict__'))
+
+    def test_lock(self):
+        target = CaperURI(os.path.join(self.root, 'target.txt'))
+        lock_file = target.get_uri() + CaperURI.LOCK_EXT
+        lock = target._CaperURI__lock()
+        with open(lock_file) as fp:
+            self.assertEqual(json.loads(fp.read())['pid'], os.getpid())
+
+        timer = threading.Timer(0.5, lock.close)
+        timer.start()
+        t = time.time()
+        # wakes up as soon as lock is released
+        target._CaperURI__wait_for_lock()
+        self.assertLess(time.time() - t, CaperURI.LOCK_POLL_MIN_SEC * 5)
+        timer.join()
+        self.assertFalse(os.path.exists(lock_file))
+
+    def test_stale_lock(self):
+        is_stale = CaperURI._CaperURI__is_stale_lock
+        self.assertFalse(is_stale(None, 0))
+        self.assertTrue(is_stale(None, CaperURI.LOCK_LEASE_SEC))
+        record = json.loads(CaperURI._CaperURI__new_lock_record())
+        self.assertFalse(is_stale(record, 0))
+        record['expires'] = time.time() - 1
+        self.assertTrue(is_stale(record, 0))
+
+        # owner process has died
+        p = subprocess.Popen(['true'])
+        p.wait()
+        record = json.loads(CaperURI._CaperURI__new_lock_record())
+        record['pid'] = p.pid
+        self.assertTrue(is_stale(record, 0))
+
+    def test_url_size(self):
+        url = self.write_data('a.txt', 'a' * 100)
+        self.assertEqual(CaperURI(url).get_file_size(), 100)
+        local_f = CaperURI(url).get_local_file()
+        # target has the same size as Content-Length. skip downloading
+        self.assertEqual(CaperURI(url).get_local_file(), local_f)
+        self.assertEqual(QuietHTTPRequestHandler.num_gets['/a.txt'], 1)
+
+    def test_url_validators(self):
+        url = self.write_data('a.txt', 'a' * 100)
+        local_f = CaperURI(url).get_local_file()
+        # revalidated with If-Modified-Since (HTTP 304)
+        self.assertEqual(CaperURI(url).get_local_file(), local_f)
+        self.assertEqual(QuietHTTPRequestHandler.num_gets['/a.txt'], 1)
+
+        # modified with the same size
+        path = os.path.join(self.data_dir, 'a.txt')
+        with open(path, 'w') as fp:
+            fp.write('b' * 100)
+        t = time.time() + 10
+        os.utime(path, (t, t))
+        self.assertEqual(CaperURI(url).get_local_file(), local_f)
+        self.assertEqual(QuietHTTPRequestHandler.num_gets['/a.txt'], 2)
+        with open(local_f) as fp:
+            self.assertEqual(fp.read(), 'b' * 100)
+
+    def test_stat_cache(self):
+        url = self.write_data('a.txt', 'a')
+        for _ in range(3):
+            self.assertTrue(CaperURI(url).file_exists())
+        self.assertEqual(QuietHTTPRequestHandler.num_heads['/a.txt'], 1)
+
+        org_ttl = CaperURI.STAT_CACHE_TTL_SEC
+        CaperURI.STAT_CACHE_TTL_SEC = 0
+        try:
+            self.assertTrue(CaperURI(url).file_exists())
+        finally:
+            CaperURI.STAT_CACHE_TTL_SEC = org_ttl
+        self.assertEqual(QuietHTTPRequestHandler.num_heads['/a.txt'], 2)
+
+    def test_local_copy_strategy(self):
+        src = os.path.join(self.data_dir, 'a.txt')
+        with open(src, 'w') as fp:
+            fp.write('a' * 100)
+        target = os.path.join(self.root, 'b.txt')
+        copy_local = CaperURI._CaperURI__copy_local
+
+        CaperURI.LOCAL_COPY_STRATEGIES = ('hardlink', 'copy')
+        self.assertEqual(copy_local(src, target), 'hardlink')
+        self.assertTrue(os.path.samefile(src, target))
+        # same hard link again
+        self.assertEqual(copy_local(src, target), 'hardlink')
+        self.assertEqual(os.listdir(self.root).count('b.txt'), 1)
+
+        # a hard link is replaced, not overwritten in place
+        CaperURI.LOCAL_COPY_STRATEGIES = ('zero_copy', 'copy')
+        self.assertEqual(copy_local(src, target), 'zero_copy')
+        self.assertFalse(os.path.samefile(src, target))
+        with open(target) as fp:
+            self.assertEqual(fp.read(), 'a' * 100)
+        self.assertEqual(os.path.getmtime(src), os.path.getmtime(target))
+
+        # fall back to a plain copy if reflink is not supported
+        with mock.patch('caper.caper_uri.fcntl.ioctl',
+                        side_effect=OSError(95, 'Not supported')):
+            CaperURI.LOCAL_COPY_STRATEGIES = ('reflink', 'copy')
+            self.assertEqual(copy_local(src, target), 'copy')
+        # no temporary file left
+        self.assertEqual(
+            [f for f in os.listdir(self.root) if f.startswith('b.txt')],
+            ['b.txt'])
+
+        self.assertRaises(ValueError, caper_uri.init_caper_uri,
+                          tmp_dir=self.root, local_copy_strategy='xxx')
+
+    def test_verify_checksum(self):
+        caper_uri.init_caper_uri(
+            tmp_dir=os.path.join(self.root, 'tmp_dir'),
+            verify_checksum=True)
+        src = os.path.join(self.data_dir, 'src.txt')
+        target = os.path.join(self.root, 'target.txt')
+        with open(src, 'w') as fp:
+            fp.write('a' * 100)
+        with open(target, 'w') as fp:
+            fp.write('b' * 100)
+        # same size but different contents
+        CaperURI(src).copy(target_uri=target)
+        with open(target) as fp:
+            self.assertEqual(fp.read(), 'a' * 100)
+
+        md5_dir = os.path.join(CaperURI.TMP_DIR, CaperURI.MD5_DIRNAME)
+        num_sidecars = sum(len(f) for _, _, f in os.walk(md5_dir))
+        self.assertEqual(num_sidecars, 2)
+        os.utime(target, (1, 1))
+        CaperURI(src).copy(target_uri=target)
+        # skipped
+        self.assertEqual(os.path.getmtime(target), 1)
+
+    def test_stat_many(self):
+        uris = ['gs://bucket/a/1.txt', 'gs://bucket/a/b/2.txt',
+                'gs://bucket/a/b/3.txt']
+        with mock.patch('caper.caper_storage.check_output',
+                        return_value=GSUTIL_LS_L.encode()) as m:
+            result = CaperURI.stat_many(uris)
+            # one non-recursive listing for each directory
+            # and never a recursive listing of a common parent
+            self.assertEqual(
+                sorted(c[0][0][-1] for c in m.call_args_list),
+                ['gs://bucket/a/1.txt*', 'gs://bucket/a/b/*'])
+            self.assertEqual(result['gs://bucket/a/1.txt'], (
+                True, 100, 'ca59d129c8c77761aafe733c8bcaf0f4'))
+            self.assertEqual(result['gs://bucket/a/b/2.txt'],
+                             (True, 200, None))
+            self.assertEqual(result['gs://bucket/a/b/3.txt'],
+                             (False, None, None))
+            # results are cached
+            self.assertFalse(CaperURI('gs://bucket/a/b/3.txt').file_exists())
+            self.assertEqual(
+                CaperURI('gs://bucket/a/b/2.txt').get_file_size(), 200)
+            self.assertEqual(m.call_count, 2)
+
+
+class TestCaperURIEmulated(CaperURIEmulatedTestCase):
+    """CaperURI on an emulated object store
+    """
+
+    def test_deepcopy_json_nested(self):
+        a = self.write('a.txt', 'a' * 10)
+        json_file = self.write('c.json', json.dumps(
+            {'x': [[a, 'y'], {'z': a}], 'n': 1, 's': 'not_a_file'}))
+
+        gcs_json, updated = CaperURI(json_file).deepcopy(
+            URI_GCS, uri_exts=('.json',))
+        self.assertTrue(updated)
+        d = json.loads(CaperURI(gcs_json).get_file_contents())
+        gcs_a = d['x'][0][0]
+        self.assertTrue(gcs_a.startswith('gs://tmp-bucket/caper/'))
+        self.assertEqual(d['x'], [[gcs_a, 'y'], {'z': gcs_a}])
+        self.assertEqual(d['n'], 1)
+        self.assertEqual(d['s'], 'not_a_file')
+        # key order is kept
+        self.assertEqual(list(d), ['x', 'n', 's'])
+
+        # nothing to rewrite
+        json_file = self.write('d.json', json.dumps({'s': 'not_a_file'}))
+        self.assertEqual(
+            CaperURI(json_file).deepcopy(
+                URI_GCS, uri_exts=('.json',), no_copy_root=True),
+            (json_file, False))
+
+    def test_copy_dir(self):
+        src_dir = os.path.join(self.data_dir, 'index')
+        os.makedirs(os.path.join(src_dir, 'sub'))
+        for rel, contents in (('a.txt', 'a' * 10), ('sub/b.txt', 'b' * 20)):
+            with open(os.path.join(src_dir, rel), 'w') as fp:
+                fp.write(contents)
+        driver = CaperURI.get_storage_driver('gs://')
+
+        # local to gs:// with a single listing for each of src and target
+        with mock.patch.object(driver, 'list', wraps=driver.list) as m:
+            gcs_dir = CaperURI(src_dir).copy(target_uri='gs://bucket/index')
+        self.assertEqual(gcs_dir, 'gs://bucket/index/')
+        m.assert_called_once_with('gs://bucket/index/', recursive=True)
+        cu = CaperURI(gcs_dir)
+        self.assertTrue(cu.is_dir())
+        self.assertTrue(cu.file_exists())
+        self.assertEqual(list(cu.list_dir()), ['a.txt', 'sub/b.txt'])
+        self.assertEqual(cu.get_file_size(), 30)
+
+        # incremental sync copies a changed file only
+        with open(os.path.join(src_dir, 'a.txt'), 'w') as fp:
+            fp.write('c' * 5)
+        with mock.patch.object(driver, 'upload', wraps=driver.upload) as m:
+            CaperURI(src_dir).copy_dir(gcs_dir, sync=True)
+        self.assertEqual([c[0][1] for c in m.call_args_list],
+                         ['gs://bucket/index/a.txt'])
+        # all files are copied without sync
+        with mock.patch.object(driver, 'upload', wraps=driver.upload) as m:
+            CaperURI(src_dir).copy_dir(gcs_dir)
+        self.assertEqual(m.call_count, 2)
+
+        # gs:// to s3:// and back to local
+        s3_dir = cu.copy(target_uri='s3://bucket/index/')
+        local_dir = CaperURI(s3_dir).copy(
+            target_uri=os.path.join(self.root, 'index'))
+        with open(os.path.join(local_dir, 'sub', 'b.txt')) as fp:
+            self.assertEqual(fp.read(), 'b' * 20)
+        self.assertEqual(CaperURI(local_dir).get_file_size(), 25)
+
+        # directories in JSON are not deepcopied (both local and cloud)
+        json_file = self.write('dirs.json', json.dumps(
+            {'gcs': gcs_dir, 'local': src_dir}))
+        self.assertEqual(CaperURI(json_file).plan_deepcopy(
+            URI_S3, uri_exts=('.json',)), [])
+        s3_json, updated = CaperURI(json_file).deepcopy(
+            URI_S3, uri_exts=('.json',))
+        self.assertEqual(json.loads(CaperURI(s3_json).get_file_contents()),
+                         {'gcs': gcs_dir, 'local': src_dir})
+
+        for d in (gcs_dir, s3_dir, local_dir):
+            CaperURI(d).rm()
+            self.assertFalse(CaperURI(d).file_exists())
+
+    def test_expand_glob(self):
+        driver = CaperURI.get_storage_driver('gs://')
+        for key in ('r/a_1.fastq.gz', 'r/a_2.fastq.gz', 'r/b.txt',
+                    'r/x/a_3.fastq.gz'):
+            driver.write('gs://bucket/' + key, key.encode())
+        self.write('c_1.txt', 'c')
+        self.write('c_2.txt', 'cc')
+
+        with mock.patch.object(driver, 'list', wraps=driver.list) as m, \
+                mock.patch.object(driver, 'stat', wraps=driver.stat) as m_stat:
+            result = CaperURI.expand_globs([
+                'gs://bucket/r/*.fastq.gz', 'gs://bucket/r/**/a_?.fastq.gz',
+                'gs://bucket/r/[!a]*', 'gs://bucket/r/*.bam'])
+            # matched files are not stat-ed again
+            self.assertEqual(
+                CaperURI('gs://bucket/r/a_1.fastq.gz').get_file_size(), 14)
+        # one recursive listing covers all patterns in it
+        m.assert_called_once_with('gs://bucket/r/', recursive=True)
+        m_stat.assert_not_called()
+        self.assertEqual(list(result['gs://bucket/r/*.fastq.gz']),
+                         ['gs://bucket/r/a_1.fastq.gz',
+                          'gs://bucket/r/a_2.fastq.gz'])
+        self.assertEqual(list(result['gs://bucket/r/**/a_?.fastq.gz']),
+                         ['gs://bucket/r/a_1.fastq.gz',
+                          'gs://bucket/r/a_2.fastq.gz',
+                          'gs://bucket/r/x/a_3.fastq.gz'])
+        self.assertEqual(result['gs://bucket/r/[!a]*'],
+                         {'gs://bucket/r/b.txt': 7})
+        self.assertEqual(result['gs://bucket/r/*.bam'], {})
+
+        # a file with literal wildcard characters is not expanded
+        driver.write('gs://bucket/r/[1].txt', b'1')
+        self.assertEqual(CaperURI.expand_globs(['gs://bucket/r/[1].txt']),
+                         {'gs://bucket/r/[1].txt': {
+                             'gs://bucket/r/[1].txt': 1}})
+
+        # relative to the working directory
+        cwd = os.getcwd()
+        os.chdir(self.root)
+        try:
+            self.assertEqual(
+                list(CaperURI.expand_globs(['data/c_*.txt'])['data/c_*.txt']),
+                [os.path.join(self.data_dir, 'c_1.txt'),
+                 os.path.join(self.data_dir, 'c_2.txt')])
+        finally:
+            os.chdir(cwd)
+
+        local_glob = os.path.join(self.data_dir, 'c_*.txt')
+        literal = self.write('[x].txt', 'x')
+        json_file = self.write('in.json', json.dumps({
+            'fastqs': 'gs://bucket/r/*.fastq.gz', 'c': local_glob,
+            'n': os.path.join(self.data_dir, '*.bam'),
+            'pairs': [['gs://bucket/r/a_1.fastq.gz', 'gs://bucket/r/x/*'],
+                      [local_glob, literal]]}))
+        CaperURI.EXPAND_GLOB = True
+        try:
+            s3_json, updated = CaperURI(json_file).deepcopy(
+                URI_S3, uri_exts=('.json',))
+        finally:
+            CaperURI.EXPAND_GLOB = False
+        self.assertTrue(updated)
+        d = json.loads(CaperURI(s3_json).get_file_contents())
+        self.assertEqual(len(d['fastqs']), 2)
+        self.assertEqual(
+            [CaperURI(f).get_file_contents() for f in d['c']], ['c', 'cc'])
+        self.assertTrue(all(f.startswith('s3://') for f in d['c']))
+        # no match
+        self.assertEqual(d['n'], os.path.join(self.data_dir, '*.bam'))
+        # matches are spliced into a list
+        self.assertEqual([len(v) for v in d['pairs']], [2, 3])
+        self.assertEqual(CaperURI(d['pairs'][0][1]).get_file_contents(),
+                         'r/x/a_3.fastq.gz')
+        self.assertEqual(CaperURI(d['pairs'][1][2]).get_file_contents(), 'x')
+
+
 if __name__ == '__main__':
     unittest.main()
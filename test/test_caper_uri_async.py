@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Tester for AsyncCaperURI
+
+Author:
+    Jin Lee (leepc12@gmail.com) at ENCODE-DCC
+"""
+
+import unittest
+import asyncio
+import os
+import json
+import threading
+import time
+from unittest import mock
+
+try:
+    import caper
+except:
+    import sys, os
+    script_path = os.path.dirname(os.path.realpath(__file__))
+    sys.path.append(os.path.join(script_path, '../'))
+    import caper
+
+from caper.caper_uri import CaperURI, URI_GCS
+from caper.caper_uri_async import AsyncCaperURI
+
+try:
+    from .caper_test_base import CaperURIEmulatedTestCase
+except ImportError:
+    from caper_test_base import CaperURIEmulatedTestCase
+
+
+class TestAsyncCaperURI(CaperURIEmulatedTestCase):
+
+    def test_concurrent(self):
+        files = [self.write('{}.txt'.format(i), 'a' * i) for i in range(10)]
+
+        async def main():
+            cus = [AsyncCaperURI(f) for f in files]
+            sizes = await asyncio.gather(*[cu.get_file_size() for cu in cus])
+            gcs_files = await asyncio.gather(
+                *[cu.get_file(URI_GCS) for cu in cus])
+            exists = await asyncio.gather(
+                *[AsyncCaperURI(f).file_exists() for f in gcs_files])
+            contents = await AsyncCaperURI(gcs_files[3]).get_file_contents()
+            return sizes, exists, contents
+
+        sizes, exists, contents = asyncio.run(main())
+        self.assertEqual(sizes, list(range(10)))
+        self.assertTrue(all(exists))
+        self.assertEqual(contents, 'aaa')
+
+    def test_cancel_deepcopy(self):
+        files = [self.write('{}.txt'.format(i), str(i)) for i in range(5)]
+        json_file = self.write('a.json', json.dumps(files))
+        driver = CaperURI.get_storage_driver('gs://')
+        started = threading.Event()
+        release = threading.Event()
+        org_upload = driver.upload
+
+        def upload(path, uri):
+            started.set()
+            release.wait(10)
+            org_upload(path, uri)
+
+        async def main():
+            task = asyncio.ensure_future(AsyncCaperURI(json_file).deepcopy(
+                URI_GCS, uri_exts=('.json',)))
+            await asyncio.get_event_loop().run_in_executor(
+                None, started.wait, 10)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        with mock.patch.object(driver, 'upload',
+                               side_effect=upload) as m:
+            asyncio.run(main())
+            release.set()
+            # running transfer is completed and then deepcopy stops
+            time.sleep(0.5)
+            self.assertEqual(m.call_count, 1)
+
+        num_lock_files = 0
+        for _, _, fnames in os.walk(self.root):
+            num_lock_files += sum(f.endswith('.lock') for f in fnames)
+        self.assertEqual(num_lock_files, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()